@@ -43,7 +43,8 @@ public class RigidCube : MonoBehaviour
     // Update is called once per frame
     void Update()
     {
-       
+        // kinematic cubes are moved from outside and drive the simulation instead
+        if (state == STATE_KINIMATIC) return;
         transform.position = box_pos;
         transform.rotation = box_rot;
     }
@@ -14,7 +14,8 @@ public class RigidScene : MonoBehaviour
     private int STATE_KINIMATIC = 1;
     private int STATE_DYNAMIC = 2;
 
-    private int max_obj = 500;
+    private int max_obj = 500; // must match max_object_num (TIOUCH_MAX_OBJECTS) of the exported module
+    private int max_particles = 20000; // must match max_particle_num (TIOUCH_MAX_PARTICLES) of the exported module
 
     private Mesh mesh;
 
@@ -24,25 +25,75 @@ public class RigidScene : MonoBehaviour
     private ComputeGraph _Compute_Graph_g_init;
     private ComputeGraph _Compute_Graph_g_update;
     private ComputeGraph _Compute_Graph_g_add_box;
+    private ComputeGraph _Compute_Graph_g_add_boxes;
+    private ComputeGraph _Compute_Graph_g_add_mesh;
     private ComputeGraph _Compute_Graph_g_copy_to_nd;
+    private ComputeGraph _Compute_Graph_g_copy_transforms;
     private ComputeGraph _Compute_Graph_g_set_ini_velocity;
     private ComputeGraph _Compute_Graph_g_reset_all;
+    private ComputeGraph _Compute_Graph_g_remove_object;
+    private ComputeGraph _Compute_Graph_g_compact;
+    private ComputeGraph _Compute_Graph_g_reorder;
+    private ComputeGraph _Compute_Graph_g_haptic_query;
+    private ComputeGraph _Compute_Graph_g_bake_static_sdf;
 
     public float dt = 1.0f / 60f;
     public float corr_rate = 0.8f;
     public float damp = 0.95f;
+    public int solver_iterations = 30; // clamped to max_iter of the exported graph
+    public float solver_tolerance = 0.0f; // 0 disables the early exit
     public Vector3 boundary_box_bot = new Vector3(-1.0f, 0.0f, -1.0f) * 1000;
     public Vector3 boundary_box_top = new Vector3(1.0f, 1.0f, 1.0f) * 1000;
     public Vector3 box_pos;
     public Quaternion box_rot;
     public Vector3 half_extent;
     public int state;
+    public float despawn_distance = 50.0f; // cubes further away from the scene are removed
+    public int reorder_interval = 0; // sort the particles of every cube by position every n updates, 0 never
+    private int update_frame = 0;
 
-    public NdArray<float> object_cm_ndarray;
-    public NdArray<float> object_rot_ndarray;
+    // readback ring: frame k writes slot k % readback_ring_size, the host reads
+    // the slot of frame k - 1, which is done by then, instead of waiting for frame k
+    public int readback_ring_size = 3;
+    // compact: position + quaternion of the objects that moved more than the thresholds,
+    // otherwise cm + 3x3 rotation of every object
+    public bool compact_readback = true;
+    public float readback_position_threshold = 1e-4f;
+    public float readback_rotation_threshold = 1e-4f;
+    private NdArray<float>[] object_cm_ring;
+    private NdArray<float>[] object_rot_ring;
+    private NdArray<float>[] transforms_ring;
+    private NdArray<int>[] transform_ids_ring;
+    private const int transform_size = 7;
+    private float[] transforms_host;
+    private int[] transform_ids_host;
+    private int readback_frame = 0;
+    // contact output: the graphs were exported with TIOUCH_CONTACT_OUTPUT=1, every readback also
+    // carries impulse(3), force(3), torque(3) and the particle contact count of each object
+    public bool contact_output = false;
+    private const int contact_output_size = 10;
+    private NdArray<float>[] object_contacts_ring;
+    private float[] contacts_host;
     public NdArray<float> boundary_box_ndarray;
+    public NdArray<float> boxes_ndarray;
+    public NdArray<float> mesh_particles_ndarray;
+    public NdArray<float> kinematic_poses_ndarray;
+    public NdArray<float> haptic_tool_ndarray;
+    public NdArray<float> haptic_wrench_ndarray;
+    public float haptic_stiffness = 500.0f;
+    private float[] haptic_tool = new float[8];
+    private float[] haptic_wrench = new float[6];
+    // add_boxes descriptor: center(3), half extent(3), rotation xyzw(4), state,
+    // friction(2), restitution, initial velocity(3)
+    private const int box_desc_size = 18;
+    // mesh particle: position in the mesh frame(3), sdf, sdf gradient(3), see scripts/mesh_import.py
+    private const int mesh_particle_size = 7;
+    // kinematic pose: rest Cm position(3), rotation relative to the rest pose xyzw(4), one row per object id
+    private const int kinematic_pose_size = 7;
+    private float[] kinematic_poses;
     // TODO: 2box
     private int child_num;
+    private Stack<int> free_object_ids = new Stack<int>();
     private float[] cm;
     private float[] rot;
 
@@ -55,7 +106,7 @@ public class RigidScene : MonoBehaviour
         new_cube.AddComponent<RigidCube>();
         new_cube.transform.localScale = new Vector3(extent, extent, extent) * 2.0f;
 
-        var obj_id = child_num++;
+        var obj_id = free_object_ids.Count > 0 ? free_object_ids.Pop() : child_num++;
         rigidCubes[obj_id] = new_cube.GetComponent<RigidCube>();
 
         if (_Compute_Graph_g_add_box != null)
@@ -81,6 +132,123 @@ public class RigidScene : MonoBehaviour
         else Debug.LogError("Oh how could this be... _Compute_Graph_g_set_ini_velocity missing!");
     }
 
+    private void write_box_desc(float[] boxes_host, int i, Vector3 pos, Vector3 half_extent, int state, Vector3 v)
+    {
+        int o = i * box_desc_size;
+        boxes_host[o + 0] = pos.x;
+        boxes_host[o + 1] = pos.y;
+        boxes_host[o + 2] = pos.z;
+        boxes_host[o + 3] = half_extent.x;
+        boxes_host[o + 4] = half_extent.y;
+        boxes_host[o + 5] = half_extent.z;
+        boxes_host[o + 6] = 0.0f;
+        boxes_host[o + 7] = 0.0f;
+        boxes_host[o + 8] = 0.0f;
+        boxes_host[o + 9] = 1.0f;
+        boxes_host[o + 10] = state;
+        boxes_host[o + 11] = 1.0f;
+        boxes_host[o + 12] = 1.0f;
+        boxes_host[o + 13] = 1.0f;
+        boxes_host[o + 14] = v.x;
+        boxes_host[o + 15] = v.y;
+        boxes_host[o + 16] = v.z;
+        boxes_host[o + 17] = 0.0f; // scene
+    }
+
+    // Spawn a prop from particles precomputed by scripts/mesh_import.py (the cached
+    // .npz "particles" array, mesh_particle_size floats per particle).
+    // The cube supplies the rendered mesh, its scale is baked into the particles.
+    public void add_mesh(RigidCube cube, float[] mesh_particles_host, Vector3 pos, Vector3 v)
+    {
+        var obj_id = free_object_ids.Count > 0 ? free_object_ids.Pop() : child_num++;
+        rigidCubes[obj_id] = cube;
+
+        var padded = new float[mesh_particle_size * max_particles];
+        Array.Copy(mesh_particles_host, padded, Math.Min(mesh_particles_host.Length, padded.Length));
+        mesh_particles_ndarray.CopyFromArray(padded);
+        var boxes_host = new float[box_desc_size * max_obj];
+        write_box_desc(boxes_host, 0, pos, Vector3.zero, STATE_DYNAMIC, v);
+        boxes_ndarray.CopyFromArray(boxes_host);
+        if (_Compute_Graph_g_add_mesh != null)
+            _Compute_Graph_g_add_mesh.LaunchAsync(new Dictionary<string, object>{
+                { "mesh_particles", mesh_particles_ndarray },
+                { "mesh_particle_num", mesh_particles_host.Length / mesh_particle_size },
+                { "boxes", boxes_ndarray },
+                { "object_id", obj_id }
+            });
+        else Debug.LogError("Oh how could this be... _Compute_Graph_g_add_mesh missing!");
+    }
+
+    public void remove_boxes(List<int> obj_ids)
+    {
+        foreach (var obj_id in obj_ids)
+        {
+            if (_Compute_Graph_g_remove_object != null)
+                _Compute_Graph_g_remove_object.LaunchAsync(new Dictionary<string, object>{
+                    { "object_id", obj_id }
+                });
+            else Debug.LogError("Oh how could this be... _Compute_Graph_g_remove_object missing!");
+            Destroy(rigidCubes[obj_id].gameObject);
+            rigidCubes[obj_id] = null;
+            Array.Clear(kinematic_poses, obj_id * kinematic_pose_size, kinematic_pose_size);
+            free_object_ids.Push(obj_id);
+        }
+
+        // one compaction for the whole batch
+        if (_Compute_Graph_g_compact != null)
+            _Compute_Graph_g_compact.LaunchAsync(new Dictionary<string, object>{
+                { "total_objects", child_num }
+            });
+        else Debug.LogError("Oh how could this be... _Compute_Graph_g_compact missing!");
+    }
+
+    // Contacts of object obj_id in the frame the cubes show, e.g. for the force feedback of a
+    // grabbed cube or a kinematic tool; returns the particle contact count, 0 without contact_output.
+    public int object_contact(int obj_id, out Vector3 impulse, out Vector3 force, out Vector3 torque)
+    {
+        int o = obj_id * contact_output_size;
+        impulse = new Vector3(contacts_host[o + 0], contacts_host[o + 1], contacts_host[o + 2]);
+        force = new Vector3(contacts_host[o + 3], contacts_host[o + 4], contacts_host[o + 5]);
+        torque = new Vector3(contacts_host[o + 6], contacts_host[o + 7], contacts_host[o + 8]);
+        return (int)contacts_host[o + 9];
+    }
+
+    // Capsule p0-p1 (p0 == p1 for a sphere) against the particles of the last update.
+    // Meant to be called from the haptic loop between updates, dt is the time since the previous query.
+    // The reaction impulse on the touched cubes is applied in the next update.
+    public void haptic_query(Vector3 p0, Vector3 p1, float radius, float dt, out Vector3 force, out Vector3 torque)
+    {
+        haptic_tool[0] = p0.x;
+        haptic_tool[1] = p0.y;
+        haptic_tool[2] = p0.z;
+        haptic_tool[3] = p1.x;
+        haptic_tool[4] = p1.y;
+        haptic_tool[5] = p1.z;
+        haptic_tool[6] = radius;
+        haptic_tool[7] = 0.0f; // scene
+        haptic_tool_ndarray.CopyFromArray(haptic_tool);
+        if (_Compute_Graph_g_haptic_query != null)
+            _Compute_Graph_g_haptic_query.LaunchAsync(new Dictionary<string, object>{
+                { "haptic_tool", haptic_tool_ndarray },
+                { "stiffness", haptic_stiffness },
+                { "dt", dt },
+                { "haptic_wrench", haptic_wrench_ndarray }
+            });
+        else Debug.LogError("Oh how could this be... _Compute_Graph_g_haptic_query missing!");
+        haptic_wrench_ndarray.CopyToArray(haptic_wrench);
+        force = new Vector3(haptic_wrench[0], haptic_wrench[1], haptic_wrench[2]);
+        torque = new Vector3(haptic_wrench[3], haptic_wrench[4], haptic_wrench[5]);
+    }
+
+    // Static cubes collide through the baked volume instead of the particle pairs.
+    // Call again after adding or removing a static cube.
+    public void bake_static_sdf()
+    {
+        if (_Compute_Graph_g_bake_static_sdf != null)
+            _Compute_Graph_g_bake_static_sdf.LaunchAsync(new Dictionary<string, object>{});
+        else Debug.LogError("Oh how could this be... _Compute_Graph_g_bake_static_sdf missing!");
+    }
+
     public void reset_scene()
     {
         if (_Compute_Graph_g_reset_all != null)
@@ -132,16 +300,45 @@ public class RigidScene : MonoBehaviour
             _Compute_Graph_g_init = cgraphs["init"];
             _Compute_Graph_g_update = cgraphs["update"];
             _Compute_Graph_g_add_box = cgraphs["add_box"];
+            _Compute_Graph_g_add_boxes = cgraphs["add_boxes"];
+            _Compute_Graph_g_add_mesh = cgraphs["add_mesh"];
             _Compute_Graph_g_copy_to_nd = cgraphs["copy_to_nd"];
+            _Compute_Graph_g_copy_transforms = cgraphs["copy_transforms"];
             _Compute_Graph_g_set_ini_velocity = cgraphs["set_ini_velocity"];
             _Compute_Graph_g_reset_all = cgraphs["reset_all"];
+            _Compute_Graph_g_remove_object = cgraphs["remove_object"];
+            _Compute_Graph_g_compact = cgraphs["compact"];
+            _Compute_Graph_g_reorder = cgraphs["reorder"];
+            _Compute_Graph_g_haptic_query = cgraphs["haptic_query"];
+            _Compute_Graph_g_bake_static_sdf = cgraphs["bake_static_sdf"];
         }
         else Debug.LogError("Oh how could this be... compute graphs missing!");
 
 
-        object_cm_ndarray = new NdArrayBuilder<float>().Shape(max_obj).ElemShape(3).HostRead().Build();
-        object_rot_ndarray = new NdArrayBuilder<float>().Shape(max_obj).ElemShape(3, 3).HostRead().Build();
+        object_cm_ring = new NdArray<float>[readback_ring_size];
+        object_rot_ring = new NdArray<float>[readback_ring_size];
+        transforms_ring = new NdArray<float>[readback_ring_size];
+        transform_ids_ring = new NdArray<int>[readback_ring_size];
+        object_contacts_ring = new NdArray<float>[readback_ring_size];
+        for (int k = 0; k < readback_ring_size; k++)
+        {
+            object_cm_ring[k] = new NdArrayBuilder<float>().Shape(max_obj).ElemShape(3).HostRead().Build();
+            object_rot_ring[k] = new NdArrayBuilder<float>().Shape(max_obj).ElemShape(3, 3).HostRead().Build();
+            transforms_ring[k] = new NdArrayBuilder<float>().Shape(max_obj).ElemShape(transform_size).HostRead().Build();
+            transform_ids_ring[k] = new NdArrayBuilder<int>().Shape(max_obj + 1).HostRead().Build();
+            if (contact_output)
+                object_contacts_ring[k] = new NdArrayBuilder<float>().Shape(max_obj).ElemShape(contact_output_size).HostRead().Build();
+        }
+        contacts_host = new float[contact_output_size * max_obj];
+        transforms_host = new float[transform_size * max_obj];
+        transform_ids_host = new int[max_obj + 1];
         boundary_box_ndarray = new NdArrayBuilder<float>().Shape(2).ElemShape(3).HostWrite().Build();
+        boxes_ndarray = new NdArrayBuilder<float>().Shape(max_obj).ElemShape(box_desc_size).HostWrite().Build();
+        mesh_particles_ndarray = new NdArrayBuilder<float>().Shape(max_particles).ElemShape(mesh_particle_size).HostWrite().Build();
+        kinematic_poses_ndarray = new NdArrayBuilder<float>().Shape(max_obj).ElemShape(kinematic_pose_size).HostWrite().Build();
+        kinematic_poses = new float[kinematic_pose_size * max_obj];
+        haptic_tool_ndarray = new NdArrayBuilder<float>().Shape(8).HostWrite().Build();
+        haptic_wrench_ndarray = new NdArrayBuilder<float>().Shape(6).HostRead().Build();
 
         // get all data from children
         var boundary_box_host = new float[6];
@@ -160,6 +357,8 @@ public class RigidScene : MonoBehaviour
             _Compute_Graph_g_init.LaunchAsync(new Dictionary<string, object>{});
         else Debug.LogError("Oh how could this be... _Compute_Graph_g_init missing!");
 
+        // all children in one add_boxes launch
+        var boxes_host = new float[box_desc_size * max_obj];
         for (int i = 0; i < child_num; i++)
         {
             var cube = rigidCubes[i];
@@ -167,19 +366,19 @@ public class RigidScene : MonoBehaviour
             box_rot = cube.GetComponent<RigidCube>().transform.rotation;
             state = cube.GetComponent<RigidCube>().state;
             half_extent = cube.GetComponent<RigidCube>().transform.localScale / 2.0f;
-            if (_Compute_Graph_g_add_box != null)
-                _Compute_Graph_g_add_box.LaunchAsync(new Dictionary<string, object>{
-                { "center_x", box_pos.x },
-                { "center_y", box_pos.y },
-                { "center_z", box_pos.z },
-                { "half_extent_x", half_extent.x },
-                { "half_extent_y", half_extent.y },
-                { "half_extent_z", half_extent.z },
-                { "state", state },
-                { "object_id", i }
-            });
-            else Debug.LogError("Oh how could this be... _Compute_Graph_g_add_box missing!");
+            // rotation stays identity like add_box, the cubes apply the simulated rotation on top of their own
+            write_box_desc(boxes_host, i, box_pos, half_extent, state, Vector3.zero);
         }
+        boxes_ndarray.CopyFromArray(boxes_host);
+        if (_Compute_Graph_g_add_boxes != null)
+            _Compute_Graph_g_add_boxes.LaunchAsync(new Dictionary<string, object>{
+                { "boxes", boxes_ndarray },
+                { "box_num", child_num },
+                { "object_id", 0 }
+            });
+        else Debug.LogError("Oh how could this be... _Compute_Graph_g_add_boxes missing!");
+
+        bake_static_sdf();
 
         Debug.Log("successfully start!");
     }
@@ -203,35 +402,111 @@ public class RigidScene : MonoBehaviour
         }
         
 
+        // kinematic cubes are driven by their transform (e.g. a haptic tool), one upload for all of them
+        for (int i = 0; i < child_num; i++)
+        {
+            if (rigidCubes[i] == null || rigidCubes[i].state != STATE_KINIMATIC) continue;
+            var t = rigidCubes[i].transform;
+            int o = i * kinematic_pose_size;
+            kinematic_poses[o + 0] = t.position.x;
+            kinematic_poses[o + 1] = t.position.y;
+            kinematic_poses[o + 2] = t.position.z;
+            kinematic_poses[o + 3] = t.rotation.x;
+            kinematic_poses[o + 4] = t.rotation.y;
+            kinematic_poses[o + 5] = t.rotation.z;
+            kinematic_poses[o + 6] = t.rotation.w;
+        }
+        kinematic_poses_ndarray.CopyFromArray(kinematic_poses);
+
         if (_Compute_Graph_g_update != null)
             _Compute_Graph_g_update.LaunchAsync(new Dictionary<string, object>{
+                { "kinematic_poses", kinematic_poses_ndarray },
                 { "dt", dt },
                 { "total_objects", child_num },
                 { "boundary_box", boundary_box_ndarray },
                 { "corr_rate", corr_rate },
-                { "damp", damp}
+                { "damp", damp},
+                { "iterations", solver_iterations },
+                { "tolerance", solver_tolerance }
             });
         else Debug.LogError("Oh how could this be... _Compute_Graph_g_update missing!");
 
-        if (_Compute_Graph_g_copy_to_nd != null)
-            _Compute_Graph_g_copy_to_nd.LaunchAsync(new Dictionary<string, object>{
-                { "total_objects", child_num },
-                { "object_cm", object_cm_ndarray },
-                { "object_rot", object_rot_ndarray }
-            });
-        else Debug.LogError("Oh how could this be... _Compute_Graph_g_copy_to_nd missing!");
-
-        object_cm_ndarray.CopyToArray(cm);
-        object_rot_ndarray.CopyToArray(rot);
+        update_frame++;
+        if (reorder_interval > 0 && update_frame % reorder_interval == 0)
+        {
+            if (_Compute_Graph_g_reorder != null)
+                _Compute_Graph_g_reorder.LaunchAsync(new Dictionary<string, object>{
+                    { "total_objects", child_num }
+                });
+            else Debug.LogError("Oh how could this be... _Compute_Graph_g_reorder missing!");
+        }
 
-        var sub_rot = new float[9];
-        for (int i = 0; i < child_num; i++)
+        int slot = readback_frame % readback_ring_size;
+        if (compact_readback)
         {
-            Array.Copy(rot, i*9, sub_rot, 0, 9);
-            rigidCubes[i].box_rot = rot2quat(sub_rot);
-            rigidCubes[i].box_pos = new Vector3(cm[i * 3 + 0], cm[i * 3 + 1], cm[i * 3 + 2]);
+            var args = new Dictionary<string, object>{
+                { "total_objects", child_num },
+                { "position_threshold", readback_position_threshold },
+                { "rotation_threshold", readback_rotation_threshold },
+                { "transforms", transforms_ring[slot] },
+                { "transform_ids", transform_ids_ring[slot] }
+            };
+            if (contact_output) args["object_contacts"] = object_contacts_ring[slot];
+            if (_Compute_Graph_g_copy_transforms != null)
+                _Compute_Graph_g_copy_transforms.LaunchAsync(args);
+            else Debug.LogError("Oh how could this be... _Compute_Graph_g_copy_transforms missing!");
+        }
+        else
+        {
+            var args = new Dictionary<string, object>{
+                { "total_objects", child_num },
+                { "object_cm", object_cm_ring[slot] },
+                { "object_rot", object_rot_ring[slot] }
+            };
+            if (contact_output) args["object_contacts"] = object_contacts_ring[slot];
+            if (_Compute_Graph_g_copy_to_nd != null)
+                _Compute_Graph_g_copy_to_nd.LaunchAsync(args);
+            else Debug.LogError("Oh how could this be... _Compute_Graph_g_copy_to_nd missing!");
         }
 
         Runtime.Submit();
+
+        // the cubes show the previous frame
+        readback_frame++;
+        if (readback_frame < 2) return;
+        int ready = (readback_frame - 2) % readback_ring_size;
+
+        if (contact_output) object_contacts_ring[ready].CopyToArray(contacts_host);
+
+        var fallen = new List<int>();
+        if (compact_readback)
+        {
+            transform_ids_ring[ready].CopyToArray(transform_ids_host);
+            transforms_ring[ready].CopyToArray(transforms_host);
+            for (int k = 0; k < transform_ids_host[0]; k++)
+            {
+                int i = transform_ids_host[k + 1];
+                if (rigidCubes[i] == null || rigidCubes[i].state == STATE_KINIMATIC) continue;
+                int o = k * transform_size;
+                rigidCubes[i].box_pos = new Vector3(transforms_host[o + 0], transforms_host[o + 1], transforms_host[o + 2]);
+                rigidCubes[i].box_rot = new Quaternion(transforms_host[o + 3], transforms_host[o + 4], transforms_host[o + 5], transforms_host[o + 6]);
+                if (rigidCubes[i].box_pos.magnitude > despawn_distance) fallen.Add(i);
+            }
+        }
+        else
+        {
+            object_cm_ring[ready].CopyToArray(cm);
+            object_rot_ring[ready].CopyToArray(rot);
+            var sub_rot = new float[9];
+            for (int i = 0; i < child_num; i++)
+            {
+                if (rigidCubes[i] == null || rigidCubes[i].state == STATE_KINIMATIC) continue;
+                Array.Copy(rot, i*9, sub_rot, 0, 9);
+                rigidCubes[i].box_rot = rot2quat(sub_rot);
+                rigidCubes[i].box_pos = new Vector3(cm[i * 3 + 0], cm[i * 3 + 1], cm[i * 3 + 2]);
+                if (rigidCubes[i].box_pos.magnitude > despawn_distance) fallen.Add(i);
+            }
+        }
+        if (fallen.Count > 0) remove_boxes(fallen);
     }
 }
@@ -0,0 +1,293 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+
+# headless benchmark: procedural scenes through the update and copy_to_nd graphs
+# usage: python scripts/benchmark.py --archs cpu vulkan --scenes stack rain pyramid --out bench.json
+# every arch runs in its own process since taichi is initialised once per process
+
+
+def random_quat(rng):
+    q = rng.normal(size=4)
+    return q / np.linalg.norm(q)
+
+
+def ground_desc(rs, half_width):
+    # thin static slab the scenes rest on, its top is at y = 0.2
+    return rs.box_desc((0.0, 0.1, 0.0), (half_width, 0.1, half_width), state=rs.STATE_STATIC)
+
+
+def stack_scene(rs, rng, size):
+    # size boxes stacked in one column
+    descs = [ground_desc(rs, 1.0)]
+    for n in range(size):
+        descs.append(rs.box_desc((0.0, 0.5 + 0.5 * n, 0.0), (0.2, 0.2, 0.2)))
+    return descs
+
+
+def rain_scene(rs, rng, size):
+    # size randomly rotated boxes on a jittered lattice above the ground
+    side = int(np.ceil(np.sqrt(size)))
+    descs = [ground_desc(rs, 0.4 * side)]
+    for n in range(size):
+        i, j, k = n % side, (n // side) % side, n // (side * side)
+        center = (
+            (i - side / 2) * 0.8 + rng.uniform(-0.1, 0.1),
+            1.0 + k * 0.8 + rng.uniform(-0.1, 0.1),
+            (j - side / 2) * 0.8 + rng.uniform(-0.1, 0.1),
+        )
+        descs.append(rs.box_desc(center, (0.15, 0.15, 0.15), rotation=random_quat(rng)))
+    return descs
+
+
+def pyramid_scene(rs, rng, size):
+    # size layers, layer l holds (size - l)^2 boxes
+    descs = [ground_desc(rs, 0.3 * size + 0.5)]
+    for layer in range(size):
+        n = size - layer
+        for i in range(n):
+            for j in range(n):
+                center = ((i - (n - 1) / 2) * 0.5, 0.5 + 0.5 * layer, (j - (n - 1) / 2) * 0.5)
+                descs.append(rs.box_desc(center, (0.2, 0.2, 0.2)))
+    return descs
+
+
+scenes = {
+    'stack': stack_scene,
+    'rain': rain_scene,
+    'pyramid': pyramid_scene,
+}
+
+
+def timed(graph_run, sync):
+    t = time.perf_counter()
+    graph_run()
+    sync()
+    return time.perf_counter() - t
+
+
+def batch_descs(rs, descs, batch):
+    # the same boxes once per scene, scenes overlap in space but never touch
+    descs = np.tile(np.asarray(descs), (batch, 1))
+    descs[:, rs.BOX_DESC_SCENE] = np.repeat(np.arange(batch), len(descs) // batch)
+    return descs
+
+
+def shuffle_particles(rs, rng, object_num):
+    # random particle order inside every object range, the worst case for
+    # the neighbour lookups that the reorder graph is meant to undo
+    begin = rs.object_begin.to_numpy()[:object_num]
+    size = rs.object_size.to_numpy()[:object_num]
+    perm = np.arange(rs.max_particle_num, dtype=np.int32)
+    for b, n in zip(begin, size):
+        perm[b:b + n] = b + rng.permutation(n)
+    rs.particle_perm.from_numpy(perm)
+    rs.permute_particles()
+    rs.rebuild_object_tables(object_num)
+
+
+def stability(rs, descs, object_num):
+    # how far the dynamic boxes slid sideways from where they were spawned, and
+    # how fast the fastest one still moves
+    dynamic = descs[:, rs.BOX_DESC_STATE] == rs.STATE_DYNAMIC
+    start = descs[:, rs.BOX_DESC_CENTER:rs.BOX_DESC_CENTER + 3][dynamic]
+    cm = rs.object_Cm.to_numpy()[:object_num][dynamic]
+    speed = np.linalg.norm(rs.v.to_numpy()[:rs.particle_num[None]], axis=1)
+    return {
+        'max_drift': float(np.linalg.norm((cm - start)[:, [0, 2]], axis=1).max()),
+        'max_speed': float(speed.max()),
+    }
+
+
+def run_scene(rs, ti, scene, size, frames, warmup, seed, static_sdf, readback, batch, iterations, shuffle):
+    rng = np.random.default_rng(seed)
+    rs.init_mock()
+    descs = batch_descs(rs, scenes[scene](rs, rng, size), batch)
+    object_num = rs.add_boxes_mock(descs, 0)
+    if shuffle:
+        shuffle_particles(rs, rng, object_num)
+    bake_time = 0.0
+    if static_sdf:
+        rs.bake_static_sdf_mock()
+        ti.sync()
+        # second bake, the first one compiles
+        bake_time = timed(rs.bake_static_sdf_mock, ti.sync)
+
+    def update():
+        rs.update_mock(object_num=object_num, dt=1.0 / 60.0, corr_rate=1.0, damp=0.98,
+            iterations=iterations)
+
+    def copy_to_nd():
+        if readback == 'direct':
+            rs.copy_to_nd_mock(object_num)
+            rs.object_cm_to_host.to_numpy()
+            rs.object_rot_to_host.to_numpy()
+            if rs.contact_output_enabled:
+                rs.object_contacts_to_host.to_numpy()
+            return
+        # ring: read the slot of the previous frame
+        compact = readback == 'compact'
+        slot = rs.copy_transforms_mock(object_num, compact=compact)
+        if slot is not None:
+            rs.read_transforms(slot, compact=compact, total_objects=object_num)
+            if rs.contact_output_enabled:
+                rs.read_contacts(slot, object_num)
+
+    # first frames compile the kernels
+    for _ in range(warmup):
+        update()
+        copy_to_nd()
+    ti.sync()
+    rs.reset_profile()
+
+    times = {'update': [], 'copy_to_nd': []}
+    for _ in range(frames):
+        times['update'].append(timed(update, ti.sync))
+        times['copy_to_nd'].append(timed(copy_to_nd, ti.sync))
+
+    frame_time = sum(sum(t) for t in times.values()) / frames
+    result = {
+        'scene': scene,
+        'size': size,
+        'batch': batch,
+        'objects': object_num,
+        'particles': int(rs.particle_num[None]),
+        'frames': frames,
+        'fps': 1.0 / frame_time,
+        'static_sdf': static_sdf,
+        'readback': readback,
+        'iterations': iterations,
+        'shuffle': shuffle,
+        'reorder_interval': rs.reorder_interval,
+        'stability': stability(rs, descs, object_num),
+        'bake_ms': 1000.0 * bake_time,
+        'graphs': {
+            name: {
+                'total_s': sum(t),
+                'mean_ms': 1000.0 * float(np.mean(t)),
+                'max_ms': 1000.0 * float(np.max(t)),
+            }
+            for name, t in times.items()
+        },
+    }
+    if rs.profiling:
+        # per-kernel p50/p99 of the timed frames
+        result['profile'] = rs.profile_stats()
+        # grid, pairs and contacts of all solver iterations
+        result['contact_ms'] = sum(
+            result['profile'].get('kernel/' + kernel, {'mean_ms': 0.0})['mean_ms']
+            for kernel in ('build_object_pairs', 'build_grid', 'solve_constraints'))
+    return result
+
+
+def run_child(args):
+    import taichi as ti
+    import rigid_scene as rs
+
+    rs.init_taichi(
+        arch=getattr(ti, args.arch), max_particles=args.max_particles,
+        max_objects=args.max_objects, profile=args.profile, rotation=args.rotation,
+        max_scenes=args.batch, body_model=args.body_model,
+        contact_solver=args.contact_solver, sor=args.sor, reorder=args.reorder_interval,
+        rest=args.rest_storage, contact_output=args.contact_output
+    )
+    arch = ti.lang.impl.current_cfg().arch.name
+    results = []
+    for scene in args.scenes:
+        results.append(run_scene(rs, ti, scene, args.size[scene], args.frames, args.warmup, args.seed,
+            not args.static_pairs, args.readback, args.batch, args.iterations, args.shuffle))
+    print(json.dumps({
+        'arch': arch, 'rotation': args.rotation, 'body_model': args.body_model,
+        'contact_solver': args.contact_solver, 'rest_storage': args.rest_storage,
+        'contact_output': args.contact_output, 'results': results
+    }))
+
+
+def parse_size(values):
+    # scene=size pairs, e.g. stack=20 pyramid=5
+    size = {'stack': 20, 'rain': 100, 'pyramid': 5}
+    for value in values:
+        scene, n = value.split('=')
+        size[scene] = int(n)
+    return size
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--archs', nargs='+', default=['cpu', 'vulkan'])
+    parser.add_argument('--scenes', nargs='+', default=list(scenes), choices=list(scenes))
+    parser.add_argument('--size', nargs='*', default=[], help='scene=size, e.g. stack=20 rain=100 pyramid=5')
+    parser.add_argument('--frames', type=int, default=120)
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-particles', type=int, default=100000)
+    parser.add_argument('--max-objects', type=int, default=2000)
+    parser.add_argument('--out', default=None, help='json file, stdout when omitted')
+    parser.add_argument('--profile', action='store_true', help='add per-kernel timings from the kernel profiler')
+    parser.add_argument('--static-pairs', action='store_true',
+        help='keep the ground in the particle pair loop instead of baking it into the static sdf volume')
+    parser.add_argument('--readback', default='direct', choices=['direct', 'ring', 'compact'],
+        help='copy_to_nd into fixed ndarrays, into the readback ring, or moved objects only')
+    parser.add_argument('--rotation', default='polar', choices=['polar', 'quaternion'],
+        help='rotation extraction mode of the build')
+    parser.add_argument('--body-model', default='shape_matching', choices=['shape_matching', 'rigid'],
+        help='body model of the build')
+    parser.add_argument('--contact-solver', default='jacobi', choices=['jacobi', 'jacobi_sor', 'colored'],
+        help='contact solve schedule of the build')
+    parser.add_argument('--sor', type=float, default=1.5, help='relaxation factor of the jacobi_sor schedule')
+    parser.add_argument('--batch', type=int, default=1,
+        help='copies of every scene stepped together as independent scenes of one update')
+    parser.add_argument('--iterations', type=int, default=30, help='solver iterations per update')
+    parser.add_argument('--rest-storage', default='f32', choices=['f32', 'compact'],
+        help='rest state storage of the build, compact drift against f32: rest_drift.py')
+    parser.add_argument('--contact-output', action='store_true',
+        help='build with the per-object contact output and read it back with the transforms')
+    parser.add_argument('--reorder-interval', type=int, default=0,
+        help='run the spatial reorder graph every n updates, 0 never')
+    parser.add_argument('--shuffle', action='store_true',
+        help='shuffle the particles inside every object after adding the scene')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--arch', default='cpu', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    args.size = parse_size(args.size)
+
+    if args.child:
+        run_child(args)
+        sys.exit(0)
+
+    report = []
+    for arch in args.archs:
+        child_args = [a for a in sys.argv[1:] if a != '--child']
+        proc = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--child', '--arch', arch] + child_args,
+            capture_output=True, text=True
+        )
+        if proc.returncode != 0:
+            print('{}: failed\n{}'.format(arch, proc.stderr), file=sys.stderr)
+            continue
+        run = json.loads(proc.stdout.strip().splitlines()[-1])
+        if run['arch'] != arch and run['arch'] != {'cpu': 'x64'}.get(arch):
+            # taichi fell back to another backend, that one is measured on its own
+            print('{}: not available, skipped'.format(arch), file=sys.stderr)
+            continue
+        run['requested_arch'] = arch
+        report.append(run)
+        for r in run['results']:
+            print('{:>8} {:>8} {:>6} objects {:>7} particles  update {:8.3f} ms  copy_to_nd {:7.3f} ms  {:7.1f} fps'
+                '  drift {:6.3f}'.format(
+                run['arch'], r['scene'], r['objects'], r['particles'],
+                r['graphs']['update']['mean_ms'], r['graphs']['copy_to_nd']['mean_ms'], r['fps'],
+                r['stability']['max_drift']), file=sys.stderr)
+
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
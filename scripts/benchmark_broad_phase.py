@@ -0,0 +1,89 @@
+import argparse
+import time
+
+import taichi as ti
+
+import rigid_scene as rs
+
+
+# benchmark: object pairs + spatial hash grid vs all-pairs solve_constraints
+# usage: python scripts/benchmark_broad_phase.py --sizes 1000 5000 20000
+
+
+def build_lattice_scene(target_particle_num, half_extent=0.2, gap=0.05):
+    # boxes of half_extent 0.2 hold 5x5x5 = 125 particles each
+    rs.init_mock()
+    box_size = 2.0 * half_extent + gap
+    box_num = max(1, target_particle_num // 125)
+    side = 1
+    while side * side * side < box_num:
+        side += 1
+
+    object_id = 0
+    for n in range(box_num):
+        i = n % side
+        j = (n // side) % side
+        k = n // (side * side)
+        object_id = rs.add_box_mock(
+            center_x=(i - side / 2) * box_size,
+            center_y=1.0 + j * box_size,
+            center_z=(k - side / 2) * box_size,
+            half_extent_x=half_extent,
+            half_extent_y=half_extent,
+            half_extent_z=half_extent,
+            state=rs.STATE_DYNAMIC,
+            object_id=object_id
+        )
+    return object_id
+
+
+def start_solver_iteration():
+    # the per-iteration kernels only run inside an active solver iteration
+    rs.solver_iter[None] = 0
+    rs.begin_solver_iteration(1, 0.0)
+
+
+def time_iterations(step, object_num, repeat):
+    # first call compiles the kernels
+    rs.reset_all(object_num)
+    step()
+    ti.sync()
+
+    total = 0.0
+    for _ in range(repeat):
+        rs.reset_all(object_num)
+        ti.sync()
+        t = time.perf_counter()
+        step()
+        ti.sync()
+        total += time.perf_counter() - t
+    return total / repeat
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 5000, 20000])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--gap', type=float, default=0.05, help='spacing between neighbouring boxes')
+    args = parser.parse_args()
+
+    print('{:>10} {:>14} {:>14} {:>10}'.format('particles', 'all pairs ms', 'grid ms', 'speedup'))
+    for size in args.sizes:
+        object_num = build_lattice_scene(size, gap=args.gap)
+
+        def all_pairs_step():
+            start_solver_iteration()
+            rs.solve_constraints_all_pairs(object_num, 1.0)
+
+        rs.sort_objects(object_num)
+
+        def grid_step():
+            start_solver_iteration()
+            rs.build_object_pairs(object_num)
+            rs.build_grid()
+            rs.solve_constraints(object_num, 1.0)
+
+        t_all = time_iterations(all_pairs_step, object_num, args.repeat)
+        t_grid = time_iterations(grid_step, object_num, args.repeat)
+        print('{:>10} {:>14.3f} {:>14.3f} {:>9.1f}x'.format(
+            rs.particle_num[None], t_all * 1000, t_grid * 1000, t_all / t_grid))
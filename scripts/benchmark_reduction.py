@@ -0,0 +1,77 @@
+import argparse
+import time
+
+import numpy as np
+import taichi as ti
+
+import rigid_scene as rs
+
+
+# benchmark: segmented vs atomic calc_all_object_cm_A_rot on skewed object sizes
+# usage: python scripts/benchmark_reduction.py --big-half-extent 1.0 --small-num 300
+
+
+def build_skewed_scene(big_half_extent, small_num, small_half_extent=0.1):
+    # one large cube owning most particles plus many tiny ones
+    rs.init_mock()
+    object_id = rs.add_box_mock(
+        center_x=0.0, center_y=big_half_extent + 1.0, center_z=0.0,
+        half_extent_x=big_half_extent,
+        half_extent_y=big_half_extent,
+        half_extent_z=big_half_extent,
+        state=rs.STATE_DYNAMIC,
+        object_id=0
+    )
+    side = int(np.ceil(np.sqrt(small_num)))
+    for n in range(small_num):
+        object_id = rs.add_box_mock(
+            center_x=(n % side) * 0.5 + 3.0,
+            center_y=1.0,
+            center_z=(n // side) * 0.5,
+            half_extent_x=small_half_extent,
+            half_extent_y=small_half_extent,
+            half_extent_z=small_half_extent,
+            state=rs.STATE_DYNAMIC,
+            object_id=object_id
+        )
+    return object_id
+
+
+def time_kernel(kernel, object_num, repeat):
+    kernel(object_num)
+    ti.sync()
+    t = time.perf_counter()
+    for _ in range(repeat):
+        kernel(object_num)
+    ti.sync()
+    return (time.perf_counter() - t) / repeat
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--big-half-extent', type=float, default=1.0)
+    parser.add_argument('--small-num', type=int, default=300)
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    object_num = build_skewed_scene(args.big_half_extent, args.small_num)
+    # perturb the rest pose so A is not trivially the identity
+    rs.update_mock(object_num=object_num, dt=1.0 / 60.0, corr_rate=1.0, damp=0.98)
+    ti.sync()
+
+    t_atomic = time_kernel(rs.calc_all_object_cm_A_rot_atomic_kernel, object_num, args.repeat)
+    cm_atomic = rs.object_Cm.to_numpy()[:object_num]
+    A_atomic = rs.object_A.to_numpy()[:object_num]
+
+    t_segmented = time_kernel(rs.calc_all_object_cm_A_rot_kernel, object_num, args.repeat)
+    cm_segmented = rs.object_Cm.to_numpy()[:object_num]
+    A_segmented = rs.object_A.to_numpy()[:object_num]
+
+    sizes = rs.object_size.to_numpy()[:object_num]
+    print('objects: {}, particles: {}, largest object: {} particles'.format(
+        object_num, rs.particle_num[None], sizes.max()))
+    print('atomic    {:10.3f} ms'.format(t_atomic * 1000))
+    print('segmented {:10.3f} ms  ({:.1f}x)'.format(t_segmented * 1000, t_atomic / t_segmented))
+    print('max |cm diff| {:.3e}, max |A diff| / max |A| {:.3e}'.format(
+        np.abs(cm_atomic - cm_segmented).max(),
+        np.abs(A_atomic - A_segmented).max() / np.abs(A_atomic).max()))
@@ -0,0 +1,317 @@
+import argparse
+import hashlib
+import os
+
+import numpy as np
+
+
+# mesh import: OBJ/PLY triangle mesh -> particles for rigid_scene.add_mesh_mock
+# usage: python scripts/mesh_import.py bunny.obj --scale 0.01
+#
+# The mesh is voxelised on a lattice of particle_diameter (ray parity along z),
+# so a particle is wherever a lattice point lies inside (or on) the mesh. Like the
+# boxes of add_box, boundary particles (an empty 6-neighbour) get sdf 0 and the
+# outward normal of their empty neighbours as gradient, interior particles get
+# minus the distance to the nearest boundary particle, found by jump flooding,
+# and the direction towards it. The result is cached as .npz keyed by the mesh
+# bytes, the scale and the particle size, so spawning the same prop again is
+# a file read plus one upload.
+
+
+mesh_cache_version = 1
+mesh_cache_dir = os.environ.get(
+    'TIOUCH_MESH_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'tiouch')
+)
+
+
+# loading---------------------------------------------------------------
+def load_obj(path):
+    vertices, faces = [], []
+    with open(path) as f:
+        for line in f:
+            items = line.split()
+            if not items:
+                continue
+            if items[0] == 'v':
+                vertices.append([float(c) for c in items[1:4]])
+            elif items[0] == 'f':
+                # "f 1 2 3", "f 1/1 2/2 3/3" or "f 1//1 ...", negative indices count from the end
+                ids = [int(item.split('/')[0]) for item in items[1:]]
+                ids = [i - 1 if i > 0 else len(vertices) + i for i in ids]
+                for k in range(1, len(ids) - 1):
+                    faces.append([ids[0], ids[k], ids[k + 1]])
+    return np.array(vertices, dtype=np.float64), np.array(faces, dtype=np.int64)
+
+
+ply_types = {
+    'char': 'i1', 'int8': 'i1', 'uchar': 'u1', 'uint8': 'u1',
+    'short': 'i2', 'int16': 'i2', 'ushort': 'u2', 'uint16': 'u2',
+    'int': 'i4', 'int32': 'i4', 'uint': 'u4', 'uint32': 'u4',
+    'float': 'f4', 'float32': 'f4', 'double': 'f8', 'float64': 'f8',
+}
+
+
+def load_ply(path):
+    # ascii and binary PLY, vertex x/y/z and the vertex_indices face list
+    with open(path, 'rb') as f:
+        if f.readline().strip() != b'ply':
+            raise ValueError('{} is not a PLY file'.format(path))
+        fmt = None
+        elements = []  # [name, count, [(property, type) or (property, (count type, item type))]]
+        while True:
+            line = f.readline()
+            if not line:
+                raise ValueError('{} has no end_header'.format(path))
+            items = line.decode('ascii').split()
+            if not items or items[0] in ('comment', 'obj_info'):
+                continue
+            if items[0] == 'end_header':
+                break
+            if items[0] == 'format':
+                fmt = items[1]
+            elif items[0] == 'element':
+                elements.append([items[1], int(items[2]), []])
+            elif items[0] == 'property':
+                if items[1] == 'list':
+                    elements[-1][2].append((items[4], (ply_types[items[2]], ply_types[items[3]])))
+                else:
+                    elements[-1][2].append((items[2], ply_types[items[1]]))
+
+        vertices, faces = None, []
+        if fmt == 'ascii':
+            tokens = iter(f.read().split())
+            for name, count, properties in elements:
+                rows = []
+                for _ in range(count):
+                    row = {}
+                    for prop, kind in properties:
+                        if isinstance(kind, tuple):
+                            row[prop] = [float(next(tokens)) for _ in range(int(next(tokens)))]
+                        else:
+                            row[prop] = float(next(tokens))
+                    rows.append(row)
+                if name == 'vertex':
+                    vertices = np.array([[r['x'], r['y'], r['z']] for r in rows])
+                elif name == 'face':
+                    prop = properties[0][0]
+                    faces = [[int(i) for i in r[prop]] for r in rows]
+        else:
+            endian = '<' if fmt == 'binary_little_endian' else '>'
+            for name, count, properties in elements:
+                if all(not isinstance(kind, tuple) for _, kind in properties):
+                    dtype = np.dtype([(prop, endian + kind) for prop, kind in properties])
+                    data = np.frombuffer(f.read(dtype.itemsize * count), dtype=dtype)
+                    if name == 'vertex':
+                        vertices = np.stack([data['x'], data['y'], data['z']], axis=1).astype(np.float64)
+                    continue
+                rows = []
+                for _ in range(count):
+                    row = {}
+                    for prop, kind in properties:
+                        if isinstance(kind, tuple):
+                            count_type = np.dtype(endian + kind[0])
+                            item_type = np.dtype(endian + kind[1])
+                            n = int(np.frombuffer(f.read(count_type.itemsize), dtype=count_type)[0])
+                            row[prop] = np.frombuffer(f.read(item_type.itemsize * n), dtype=item_type)
+                        else:
+                            item_type = np.dtype(endian + kind)
+                            row[prop] = np.frombuffer(f.read(item_type.itemsize), dtype=item_type)[0]
+                    rows.append(row)
+                if name == 'face':
+                    prop = [prop for prop, kind in properties if isinstance(kind, tuple)][0]
+                    faces = [[int(i) for i in r[prop]] for r in rows]
+
+    triangles = []
+    for face in faces:
+        for k in range(1, len(face) - 1):
+            triangles.append([face[0], face[k], face[k + 1]])
+    return np.asarray(vertices, dtype=np.float64), np.array(triangles, dtype=np.int64)
+
+
+def load_mesh(path):
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.obj':
+        return load_obj(path)
+    if ext == '.ply':
+        return load_ply(path)
+    raise ValueError('unsupported mesh format {}'.format(ext))
+# loading---------------------------------------------------------------
+
+
+# voxelisation----------------------------------------------------------
+def voxelize(vertices, faces, spacing, tolerance=1e-3):
+    # lattice centered on the mesh bounds; returns (origin, inside[nx, ny, nz]).
+    # Points within tolerance * spacing of the surface count as inside, so a
+    # box gives the same lattice as add_box, faces included.
+    lower, upper = vertices.min(axis=0), vertices.max(axis=0)
+    dims = np.floor((upper - lower) / spacing + tolerance).astype(np.int64) + 1
+    origin = (lower + upper) / 2 - (dims - 1) / 2 * spacing
+
+    inside = np.zeros(tuple(dims), dtype=bool)
+    for ray_offset in spacing * tolerance * np.array([[1, 1], [-1, 1], [1, -1], [-1, -1]]):
+        for z_offset in spacing * tolerance * np.array([1, -1]):
+            inside |= ray_parity(vertices, faces, spacing, origin, dims, ray_offset, z_offset)
+    return origin, inside
+
+
+def ray_parity(vertices, faces, spacing, origin, dims, ray_offset, z_offset):
+    # inside test of the lattice shifted by (ray_offset, z_offset): count the
+    # crossings of a +z ray per column, slightly off the lattice so rays do
+    # not run through mesh vertices and edges
+    ray_offset = ray_offset * np.array([1.0, 1.37])
+    crossings = np.zeros((dims[0], dims[1], dims[2] + 1), dtype=np.int32)
+    for tri in vertices[faces]:
+        a, b, c = tri
+        area = (b[0] - a[0]) * (c[1] - a[1]) - (c[0] - a[0]) * (b[1] - a[1])
+        if area == 0.0:
+            continue
+        lo = np.ceil((tri[:, :2].min(axis=0) - origin[:2] - ray_offset) / spacing).astype(np.int64)
+        hi = np.floor((tri[:, :2].max(axis=0) - origin[:2] - ray_offset) / spacing).astype(np.int64)
+        lo = np.maximum(lo, 0)
+        hi = np.minimum(hi, dims[:2] - 1)
+        if np.any(hi < lo):
+            continue
+        ii, jj = np.meshgrid(np.arange(lo[0], hi[0] + 1), np.arange(lo[1], hi[1] + 1), indexing='ij')
+        px = origin[0] + ii * spacing + ray_offset[0]
+        py = origin[1] + jj * spacing + ray_offset[1]
+        # barycentric coordinates in the xy projection
+        w1 = ((b[0] - px) * (c[1] - py) - (c[0] - px) * (b[1] - py)) / area
+        w2 = ((c[0] - px) * (a[1] - py) - (a[0] - px) * (c[1] - py)) / area
+        w3 = 1.0 - w1 - w2
+        hit = (w1 >= 0) & (w2 >= 0) & (w3 >= 0)
+        if not hit.any():
+            continue
+        z = w1[hit] * a[2] + w2[hit] * b[2] + w3[hit] * c[2]
+        # bin = index of the first lattice point at or above the crossing
+        k = np.clip(np.ceil((z - origin[2] - z_offset) / spacing).astype(np.int64), 0, dims[2])
+        np.add.at(crossings, (ii[hit], jj[hit], k), 1)
+
+    # a lattice point is inside when an odd number of crossings lies above it
+    above = np.cumsum(crossings[:, :, ::-1], axis=2)[:, :, ::-1]
+    return above[:, :, 1:] % 2 == 1
+
+
+def boundary_normals(inside):
+    # boundary = inside with an empty 6-neighbour, normal = sum of the empty directions
+    padded = np.pad(inside, 1)
+    normal = np.zeros(inside.shape + (3,))
+    for d in range(3):
+        for sign in (-1, 1):
+            neighbour = np.roll(padded, -sign, axis=d)[1:-1, 1:-1, 1:-1]
+            normal[..., d] += sign * (inside & ~neighbour)
+    boundary = inside & np.any(normal != 0, axis=-1)
+    return boundary, normal
+
+
+def jump_flood(seeds):
+    # nearest seed index (nx, ny, nz, 3) of every lattice point, -1 where none
+    dims = np.array(seeds.shape)
+    nearest = np.full(tuple(dims) + (3,), -1, dtype=np.int64)
+    nearest[seeds] = np.argwhere(seeds)
+    grid = np.stack(np.meshgrid(*[np.arange(n) for n in dims], indexing='ij'), axis=-1)
+
+    def distance(candidate):
+        dist = np.sum((candidate - grid) ** 2, axis=-1).astype(np.float64)
+        dist[candidate[..., 0] < 0] = np.inf
+        return dist
+
+    step = 1 << int(np.ceil(np.log2(max(dims.max(), 2)))) - 1
+    while step >= 1:
+        best = distance(nearest)
+        for offset in np.ndindex(3, 3, 3):
+            offset = (np.array(offset) - 1) * step
+            if not offset.any():
+                continue
+            # candidate = nearest seed of the lattice point at grid + offset
+            candidate = np.full_like(nearest, -1)
+            src = tuple(slice(max(o, 0), n + min(o, 0)) for o, n in zip(offset, dims))
+            dst = tuple(slice(max(-o, 0), n + min(-o, 0)) for o, n in zip(offset, dims))
+            candidate[dst] = nearest[src]
+            dist = distance(candidate)
+            closer = dist < best
+            nearest[closer] = candidate[closer]
+            best[closer] = dist[closer]
+        step //= 2
+    return nearest
+
+
+def voxelize_particles(vertices, faces, spacing):
+    # (n, 7) float32 rows: position relative to the mesh frame, sdf, sdf gradient
+    origin, inside = voxelize(vertices, faces, spacing)
+    boundary, normal = boundary_normals(inside)
+    nearest = jump_flood(boundary)
+
+    ids = np.argwhere(inside)
+    pos = origin + ids * spacing
+    to_boundary = (nearest[inside] - ids) * spacing
+    sdf = -np.linalg.norm(to_boundary, axis=-1)
+    grad = to_boundary / np.maximum(-sdf, 1e-12)[:, None]
+    on_boundary = boundary[inside]
+    sdf[on_boundary] = 0.0
+    boundary_normal = normal[inside][on_boundary]
+    grad[on_boundary] = boundary_normal / np.linalg.norm(boundary_normal, axis=-1, keepdims=True)
+    return np.concatenate([pos, sdf[:, None], grad], axis=1).astype(np.float32)
+# voxelisation----------------------------------------------------------
+
+
+# cache-----------------------------------------------------------------
+def mesh_key(path, scale, spacing):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        h.update(f.read())
+    h.update('{}:{!r}:{!r}'.format(mesh_cache_version, float(scale), float(spacing)).encode())
+    return h.hexdigest()
+
+
+def mesh_particles(path, spacing, scale=1.0, cache_dir=None):
+    # cached voxelize_particles of the mesh at path, scaled by scale
+    cache_dir = cache_dir or mesh_cache_dir
+    cache_path = os.path.join(cache_dir, mesh_key(path, scale, spacing) + '.npz')
+    if os.path.exists(cache_path):
+        with np.load(cache_path) as cached:
+            if int(cached['version']) == mesh_cache_version:
+                return cached['particles']
+
+    vertices, faces = load_mesh(path)
+    particles = voxelize_particles(vertices * scale, faces, spacing)
+    os.makedirs(cache_dir, exist_ok=True)
+    # write then rename, concurrent imports of the same mesh never see half a file
+    tmp_path = '{}.{}.tmp.npz'.format(cache_path[:-4], os.getpid())
+    np.savez(tmp_path, version=mesh_cache_version, particles=particles)
+    os.replace(tmp_path, cache_path)
+    return particles
+# cache-----------------------------------------------------------------
+
+
+def add_mesh(rs, path, object_id, center, rotation=(0.0, 0.0, 0.0, 1.0), state=None,
+    scale=1.0, friction=(1.0, 1.0), restitution=1.0, velocity=(0.0, 0.0, 0.0)):
+    # mesh as one rigid object of rigid_scene rs, returns the next object id
+    if state is None:
+        state = rs.STATE_DYNAMIC
+    particles = mesh_particles(path, rs.particle_diameter, scale)
+    desc = rs.box_desc(
+        center, (0.0, 0.0, 0.0), rotation=rotation, state=state,
+        friction=friction, restitution=restitution, velocity=velocity
+    )
+    return rs.add_mesh_mock(particles, desc, object_id)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('mesh', help='.obj or .ply')
+    parser.add_argument('--scale', type=float, default=1.0)
+    parser.add_argument('--spacing', type=float, default=None,
+        help='particle diameter, rigid_scene.particle_diameter when omitted')
+    parser.add_argument('--cache-dir', default=None)
+    args = parser.parse_args()
+
+    spacing = args.spacing
+    if spacing is None:
+        import rigid_scene as rs
+        spacing = rs.particle_diameter
+    particles = mesh_particles(args.mesh, spacing, args.scale, args.cache_dir)
+    boundary = np.count_nonzero(particles[:, 3] == 0.0)
+    print('{}: {} particles, {} on the boundary, deepest sdf {:.4f}'.format(
+        args.mesh, len(particles), boundary, particles[:, 3].min()))
+    print('cache: {}'.format(os.path.join(
+        args.cache_dir or mesh_cache_dir, mesh_key(args.mesh, args.scale, spacing) + '.npz')))
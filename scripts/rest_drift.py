@@ -0,0 +1,99 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+import numpy as np
+
+import benchmark
+
+
+# drift of the compact rest storage against f32: the same scene runs once per
+# rest storage mode, each in its own process, and the object poses are compared
+# usage: python scripts/rest_drift.py --scene pyramid --size 3 --frames 1000
+# exits with 1 when a pose differs by more than the tolerances. Use a scene that
+# settles: a box balanced on another ends half a lattice spacing to one side or
+# the other, and 1e-7 in the f32 rest offsets already picks a different side.
+
+
+def run_child(args):
+    import taichi as ti
+    import rigid_scene as rs
+
+    rs.init_taichi(arch=getattr(ti, args.arch), rest=args.rest)
+    rs.init_mock()
+    rng = np.random.default_rng(args.seed)
+    descs = np.asarray(benchmark.scenes[args.scene](rs, rng, args.size))
+    object_num = rs.add_boxes_mock(descs, 0)
+    rs.bake_static_sdf_mock()
+
+    poses = []
+    for frame in range(args.frames):
+        rs.update_mock(object_num=object_num, dt=1.0 / 60.0, corr_rate=1.0, damp=0.98,
+            iterations=args.iterations)
+        if frame % args.every == args.every - 1:
+            rs.copy_to_nd_mock(object_num)
+            poses.append({
+                'cm': rs.object_cm_to_host.to_numpy()[:object_num].tolist(),
+                'rot': rs.object_rot_to_host.to_numpy()[:object_num].tolist(),
+            })
+    print(json.dumps({'rest': rs.rest_storage, 'poses': poses}))
+
+
+def rotation_angle(a, b):
+    # about the angle between a and b per object, a and b are (n, 3, 3); the
+    # arccos of the trace loses small angles in f32 matrices
+    return np.linalg.norm(a - b, axis=(1, 2)) / np.sqrt(2.0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--arch', default='cpu')
+    parser.add_argument('--scene', default='pyramid', choices=list(benchmark.scenes))
+    parser.add_argument('--size', type=int, default=3)
+    parser.add_argument('--frames', type=int, default=1000)
+    parser.add_argument('--every', type=int, default=10, help='compare the poses every n frames')
+    parser.add_argument('--iterations', type=int, default=30)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--position-tolerance', type=float, default=0.01)
+    parser.add_argument('--rotation-tolerance', type=float, default=0.01, help='radians')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--rest', default='f32', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args)
+        sys.exit(0)
+
+    runs = {}
+    for rest in ('f32', 'compact'):
+        child_args = [a for a in sys.argv[1:] if a != '--child']
+        proc = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--child', '--rest', rest] + child_args,
+            capture_output=True, text=True
+        )
+        if proc.returncode != 0:
+            print('{}: failed\n{}'.format(rest, proc.stderr), file=sys.stderr)
+            sys.exit(2)
+        runs[rest] = json.loads(proc.stdout.strip().splitlines()[-1])['poses']
+
+    position_drift = []
+    rotation_drift = []
+    for a, b in zip(runs['f32'], runs['compact']):
+        position_drift.append(float(np.linalg.norm(np.subtract(a['cm'], b['cm']), axis=1).max()))
+        rotation_drift.append(float(rotation_angle(np.array(a['rot']), np.array(b['rot'])).max()))
+    report = {
+        'scene': args.scene,
+        'size': args.size,
+        'frames': args.frames,
+        'max_position_drift': max(position_drift),
+        'max_rotation_drift': max(rotation_drift),
+        'final_position_drift': position_drift[-1],
+        'final_rotation_drift': rotation_drift[-1],
+    }
+    print(json.dumps(report, indent=2))
+    if (report['max_position_drift'] > args.position_tolerance
+            or report['max_rotation_drift'] > args.rotation_tolerance):
+        print('drift above tolerance', file=sys.stderr)
+        sys.exit(1)
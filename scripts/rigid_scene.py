@@ -1,10 +1,13 @@
 import taichi as ti
+import numpy as np
 import random
 import math
+import os
+import time
+import json
+from collections import defaultdict, deque
 
 
-ti.init(arch=ti.vulkan)
-
 # aux-------------------------------------------------------------
 vec2 = ti.types.vector(2, ti.f32)
 vec3 = ti.types.vector(3, ti.f32)
@@ -13,6 +16,7 @@ mat33 = ti.types.matrix(3, 3, ti.f32)
 STATE_STATIC = 0
 STATE_KINIMATIC = 1
 STATE_DYNAMIC = 2
+STATE_REMOVED = 3  # slot freed by remove_object, owns no particles after compact
 
 mat33_identity = mat33([[1.0, 0.0, 0.0], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0]])
 rad = math.pi / 6
@@ -25,45 +29,686 @@ eps = 1e-6
 # aux-------------------------------------------------------------
 
 
+# init------------------------------------------------------------
+# Importing the module does not touch the taichi runtime. init_taichi picks
+# the backend, fixes the capacities and allocates every field; it runs
+# with the defaults below on the first graph run unless called before.
+# Graphs are compiled on first use (get_graph) and kernels go through
+# taichi's offline cache, so a process only pays for what it runs.
+# The defaults come from the environment, e.g.
+# TIOUCH_ARCH=cpu TIOUCH_MAX_PARTICLES=100000 TIOUCH_MAX_OBJECTS=2000 TIOUCH_PROFILE=1
+# TIOUCH_ROTATION=quaternion TIOUCH_MAX_SCENES=1000
+# TIOUCH_BODY_MODEL=rigid TIOUCH_CONTACT_SOLVER=colored TIOUCH_REORDER_INTERVAL=120
+# TIOUCH_REST_STORAGE=compact TIOUCH_CONTACT_OUTPUT=1 TIOUCH_MAX_OBJECT_PAIRS=8000
+# TIOUCH_STATIC_SDF_NODES=262144
+max_particle_num = int(os.environ.get('TIOUCH_MAX_PARTICLES', 20000))
+max_object_num = int(os.environ.get('TIOUCH_MAX_OBJECTS', 500))
+max_object_pair_num = int(os.environ.get('TIOUCH_MAX_OBJECT_PAIRS', 0))  # 0: 16 per object
+profiling = os.environ.get('TIOUCH_PROFILE', '0') == '1'
+initialized = False
+
+
+def init_taichi(arch=None, max_particles=None, max_objects=None, offline_cache=True,
+    offline_cache_path=None, profile=None, rotation=None, max_scenes=None,
+    body_model=None, contact_solver=None, sor=None, reorder=None, rest=None, contact_output=None,
+    max_object_pairs=None, static_sdf_nodes=None):
+    global max_particle_num, max_object_num, max_object_pair_num, profiling, rotation_extraction, initialized
+    global max_scene_num, solver_body_model, contact_schedule, contact_sor
+    global reorder_interval, rest_storage, contact_output_enabled, static_sdf_max_nodes
+    if initialized:
+        raise RuntimeError('init_taichi has already been called in this process')
+    if arch is None:
+        arch = getattr(ti, os.environ.get('TIOUCH_ARCH', 'vulkan'))
+    if max_particles is not None:
+        max_particle_num = max_particles
+    if max_objects is not None:
+        max_object_num = max_objects
+    if max_object_pairs is not None:
+        max_object_pair_num = max_object_pairs
+    if max_object_pair_num <= 0:
+        max_object_pair_num = 16 * max_object_num
+    if profile is not None:
+        profiling = profile
+    if rotation is not None:
+        rotation_extraction = rotation
+    if max_scenes is not None:
+        max_scene_num = max_scenes
+    if body_model is not None:
+        solver_body_model = body_model
+    if contact_solver is not None:
+        contact_schedule = contact_solver
+    if sor is not None:
+        contact_sor = sor
+    if reorder is not None:
+        reorder_interval = reorder
+    if rest is not None:
+        rest_storage = rest
+    if contact_output is not None:
+        contact_output_enabled = contact_output
+    if static_sdf_nodes is not None:
+        static_sdf_max_nodes = static_sdf_nodes
+    if rotation_extraction not in ('polar', 'quaternion'):
+        raise ValueError('unknown rotation extraction {}'.format(rotation_extraction))
+    if solver_body_model not in ('shape_matching', 'rigid'):
+        raise ValueError('unknown body model {}'.format(solver_body_model))
+    if contact_schedule not in ('jacobi', 'jacobi_sor', 'colored'):
+        raise ValueError('unknown contact solver {}'.format(contact_schedule))
+    if rest_storage not in ('f32', 'compact'):
+        raise ValueError('unknown rest storage {}'.format(rest_storage))
+    cache_args = {}
+    if offline_cache_path is not None:
+        cache_args['offline_cache_file_path'] = offline_cache_path
+    ti.init(arch=arch, offline_cache=offline_cache, kernel_profiler=profiling, **cache_args)
+    allocate_fields()
+    initialized = True
+
+
+def ensure_init():
+    if not initialized:
+        init_taichi()
+# init------------------------------------------------------------
+
+
 # global variable-------------------------------------------------
 object_num = 0
-particle_num = ti.field(ti.i32, shape=())
-max_particle_num = 20000
-max_object_num = 500
 particle_radius = 0.05
 particle_diameter = particle_radius * 2.0
-particle_object_id = ti.field(ti.i32, max_particle_num)
-
-x = ti.Vector.field(3, ti.f32, max_particle_num)
-delta_x = ti.Vector.field(3, ti.f32, max_particle_num)
-x_old = ti.Vector.field(3, ti.f32, max_particle_num)
-x0 = ti.Vector.field(3, ti.f32, max_particle_num)
-v = ti.Vector.field(3, ti.f32, max_particle_num)
-
-# inv_m = ti.field(ti.f32, max_particle_num)
-particle_sdf = ti.field(ti.f32, max_particle_num)
-particle_sdf_grad = ti.Vector.field(3, ti.f32, max_particle_num)
-object_rest_Cm = ti.Vector.field(3, ti.f32, max_object_num)
-object_Cm = ti.Vector.field(3, ti.f32, max_object_num)
-object_rot = ti.Matrix.field(3, 3, ti.f32, max_object_num)
-object_rest_rot = ti.Matrix.field(3, 3, ti.f32, max_object_num)
-object_A = ti.Matrix.field(3, 3, ti.f32, max_object_num)
-object_state = ti.field(ti.i32, max_object_num)
-object_friction_factor = ti.Vector.field(
-    2, ti.f32, max_object_num
-)  # [mu_s, mu_k]
-object_restitution = ti.field(ti.f32, max_object_num)
-object_begin = ti.field(ti.i32, max_object_num)
-object_size = ti.field(ti.i32, max_object_num)
-object_mass = ti.field(ti.f32, max_object_num)
 # global variable-------------------------------------------------
 
+# add_boxes descriptors-------------------------------------------
+# One row of box_desc_size floats per box: center(3), half extent(3),
+# rotation quaternion xyzw(4), state, friction [mu_s, mu_k](2),
+# restitution, initial velocity(3), scene
+BOX_DESC_CENTER = 0
+BOX_DESC_HALF_EXTENT = 3
+BOX_DESC_ROTATION = 6
+BOX_DESC_STATE = 10
+BOX_DESC_FRICTION = 11
+BOX_DESC_RESTITUTION = 13
+BOX_DESC_VELOCITY = 14
+BOX_DESC_SCENE = 17
+box_desc_size = 18
+# add_boxes descriptors-------------------------------------------
+
+# add_mesh particles----------------------------------------------
+# A mesh object arrives as precomputed particles (mesh_import.py), one row
+# of mesh_particle_size floats each: position in the mesh frame(3), sdf,
+# sdf gradient(3). Its pose, state and material come in a box descriptor
+# whose half extent is ignored.
+MESH_PARTICLE_POS = 0
+MESH_PARTICLE_SDF = 3
+MESH_PARTICLE_SDF_GRAD = 4
+mesh_particle_size = 7
+# add_mesh particles----------------------------------------------
+
+# kinematic objects-----------------------------------------------
+# STATE_KINIMATIC objects follow poses from the host: one row of
+# kinematic_pose_size floats per object id, position of the rest Cm(3)
+# and rotation relative to the rest pose as a quaternion xyzw(4), like
+# object_Cm / object_rot. The whole table goes up once per update; rows
+# of other objects, and rows with a zero quaternion, are ignored. Their
+# particles are placed at x = R (x0 - rest_Cm) + t before the solver,
+# skip integration and shape matching and push dynamic particles as fixed
+# obstacles. Their v is the velocity derived from the pose change; the
+# contact friction works on positions, which already carry that motion,
+# so a box on a moving kinematic platform is dragged along.
+KINEMATIC_POSE_POSITION = 0
+KINEMATIC_POSE_ROTATION = 3
+kinematic_pose_size = 7
+# kinematic objects-----------------------------------------------
+
+# object removal--------------------------------------------------
+# remove_object only marks a slot as STATE_REMOVED, compact then moves the
+# remaining particle ranges together (gather through particle_perm) and
+# rebuilds the per-object chunk and shell tables. An add that does not fit
+# in max_particle_num adds no particles, an add_boxes batch as a whole: its
+# slots are stored as removed, empty objects and set capacity_overflow, and
+# the mock puts them on free_object_ids and raises RuntimeError. Object ids
+# are checked against max_object_num on the host before the dispatch, an
+# add past it raises RuntimeError and changes nothing.
+# object removal--------------------------------------------------
+
+# spatial reorder-------------------------------------------------
+# Every reorder_interval updates (0 never) update_mock runs the reorder
+# graph: the particles of every object range are sorted by the morton code
+# of their grid cell relative to the object Cm, so particles close in space
+# are close in x, v, x0, the sdf data and the grid cells. The keys
+# (object_begin, morton code, index) go through one bitonic network over the
+# next power of two of max_particle_num, one dispatch per step; the sorted
+# indices become particle_perm and the fields are gathered like compact
+# does, the object ranges do not move.
+reorder_interval = int(os.environ.get('TIOUCH_REORDER_INTERVAL', 0))
+morton_bits = 10  # per axis, cells further than 512 from the Cm are clamped
+# spatial reorder-------------------------------------------------
+
+# rest storage----------------------------------------------------
+# The rest state of a particle never changes after it is added. With
+# rest_storage 'f32' it is kept in x0, particle_sdf, particle_sdf_grad and
+# particle_rest_q, 40 bytes a particle. 'compact' packs it into the three
+# i32 of particle_rest, 12 bytes, as signed 16 bit halves:
+#   [0] rest offset x | y << 16
+#   [1] rest offset z | sdf << 16
+#   [2] sdf gradient, octahedral u | v << 16
+# The rest offset (x0 - object_rest_Cm) is quantised with a step per
+# object, object_rest_quantum, a power of two fraction of particle_diameter
+# small enough that object_rest_extent fits, set by set_rest_quantum once
+# the extent is known; the sdf with rest_sdf_step, deeper
+# values are clamped. x0 is not stored, it is object_rest_Cm + offset.
+# Kernels read the rest state through rest_q, rest_position, rest_sdf and
+# rest_sdf_grad only.
+rest_storage = os.environ.get('TIOUCH_REST_STORAGE', 'f32')
+rest_i16_max = 32767
+rest_sdf_step = particle_diameter / 1024  # sdf down to -3.2
+# rest storage----------------------------------------------------
+
+# scenes----------------------------------------------------------
+# Up to max_scene_num independent scenes share the particle and object
+# storage, every object carries the scene it was added to (BOX_DESC_SCENE)
+# and one update steps all of them. Objects of different scenes never
+# form a pair and hash into different grid cells, so scenes may overlap
+# in space. The corr_rate, damp and boundary_box arguments of update are
+# the defaults; set_scenes overrides them per scene with rows of
+# scene_desc_size floats: boundary lower(3), boundary upper(3), corr_rate,
+# damp. Every scene bakes its own static sdf volume, the solver runs until
+# the slowest scene converges and haptic queries address one scene each.
+max_scene_num = int(os.environ.get('TIOUCH_MAX_SCENES', 1))
+SCENE_DESC_BOUNDARY_LOWER = 0
+SCENE_DESC_BOUNDARY_UPPER = 3
+SCENE_DESC_CORR_RATE = 6
+SCENE_DESC_DAMP = 7
+scene_desc_size = 8
+# scenes----------------------------------------------------------
+
+# object broad phase----------------------------------------------
+# Per-object AABBs from object_Cm/object_rot and the rest extents,
+# overlapping pairs found by sweep and prune along x within each scene.
+# The objects are sorted by (scene, aabb_min.x) once per frame, with the
+# bitonic network of the spatial reorder; every solver iteration sweeps
+# that order and widens its early exit by how far any aabb_min.x fell
+# since (object_sap_slack), so the pairs match a fresh sort. Only shell
+# particles of objects with an overlapping partner enter the grid and
+# the pair loop. Each pair is one row of object_pair, (a, b) with a < b.
+# The pair loop looks pairs up in object_pair_table, an open addressing
+# table of the keys a * max_object_num + b, rebuilt with the pairs in
+# every iteration over the first power of two above twice their number.
+# Both grow with max_object_pair_num, not with the square of
+# max_object_num. max_object_pair_num (TIOUCH_MAX_OBJECT_PAIRS, 16 per
+# object by default) bounds the pairs of an iteration; the ones past it
+# are dropped and set object_pair_overflow, and update_mock raises a
+# RuntimeError after the frame.
+# object broad phase----------------------------------------------
+
+# sleeping--------------------------------------------------------
+# A dynamic object whose particles stay slower than sleep_speed and whose
+# rotation changes less than sleep_rotation for sleep_frame_num frames
+# goes to sleep. Per-particle kernels only launch over active_particle,
+# the awake dynamic particles, rebuilt at the start of every update.
+sleep_speed = 0.1
+sleep_rotation = 1e-3
+sleep_frame_num = 30
+# sleeping--------------------------------------------------------
+
+# shell particles-------------------------------------------------
+# Only the boundary particles (particle_sdf == 0) and the first interior
+# layer below them take part in contacts. The interior layer is what
+# stops a box once two boundary lattices slide half a spacing apart and
+# no boundary pair is within particle_radius; deeper particles are only
+# used for shape matching. Each object's shell is listed contiguously.
+shell_depth = particle_diameter
+# shell particles-------------------------------------------------
+
+# segmented reduction---------------------------------------------
+# Each object's contiguous particle range is cut into chunks of
+# reduce_chunk_size. Chunks are summed in parallel, then every object
+# adds up its own chunks, so no two threads ever write the same slot.
+reduce_chunk_size = 64
+# segmented reduction---------------------------------------------
+
+# solver iterations-----------------------------------------------
+# The update graph unrolls max_iter iterations. Each one first checks
+# the requested iteration count and the residual (largest particle
+# displacement of the previous iteration) on the device; once either
+# says stop, the remaining dispatches launch over empty ranges.
+max_iter = 30
+# solver iterations-----------------------------------------------
+
+# body model------------------------------------------------------
+# 'shape_matching' (the default) integrates every particle on its own and
+# pulls it back onto its object by shape matching in every iteration.
+# 'rigid' keeps the state per object, object_Cm / object_rot_q with
+# object_v / object_omega, and uses the mass and rest inertia of the add
+# kernels. Integration moves the poses; only the shell particles of active
+# objects are placed from their pose (active_particle lists just those) to
+# find contacts, and the contact and boundary corrections they get become
+# impulses on their object (project_particles). The end of update places
+# every particle of an active object once, so x and v stay valid for
+# rendering, snapshots and haptic queries. corr_rate has no effect in this
+# model.
+solver_body_model = os.environ.get('TIOUCH_BODY_MODEL', 'shape_matching')
+# body model------------------------------------------------------
+
+# contact solver--------------------------------------------------
+# How solve_constraints schedules the particle contacts of one iteration.
+# 'jacobi' (the default): every contact particle sums the pushes of all its
+# neighbours into delta_x, applied together at the end.
+# 'jacobi_sor': the same, but delta_x is averaged over the particle's
+# contacts and scaled by contact_sor (successive over-relaxation).
+# 'colored': parallel Gauss-Seidel. Grid cells get one of 8 colours from
+# the parity of their coordinates, so two cells of one colour are never
+# neighbours. The colours run one after the other; within a colour every
+# occupied hash slot is walked by one thread, which moves its particles
+# in place, and later colours see the moved positions.
+# solve_constraints_all_pairs stays Jacobi.
+contact_schedule = os.environ.get('TIOUCH_CONTACT_SOLVER', 'jacobi')
+contact_sor = float(os.environ.get('TIOUCH_CONTACT_SOR', 1.5))
+# contact solver--------------------------------------------------
+
+# rotation extraction---------------------------------------------
+# 'polar': ti.polar_decompose of object_A in every solver iteration, with
+# a snap to identity when A degenerates.
+# 'quaternion': Mueller et al. 2016, "A Robust Method to Extract the
+# Rotational Part of Deformations". rotation_extraction_steps fixed-point
+# steps per call, warm-started from object_rot_q of the previous iteration
+# (or frame); a degenerate A leaves the rotation where it was.
+rotation_extraction = os.environ.get('TIOUCH_ROTATION', 'polar')
+rotation_extraction_steps = 3
+# rotation extraction---------------------------------------------
+
+# spatial hash grid-----------------------------------------------
+# Uniform grid hashed into a fixed table, rebuilt by counting sort before
+# every solver iteration. One cell of particle_diameter plus its 26
+# neighbours finds every pair closer than particle_diameter: all boundary
+# contacts (particle_radius) and boundary / interior layer ones. Two
+# interior layer particles touch within |sdf_i| + |sdf_j|, up to
+# 2 * shell_depth, and are skipped until they are closer than a cell, so
+# here the grid resolves fewer pairs than solve_constraints_all_pairs.
+# That is only while the boundary particles above them already overlap,
+# and these contacts push them apart. A cell of 2 * shell_depth resolves
+# them too but makes the pyramid benchmark ~50% slower for no less drift.
+use_grid_broad_phase = True
+grid_cell_size = particle_diameter
+grid_block_size = 256
+# spatial hash grid-----------------------------------------------
+
+# haptic query----------------------------------------------------
+# The end of update rebuilds the hash grid over the shell particles of
+# every object. haptic_query runs between updates (~1 kHz) against that
+# grid: a sphere/capsule tool gets a penalty force, the reaction impulse
+# is accumulated per object and applied at the start of the next update.
+haptic_tool_size = 8  # segment p0(3), p1(3), radius, scene; p0 == p1 is a sphere
+# haptic query----------------------------------------------------
+
+# static sdf volume-----------------------------------------------
+# bake_static_sdf samples the STATE_STATIC particles of every scene into a
+# node grid around them: phi(node) = min_j |node - x_j| + sdf_j,
+# splatted within static_sdf_band of every static particle of the scene,
+# plus its central difference gradient. The scene grids share the
+# static_sdf_max_nodes nodes (TIOUCH_STATIC_SDF_NODES, 16 bytes each,
+# 16 MB by default) in proportion to their extent, each from its
+# static_sdf_offset; a scene whose share is below 2x2x2 nodes gets no grid
+# (static_sdf_dims 0). While the volumes are valid (static_sdf_ready) the
+# static objects of a scene with a grid leave the pair loop and
+# collision_response pushes the active particles of the scene out of it
+# with a trilinear lookup. Adding or removing a static object invalidates
+# the volumes until the next bake.
+static_sdf_max_nodes = int(os.environ.get('TIOUCH_STATIC_SDF_NODES', 1 << 20))  # 0 bakes no volume
+static_sdf_min_cell = particle_radius
+static_sdf_band = 3.0 * particle_diameter
+# static sdf volume-----------------------------------------------
+
+# transform readback----------------------------------------------
+# copy_transforms writes one frame into the next of readback_ring_size
+# output slots, so the host reads the slot of frame k-1 while frame k is
+# still running. The compact format is one row of transform_size floats,
+# position(3) and rotation quaternion xyzw(4), only for objects that moved
+# more than a threshold since they were last written, plus
+# transform_ids = [count, object ids...]. The full format is the
+# object_cm / object_rot pair of copy_to_nd for every object.
+readback_ring_size = int(os.environ.get('TIOUCH_READBACK_RING', 3))
+transform_size = 7
+# transform readback----------------------------------------------
+
+# contact output--------------------------------------------------
+# With contact_output_enabled every update adds up, per object, what the
+# contacts did to its particles over all solver iterations: the particle
+# contact corrections (delta_x, after the sor scaling) and the static
+# surface corrections of collision_response, and r x correction about
+# object_Cm. With unit particle mass and the step h of the update, the sum
+# is an impulse sum / h and an average force sum / h^2. copy_to_nd and
+# copy_transforms then also write one row of contact_output_size floats
+# per object into object_contacts:
+#   impulse(3), force(3), torque about object_Cm(3), particle contacts
+# the contacts being those of the last solver iteration. Objects that are
+# not solved (kinematic, static or asleep, e.g. a haptic tool or the
+# ground) get the reaction of the particle contacts they take part in,
+# before the 'jacobi_sor' scaling; the static sdf volume and the boundary
+# box are not objects. In the rigid body model these are the corrections
+# of the shell particles, before project_particles averages them. Off (the
+# default) compiles the accumulation out and leaves the readback graphs as
+# they are.
+contact_output_enabled = os.environ.get('TIOUCH_CONTACT_OUTPUT', '0') == '1'
+contact_output_size = 10
+# contact output--------------------------------------------------
+
+# snapshots-------------------------------------------------------
+# save_snapshot writes the persistent state into one row of
+# snapshot_particle_size floats per particle and one row of
+# snapshot_object_size floats per object (ints stored as floats, like the
+# box descriptors, matrices row-major), plus one row of snapshot_scene_size
+# floats per scene: its set_scenes row and whether set_scenes gave one.
+# load_snapshot writes it back, scenes past the rows lose their override, and
+# rebuilds what is derived from it: the rest offsets, the chunk and shell
+# tables and the query grid. The static sdf volume stays valid when the
+# static particles did not change. File layout and ring: snapshot.py.
+SNAPSHOT_PARTICLE_X = 0
+SNAPSHOT_PARTICLE_X_OLD = 3
+SNAPSHOT_PARTICLE_V = 6
+SNAPSHOT_PARTICLE_X0 = 9
+SNAPSHOT_PARTICLE_SDF = 12
+SNAPSHOT_PARTICLE_SDF_GRAD = 13
+SNAPSHOT_PARTICLE_OBJECT = 16
+snapshot_particle_size = 17
+SNAPSHOT_OBJECT_REST_CM = 0
+SNAPSHOT_OBJECT_CM = 3
+SNAPSHOT_OBJECT_ROT = 6
+SNAPSHOT_OBJECT_REST_ROT = 15
+SNAPSHOT_OBJECT_PREV_ROT = 24
+SNAPSHOT_OBJECT_ROT_Q = 33
+SNAPSHOT_OBJECT_REST_EXTENT = 37
+SNAPSHOT_OBJECT_REST_INERTIA = 40
+SNAPSHOT_OBJECT_FRICTION = 49
+SNAPSHOT_OBJECT_RESTITUTION = 51
+SNAPSHOT_OBJECT_MASS = 52
+SNAPSHOT_OBJECT_BEGIN = 53
+SNAPSHOT_OBJECT_SIZE = 54
+SNAPSHOT_OBJECT_STATE = 55
+SNAPSHOT_OBJECT_SLEEP = 56
+SNAPSHOT_OBJECT_SLEEP_COUNTER = 57
+SNAPSHOT_OBJECT_WAKE = 58
+SNAPSHOT_OBJECT_SCENE = 59
+SNAPSHOT_OBJECT_SWEEP = 60
+SNAPSHOT_OBJECT_HAPTIC_IMPULSE = 61
+SNAPSHOT_OBJECT_HAPTIC_ANGULAR_IMPULSE = 64
+SNAPSHOT_OBJECT_V = 67
+SNAPSHOT_OBJECT_OMEGA = 70
+snapshot_object_size = 73
+SNAPSHOT_SCENE_DESC = 0  # scene_desc_size floats, as passed to set_scenes
+SNAPSHOT_SCENE_OVERRIDE = scene_desc_size
+snapshot_scene_size = scene_desc_size + 1
+# snapshots-------------------------------------------------------
+
 # mock unity------------------------------------------------------
-boundary_box = ti.Vector.ndarray(3, ti.f32, 2)
-object_cm_to_host = ti.Vector.ndarray(3, ti.f32, max_object_num)
-object_rot_to_host = ti.Matrix.ndarray(3, 3, ti.f32, max_object_num)
+boundary_box_np = np.ndarray((2, 3))
+boundary_box_np[0] = np.array([-1.0, 0.0, -1.0]) * 1000
+boundary_box_np[1] = np.array([1.0, 1.0, 1.0]) * 1000
 # mock unity------------------------------------------------------
 
+
+# fields----------------------------------------------------------
+def allocate_fields():
+    # sizes derived from the capacities and every field / ndarray, one
+    # block per section above
+    global particle_num, particle_object_id, x, delta_x, x_old, x0, v, particle_rest, object_rest_quantum
+    global particle_sdf, particle_sdf_grad, object_rest_Cm, object_Cm, object_rot
+    global object_rest_rot, object_A, object_state, object_sleep, object_sleep_counter
+    global object_wake, object_prev_rot, object_friction_factor, object_restitution
+    global object_begin, object_size, object_mass
+    global batch_box_begin, batch_box_size
+    global capacity_overflow, particle_perm, compact_object_begin, compact_old_particle_num
+    global permute_i32, permute_f32, permute_vec3
+    global reorder_sort_size, reorder_step_num, reorder_key, reorder_index, reorder_size, reorder_stage
+    global object_rest_extent, object_sweep, object_aabb_min
+    global object_aabb_max, object_sap_sort_size, object_sap_step_num, object_sap_key
+    global object_sap_order, object_sap_size, object_sap_stage, object_sap_min_x, object_sap_slack
+    global object_pair, object_pair_num, object_pair_overflow
+    global object_pair_table_size, object_pair_table, object_pair_table_mask
+    global object_contact_flag, object_contact_begin, contact_particle, contact_particle_num
+    global active_particle, active_particle_num, object_active_begin
+    global shell_particle, shell_particle_num, object_shell_begin, object_shell_size
+    global max_reduce_chunk_num, reduce_chunk_num, reduce_chunk_object, reduce_chunk_begin
+    global reduce_chunk_cm, reduce_chunk_A, reduce_chunk_speed
+    global object_chunk_begin, object_chunk_num, particle_rest_q
+    global solver_iter, solver_running, solver_residual
+    global object_rot_q
+    global grid_table_size, grid_block_num, grid_count, grid_end, grid_block_sum
+    global grid_particle, particle_cell, particle_hash
+    global object_rest_inertia, object_haptic_impulse, object_haptic_angular_impulse
+    global haptic_force, haptic_torque
+    global static_sdf, static_sdf_grad, static_sdf_ready, static_sdf_offset, static_sdf_origin
+    global static_sdf_cell, static_sdf_dims, static_sdf_lower, static_sdf_upper
+    global object_sent_Cm, object_sent_rot, object_sent_valid
+    global transforms_ring, transform_ids_ring, object_cm_ring, object_rot_ring
+    global boundary_box, boxes_to_device, object_cm_to_host, object_rot_to_host
+    global solver_stats_to_host, haptic_tool_to_device, haptic_wrench_to_host
+    global mesh_particles_to_device, kinematic_poses_to_device, kinematic_poses_np
+    global object_scene, scene_override, scene_corr_rate, scene_damp
+    global scene_boundary_lower, scene_boundary_upper
+    global scene_object_count, scene_object_begin
+    global scenes_to_device
+    global snapshot_particles_nd, snapshot_objects_nd, snapshot_particles_np, snapshot_objects_np
+    global snapshot_scenes_nd, snapshot_scenes_np
+    global object_v, object_omega, object_Cm_old, object_rot_q_old
+    global object_inv_inertia, object_correction, object_angular_correction, object_correction_count
+    global grid_slot, grid_slot_num
+    global object_contact_correction, object_contact_angular_correction, object_contact_count
+    global contact_output_h, object_contacts_to_host, object_contacts_ring
+
+    # global variable
+    particle_num = ti.field(ti.i32, shape=())
+    particle_object_id = ti.field(ti.i32, max_particle_num)
+
+    x = ti.Vector.field(3, ti.f32, max_particle_num)
+    delta_x = ti.Vector.field(3, ti.f32, max_particle_num)
+    x_old = ti.Vector.field(3, ti.f32, max_particle_num)
+    v = ti.Vector.field(3, ti.f32, max_particle_num)
+
+    # inv_m = ti.field(ti.f32, max_particle_num)
+    object_rest_Cm = ti.Vector.field(3, ti.f32, max_object_num)
+    object_Cm = ti.Vector.field(3, ti.f32, max_object_num)
+    object_rot = ti.Matrix.field(3, 3, ti.f32, max_object_num)
+    object_rest_rot = ti.Matrix.field(3, 3, ti.f32, max_object_num)
+    object_A = ti.Matrix.field(3, 3, ti.f32, max_object_num)
+    object_state = ti.field(ti.i32, max_object_num)
+    object_sleep = ti.field(ti.i32, max_object_num)  # 1 while a dynamic object sleeps
+    object_sleep_counter = ti.field(ti.i32, max_object_num)  # quiet frames so far
+    object_wake = ti.field(ti.i32, max_object_num)  # wake up at the next update
+    object_prev_rot = ti.Matrix.field(3, 3, ti.f32, max_object_num)
+    object_friction_factor = ti.Vector.field(
+        2, ti.f32, max_object_num
+    )  # [mu_s, mu_k]
+    object_restitution = ti.field(ti.f32, max_object_num)
+    object_begin = ti.field(ti.i32, max_object_num)
+    object_size = ti.field(ti.i32, max_object_num)
+    object_mass = ti.field(ti.f32, max_object_num)
+
+    # add_boxes descriptors
+    batch_box_begin = ti.field(ti.i32, max_object_num)
+    batch_box_size = ti.field(ti.i32, max_object_num)
+
+    # object removal
+    capacity_overflow = ti.field(ti.i32, shape=())
+    particle_perm = ti.field(ti.i32, max_particle_num)  # new index -> old index
+    compact_object_begin = ti.field(ti.i32, max_object_num)
+    compact_old_particle_num = ti.field(ti.i32, shape=())
+    permute_i32 = ti.field(ti.i32, max_particle_num)
+    permute_f32 = ti.field(ti.f32, max_particle_num)
+    permute_vec3 = ti.Vector.field(3, ti.f32, max_particle_num)
+
+    # spatial reorder
+    reorder_sort_size = 1
+    while reorder_sort_size < max_particle_num:
+        reorder_sort_size *= 2
+    sort_level_num = reorder_sort_size.bit_length() - 1
+    reorder_step_num = sort_level_num * (sort_level_num + 1) // 2
+    reorder_key = ti.Vector.field(2, ti.i32, reorder_sort_size)  # (object_begin, morton code)
+    reorder_index = ti.field(ti.i32, reorder_sort_size)
+    reorder_size = ti.field(ti.i32, shape=())  # power of two >= particle_num
+    reorder_stage = ti.Vector.field(2, ti.i32, shape=())  # (k, j) of the next bitonic step
+
+    # scenes
+    object_scene = ti.field(ti.i32, max_object_num)
+    scene_override = ti.field(ti.i32, max_scene_num)  # 1 once set_scenes gave its parameters
+    scene_corr_rate = ti.field(ti.f32, max_scene_num)
+    scene_damp = ti.field(ti.f32, max_scene_num)
+    scene_boundary_lower = ti.Vector.field(3, ti.f32, max_scene_num)
+    scene_boundary_upper = ti.Vector.field(3, ti.f32, max_scene_num)
+    scene_object_count = ti.field(ti.i32, max_scene_num)
+    scene_object_begin = ti.field(ti.i32, max_scene_num)
+
+    # object broad phase
+    object_rest_extent = ti.Vector.field(3, ti.f32, max_object_num)
+    object_sweep = ti.field(ti.f32, max_object_num)  # motion since object_Cm was computed
+    object_aabb_min = ti.Vector.field(3, ti.f32, max_object_num)
+    object_aabb_max = ti.Vector.field(3, ti.f32, max_object_num)
+    object_sap_sort_size = 1
+    while object_sap_sort_size < max_object_num:
+        object_sap_sort_size *= 2
+    sort_level_num = object_sap_sort_size.bit_length() - 1
+    object_sap_step_num = sort_level_num * (sort_level_num + 1) // 2
+    object_sap_key = ti.Vector.field(2, ti.i32, object_sap_sort_size)  # (scene, aabb_min.x bits)
+    object_sap_order = ti.field(ti.i32, object_sap_sort_size)
+    object_sap_size = ti.field(ti.i32, shape=())  # power of two >= object_num
+    object_sap_stage = ti.Vector.field(2, ti.i32, shape=())
+    object_sap_min_x = ti.field(ti.f32, max_object_num)  # aabb_min.x when sorted
+    object_sap_slack = ti.field(ti.f32, shape=())  # largest drop of aabb_min.x since the sort
+    object_pair = ti.Vector.field(2, ti.i32, max_object_pair_num)  # (a, b), a < b
+    object_pair_table_size = 1
+    while object_pair_table_size < 2 * max_object_pair_num + 1:
+        object_pair_table_size *= 2
+    object_pair_table = ti.field(ti.i32, object_pair_table_size)  # pair key, -1 when empty
+    object_pair_table_mask = ti.field(ti.i32, shape=())  # slots in use - 1
+    object_pair_num = ti.field(ti.i32, shape=())
+    object_pair_overflow = ti.field(ti.i32, shape=())  # set when pairs past max_object_pair_num were dropped
+    object_contact_flag = ti.field(ti.i32, max_object_num)
+    object_contact_begin = ti.field(ti.i32, max_object_num)
+    contact_particle = ti.field(ti.i32, max_particle_num)
+    contact_particle_num = ti.field(ti.i32, shape=())
+
+    # sleeping
+    active_particle = ti.field(ti.i32, max_particle_num)
+    active_particle_num = ti.field(ti.i32, shape=())
+    object_active_begin = ti.field(ti.i32, max_object_num)
+
+    # shell particles
+    shell_particle = ti.field(ti.i32, max_particle_num)
+    shell_particle_num = ti.field(ti.i32, shape=())
+    object_shell_begin = ti.field(ti.i32, max_object_num)
+    object_shell_size = ti.field(ti.i32, max_object_num)
+
+    # segmented reduction
+    max_reduce_chunk_num = max_particle_num // reduce_chunk_size + max_object_num
+    reduce_chunk_num = ti.field(ti.i32, shape=())
+    reduce_chunk_object = ti.field(ti.i32, max_reduce_chunk_num)
+    reduce_chunk_begin = ti.field(ti.i32, max_reduce_chunk_num)
+    reduce_chunk_cm = ti.Vector.field(3, ti.f32, max_reduce_chunk_num)
+    reduce_chunk_A = ti.Matrix.field(3, 3, ti.f32, max_reduce_chunk_num)
+    reduce_chunk_speed = ti.field(ti.f32, max_reduce_chunk_num)
+    object_chunk_begin = ti.field(ti.i32, max_object_num)
+    object_chunk_num = ti.field(ti.i32, max_object_num)
+
+    # rest storage, the fields of the other mode stay None
+    x0 = particle_sdf = particle_sdf_grad = particle_rest_q = particle_rest = object_rest_quantum = None
+    if rest_storage == 'compact':
+        particle_rest = ti.Vector.field(3, ti.i32, max_particle_num)
+        object_rest_quantum = ti.field(ti.f32, max_object_num)
+    else:
+        x0 = ti.Vector.field(3, ti.f32, max_particle_num)
+        particle_sdf = ti.field(ti.f32, max_particle_num)
+        particle_sdf_grad = ti.Vector.field(3, ti.f32, max_particle_num)
+        particle_rest_q = ti.Vector.field(3, ti.f32, max_particle_num)  # x0 - object_rest_Cm
+
+    # solver iterations
+    solver_iter = ti.field(ti.i32, shape=())
+    solver_running = ti.field(ti.i32, shape=())
+    solver_residual = ti.field(ti.f32, shape=())
+
+    # body model
+    object_v = ti.Vector.field(3, ti.f32, max_object_num)
+    object_omega = ti.Vector.field(3, ti.f32, max_object_num)
+    object_Cm_old = ti.Vector.field(3, ti.f32, max_object_num)
+    object_rot_q_old = ti.Vector.field(4, ti.f32, max_object_num)
+    object_inv_inertia = ti.Matrix.field(3, 3, ti.f32, max_object_num)  # in the current pose
+    object_correction = ti.Vector.field(3, ti.f32, max_object_num)  # sum of push impulses
+    object_angular_correction = ti.Vector.field(3, ti.f32, max_object_num)  # sum of r x impulse
+    object_correction_count = ti.field(ti.i32, max_object_num)  # pushed particles
+
+    # contact solver
+    grid_slot = ti.field(ti.i32, max_particle_num)  # occupied hash slots, 'colored'
+    grid_slot_num = ti.field(ti.i32, shape=())
+
+    # rotation extraction
+    object_rot_q = ti.Vector.field(4, ti.f32, max_object_num)  # xyzw, 'quaternion' and 'rigid' only
+
+    # spatial hash grid
+    grid_table_size = 2 * max_particle_num
+    grid_block_num = (grid_table_size + grid_block_size - 1) // grid_block_size
+    grid_count = ti.field(ti.i32, grid_table_size)
+    grid_end = ti.field(ti.i32, grid_table_size)
+    grid_block_sum = ti.field(ti.i32, grid_block_num)
+    grid_particle = ti.field(ti.i32, max_particle_num)
+    particle_cell = ti.Vector.field(3, ti.i32, max_particle_num)
+    particle_hash = ti.field(ti.i32, max_particle_num)
+
+    # haptic query
+    object_rest_inertia = ti.Matrix.field(3, 3, ti.f32, max_object_num)  # unit particle mass, about rest_Cm
+    object_haptic_impulse = ti.Vector.field(3, ti.f32, max_object_num)
+    object_haptic_angular_impulse = ti.Vector.field(3, ti.f32, max_object_num)
+    haptic_force = ti.Vector.field(3, ti.f32, shape=())
+    haptic_torque = ti.Vector.field(3, ti.f32, shape=())
+
+    # static sdf volume
+    static_sdf = ti.field(ti.f32, max(static_sdf_max_nodes, 1))
+    static_sdf_grad = ti.Vector.field(3, ti.f32, max(static_sdf_max_nodes, 1))
+    static_sdf_ready = ti.field(ti.i32, shape=())
+    static_sdf_offset = ti.field(ti.i32, max_scene_num + 1)  # first node of every scene grid
+    static_sdf_origin = ti.Vector.field(3, ti.f32, max_scene_num)
+    static_sdf_cell = ti.field(ti.f32, max_scene_num)
+    static_sdf_dims = ti.Vector.field(3, ti.i32, max_scene_num)
+    static_sdf_lower = ti.Vector.field(3, ti.f32, max_scene_num)  # bounds of the static particles
+    static_sdf_upper = ti.Vector.field(3, ti.f32, max_scene_num)
+
+    # transform readback
+    object_sent_Cm = ti.Vector.field(3, ti.f32, max_object_num)  # as last written by copy_transforms
+    object_sent_rot = ti.Matrix.field(3, 3, ti.f32, max_object_num)
+    object_sent_valid = ti.field(ti.i32, max_object_num)
+    transforms_ring = [
+        ti.Vector.ndarray(transform_size, ti.f32, max_object_num) for _ in range(readback_ring_size)
+    ]
+    transform_ids_ring = [ti.ndarray(ti.i32, max_object_num + 1) for _ in range(readback_ring_size)]
+    object_cm_ring = [ti.Vector.ndarray(3, ti.f32, max_object_num) for _ in range(readback_ring_size)]
+    object_rot_ring = [ti.Matrix.ndarray(3, 3, ti.f32, max_object_num) for _ in range(readback_ring_size)]
+
+    # contact output
+    object_contact_correction = ti.Vector.field(3, ti.f32, max_object_num)  # sum of contact corrections
+    object_contact_angular_correction = ti.Vector.field(3, ti.f32, max_object_num)  # sum of r x correction
+    object_contact_count = ti.field(ti.i32, max_object_num)  # particle contacts, last iteration
+    contact_output_h = ti.field(ti.f32, shape=())  # step of the last update
+    object_contacts_ring = [
+        ti.Vector.ndarray(contact_output_size, ti.f32, max_object_num) for _ in range(readback_ring_size)
+    ]
+
+    # mock unity
+    boundary_box = ti.Vector.ndarray(3, ti.f32, 2)
+    boundary_box.from_numpy(boundary_box_np)
+    boxes_to_device = ti.Vector.ndarray(box_desc_size, ti.f32, max_object_num)
+    object_cm_to_host = ti.Vector.ndarray(3, ti.f32, max_object_num)
+    object_rot_to_host = ti.Matrix.ndarray(3, 3, ti.f32, max_object_num)
+    solver_stats_to_host = ti.ndarray(ti.f32, 2)  # [iterations used, residual]
+    haptic_tool_to_device = ti.ndarray(ti.f32, haptic_tool_size)
+    haptic_wrench_to_host = ti.ndarray(ti.f32, 6)  # [force, torque about the tool center]
+    object_contacts_to_host = ti.Vector.ndarray(contact_output_size, ti.f32, max_object_num)
+    mesh_particles_to_device = ti.Vector.ndarray(mesh_particle_size, ti.f32, max_particle_num)
+    kinematic_poses_to_device = ti.Vector.ndarray(kinematic_pose_size, ti.f32, max_object_num)
+    kinematic_poses_np = np.zeros((max_object_num, kinematic_pose_size), dtype=np.float32)
+    scenes_to_device = ti.Vector.ndarray(scene_desc_size, ti.f32, max_scene_num)
+    snapshot_particles_nd = ti.Vector.ndarray(snapshot_particle_size, ti.f32, max_particle_num)
+    snapshot_objects_nd = ti.Vector.ndarray(snapshot_object_size, ti.f32, max_object_num)
+    snapshot_scenes_nd = ti.Vector.ndarray(snapshot_scene_size, ti.f32, max_scene_num)
+    snapshot_particles_np = np.zeros((max_particle_num, snapshot_particle_size), dtype=np.float32)  # upload staging
+    snapshot_objects_np = np.zeros((max_object_num, snapshot_object_size), dtype=np.float32)
+    snapshot_scenes_np = np.zeros((max_scene_num, snapshot_scene_size), dtype=np.float32)
+# fields----------------------------------------------------------
+
 # all symbols-----------------------------------------------------
 sym_dt = ti.graph.Arg(ti.graph.ArgKind.SCALAR, "dt", ti.f32)
 sym_corr_rate = ti.graph.Arg(ti.graph.ArgKind.SCALAR, "corr_rate", ti.f32)
@@ -84,27 +729,415 @@ sym_damp = ti.graph.Arg(ti.graph.ArgKind.SCALAR, "damp", ti.f32)
 sym_half_extent_x = ti.graph.Arg(ti.graph.ArgKind.SCALAR, "half_extent_x", ti.f32)
 sym_half_extent_y = ti.graph.Arg(ti.graph.ArgKind.SCALAR, "half_extent_y", ti.f32)
 sym_half_extent_z = ti.graph.Arg(ti.graph.ArgKind.SCALAR, "half_extent_z", ti.f32)
+sym_iterations = ti.graph.Arg(ti.graph.ArgKind.SCALAR, "iterations", ti.i32)
+sym_tolerance = ti.graph.Arg(ti.graph.ArgKind.SCALAR, "tolerance", ti.f32)
+sym_solver_stats = ti.graph.Arg(ti.graph.ArgKind.NDARRAY, 'solver_stats', ti.f32, field_dim=1)
+sym_boxes = ti.graph.Arg(ti.graph.ArgKind.NDARRAY, 'boxes', ti.f32, field_dim=1, element_shape=(box_desc_size,))
+sym_box_num = ti.graph.Arg(ti.graph.ArgKind.SCALAR, "box_num", ti.i32)
+sym_haptic_tool = ti.graph.Arg(ti.graph.ArgKind.NDARRAY, 'haptic_tool', ti.f32, field_dim=1)
+sym_haptic_wrench = ti.graph.Arg(ti.graph.ArgKind.NDARRAY, 'haptic_wrench', ti.f32, field_dim=1)
+sym_stiffness = ti.graph.Arg(ti.graph.ArgKind.SCALAR, "stiffness", ti.f32)
+sym_mesh_particles = ti.graph.Arg(ti.graph.ArgKind.NDARRAY, 'mesh_particles', ti.f32, field_dim=1, element_shape=(mesh_particle_size,))
+sym_mesh_particle_num = ti.graph.Arg(ti.graph.ArgKind.SCALAR, "mesh_particle_num", ti.i32)
+sym_transforms = ti.graph.Arg(ti.graph.ArgKind.NDARRAY, 'transforms', ti.f32, field_dim=1, element_shape=(transform_size,))
+sym_transform_ids = ti.graph.Arg(ti.graph.ArgKind.NDARRAY, 'transform_ids', ti.i32, field_dim=1)
+sym_position_threshold = ti.graph.Arg(ti.graph.ArgKind.SCALAR, "position_threshold", ti.f32)
+sym_rotation_threshold = ti.graph.Arg(ti.graph.ArgKind.SCALAR, "rotation_threshold", ti.f32)
+sym_kinematic_poses = ti.graph.Arg(ti.graph.ArgKind.NDARRAY, 'kinematic_poses', ti.f32, field_dim=1, element_shape=(kinematic_pose_size,))
+sym_scenes = ti.graph.Arg(ti.graph.ArgKind.NDARRAY, 'scenes', ti.f32, field_dim=1, element_shape=(scene_desc_size,))
+sym_scene_num = ti.graph.Arg(ti.graph.ArgKind.SCALAR, "scene_num", ti.i32)
+sym_snapshot_particles = ti.graph.Arg(ti.graph.ArgKind.NDARRAY, 'snapshot_particles', ti.f32, field_dim=1, element_shape=(snapshot_particle_size,))
+sym_snapshot_objects = ti.graph.Arg(ti.graph.ArgKind.NDARRAY, 'snapshot_objects', ti.f32, field_dim=1, element_shape=(snapshot_object_size,))
+sym_snapshot_scenes = ti.graph.Arg(ti.graph.ArgKind.NDARRAY, 'snapshot_scenes', ti.f32, field_dim=1, element_shape=(snapshot_scene_size,))
+sym_snapshot_particle_num = ti.graph.Arg(ti.graph.ArgKind.SCALAR, "snapshot_particle_num", ti.i32)
+sym_snapshot_scene_num = ti.graph.Arg(ti.graph.ArgKind.SCALAR, "snapshot_scene_num", ti.i32)
+sym_static_sdf_valid = ti.graph.Arg(ti.graph.ArgKind.SCALAR, "static_sdf_valid", ti.i32)
+sym_object_contacts = ti.graph.Arg(ti.graph.ArgKind.NDARRAY, 'object_contacts', ti.f32, field_dim=1, element_shape=(contact_output_size,))
 # all symbols-----------------------------------------------------
 
+# profiling-------------------------------------------------------------
+# Every *_mock runs its graph through run_graph. With profiling off that is
+# a plain get_graph(name).run; with TIOUCH_PROFILE=1 each run is fenced by ti.sync and
+# the kernel profiler is queried (ti.profiler.query_kernel_profiler_info) for
+# every kernel of the graph, as recorded in graph_kernels by the
+# GraphBuilder of its builder. update_mock closes a frame, the last
+# profile_window frames are kept per graph / kernel.
+profile_window = 600
+profile_frames = defaultdict(lambda: deque(maxlen=profile_window))  # name -> per-frame ms
+profile_current = defaultdict(float)  # name -> ms in the frame being recorded
+
+
+graph_builders = {}  # name -> function building and compiling the graph
+graphs = {}  # name -> compiled graph
+graph_kernels = {}  # name -> names of the kernels the graph dispatches, filled when it is built
+building_graph = None  # name of the graph being built
+
+
+class GraphBuilder(ti.graph.GraphBuilder):
+    # records every kernel dispatched into the graph being built
+    def dispatch(self, kernel_fn, *args):
+        kernels = graph_kernels[building_graph]
+        if kernel_fn.__name__ not in kernels:
+            kernels.append(kernel_fn.__name__)
+        super().dispatch(kernel_fn, *args)
+
+
+def lazy_graph(name):
+    # register a graph builder, the graph is compiled by the first get_graph
+    def register(build):
+        def build_recorded():
+            global building_graph
+            graph_kernels[name] = []
+            building_graph = name
+            try:
+                return build()
+            finally:
+                building_graph = None
+        graph_builders[name] = build_recorded
+        return build
+    return register
+
+
+def get_graph(name):
+    if name not in graphs:
+        ensure_init()
+        graphs[name] = graph_builders[name]()
+    return graphs[name]
+
+
+def run_graph(name, args):
+    graph = get_graph(name)
+    if not profiling:
+        graph.run(args)
+        return
+    ti.sync()
+    ti.profiler.clear_kernel_profiler_info()
+    t = time.perf_counter()
+    graph.run(args)
+    ti.sync()
+    profile_current['graph/' + name] += 1000.0 * (time.perf_counter() - t)
+    # the profiler sums the offloaded tasks of a kernel into one launch
+    for kernel in graph_kernels[name]:
+        info = ti.profiler.query_kernel_profiler_info(kernel)
+        profile_current['kernel/' + kernel] += info.counter * info.avg
+
+
+def profile_frame_end():
+    if not profiling:
+        return
+    for name in set(profile_frames) | set(profile_current):
+        profile_frames[name].append(profile_current.get(name, 0.0))
+    profile_current.clear()
+
+
+def profile_stats():
+    # {name: {'frames', 'mean_ms', 'p50_ms', 'p99_ms', 'max_ms'}} over the rolling window
+    stats = {}
+    for name, frames in profile_frames.items():
+        t = np.array(frames)
+        stats[name] = {
+            'frames': len(t),
+            'mean_ms': float(t.mean()),
+            'p50_ms': float(np.percentile(t, 50)),
+            'p99_ms': float(np.percentile(t, 99)),
+            'max_ms': float(t.max()),
+        }
+    return stats
+
+
+def dump_profile(path):
+    # .json or .csv, sorted by p99
+    stats = sorted(profile_stats().items(), key=lambda item: -item[1]['p99_ms'])
+    with open(path, 'w') as f:
+        if path.endswith('.json'):
+            json.dump(dict(stats), f, indent=2)
+        else:
+            f.write('name,frames,mean_ms,p50_ms,p99_ms,max_ms\n')
+            for name, st in stats:
+                f.write('{},{},{:.4f},{:.4f},{:.4f},{:.4f}\n'.format(
+                    name, st['frames'], st['mean_ms'], st['p50_ms'], st['p99_ms'], st['max_ms']))
+
+
+def reset_profile():
+    profile_frames.clear()
+    profile_current.clear()
+# profiling-------------------------------------------------------------
+
+
 # init graph------------------------------------------------------------
 # avoid these particles to be rendered
 @ti.kernel
 def init():
     particle_num[None] = 0
+    reduce_chunk_num[None] = 0
+    shell_particle_num[None] = 0
+    capacity_overflow[None] = 0
+    object_pair_overflow[None] = 0
+    static_sdf_ready[None] = 0
+    for s in range(max_scene_num):
+        scene_override[s] = 0
     for I in ti.grouped(x):
         x[I] = ti.Vector([1e20, 1e20, 1e20])
 
-init_GraphBuilder = ti.graph.GraphBuilder()
-init_GraphBuilder.dispatch(init)
-init_graph = init_GraphBuilder.compile()
+@lazy_graph('init')
+def build_init_graph():
+    init_GraphBuilder = GraphBuilder()
+    init_GraphBuilder.dispatch(init)
+    return init_GraphBuilder.compile()
 
 def init_mock():
-    init_graph.run({})
+    run_graph('init', {})
+    free_object_ids.clear()
+    kinematic_poses_np[:] = 0.0
 # init graph------------------------------------------------------------
 
 
 
 # add_box graph---------------------------------------------------------
+@ti.func
+def quantize_i16(value, step):
+    return ti.max(ti.min(ti.cast(ti.round(value / step), ti.i32), rest_i16_max), -rest_i16_max)
+
+
+@ti.func
+def pack_i16(lo, hi):
+    return (lo & 0xFFFF) | (hi << 16)
+
+
+@ti.func
+def unpack_i16_lo(w):
+    return (w << 16) >> 16
+
+
+@ti.func
+def unpack_i16_hi(w):
+    return w >> 16
+
+
+@ti.func
+def octahedral_encode(n):
+    # unit vector to a point of [-1, 1]^2
+    n = n / ti.max(ti.abs(n.x) + ti.abs(n.y) + ti.abs(n.z), eps)
+    p = ti.Vector([n.x, n.y])
+    if n.z < 0.0:
+        p = ti.Vector([
+            (1.0 - ti.abs(n.y)) * ti.select(n.x >= 0.0, 1.0, -1.0),
+            (1.0 - ti.abs(n.x)) * ti.select(n.y >= 0.0, 1.0, -1.0),
+        ])
+    return p
+
+
+@ti.func
+def octahedral_decode(p):
+    n = vec3(p.x, p.y, 1.0 - ti.abs(p.x) - ti.abs(p.y))
+    t = ti.max(-n.z, 0.0)
+    n.x += ti.select(n.x >= 0.0, -t, t)
+    n.y += ti.select(n.y >= 0.0, -t, t)
+    return n.normalized()
+
+
+@ti.func
+def set_rest_quantum(object_id):
+    # step of the compact rest offsets of object_id, the finest particle_diameter / 2^k
+    # that still holds the extent, lattice offsets of unrotated boxes stay exact
+    if ti.static(rest_storage == 'compact'):
+        ratio = rest_i16_max * particle_diameter / (object_rest_extent[object_id].max() + particle_diameter)
+        k = ti.max(ti.cast(ti.floor(ti.log(ratio) / ti.log(2.0)), ti.i32), 0)
+        object_rest_quantum[object_id] = particle_diameter / (1 << k)
+
+
+@ti.func
+def rest_q(i, object_id):
+    # x0 - object_rest_Cm of particle i of object_id
+    q = vec3(0.0)
+    if ti.static(rest_storage == 'compact'):
+        w = particle_rest[i]
+        q = vec3(unpack_i16_lo(w[0]), unpack_i16_hi(w[0]), unpack_i16_lo(w[1]))
+        q *= object_rest_quantum[object_id]
+    else:
+        q = particle_rest_q[i]
+    return q
+
+
+@ti.func
+def rest_position(i):
+    p = vec3(0.0)
+    if ti.static(rest_storage == 'compact'):
+        object_id = particle_object_id[i]
+        p = object_rest_Cm[object_id] + rest_q(i, object_id)
+    else:
+        p = x0[i]
+    return p
+
+
+@ti.func
+def rest_sdf(i):
+    sdf = 0.0
+    if ti.static(rest_storage == 'compact'):
+        sdf = unpack_i16_hi(particle_rest[i][1]) * rest_sdf_step
+    else:
+        sdf = particle_sdf[i]
+    return sdf
+
+
+@ti.func
+def rest_sdf_grad(i):
+    grad = vec3(0.0)
+    if ti.static(rest_storage == 'compact'):
+        w = particle_rest[i][2]
+        grad = octahedral_decode(ti.Vector([unpack_i16_lo(w), unpack_i16_hi(w)]) / rest_i16_max)
+    else:
+        grad = particle_sdf_grad[i]
+    return grad
+
+
+@ti.func
+def store_rest(i, position, sdf, grad):
+    # compact keeps no position, store_rest_q follows once object_rest_Cm is known
+    if ti.static(rest_storage == 'compact'):
+        p = octahedral_encode(grad)
+        particle_rest[i][1] = pack_i16(0, quantize_i16(sdf, rest_sdf_step))
+        particle_rest[i][2] = pack_i16(
+            quantize_i16(p.x, 1.0 / rest_i16_max), quantize_i16(p.y, 1.0 / rest_i16_max)
+        )
+    else:
+        x0[i] = position
+        particle_sdf[i] = sdf
+        particle_sdf_grad[i] = grad
+
+
+@ti.func
+def store_rest_q(i, q):
+    # after store_rest and set_rest_quantum of the object
+    if ti.static(rest_storage == 'compact'):
+        quantum = object_rest_quantum[particle_object_id[i]]
+        particle_rest[i][0] = pack_i16(quantize_i16(q.x, quantum), quantize_i16(q.y, quantum))
+        particle_rest[i][1] = pack_i16(quantize_i16(q.z, quantum), unpack_i16_hi(particle_rest[i][1]))
+    else:
+        particle_rest_q[i] = q
+
+
+@ti.func
+def append_reduce_chunks(object_id):
+    chunk_num = (object_size[object_id] + reduce_chunk_size - 1) // reduce_chunk_size
+    first = ti.atomic_add(reduce_chunk_num[None], chunk_num)
+    object_chunk_begin[object_id] = first
+    object_chunk_num[object_id] = chunk_num
+    for c in range(chunk_num):
+        reduce_chunk_object[first + c] = object_id
+        reduce_chunk_begin[first + c] = object_begin[object_id] + c * reduce_chunk_size
+
+
+@ti.func
+def append_shell_particles(object_id):
+    begin = object_begin[object_id]
+    end = begin + object_size[object_id]
+    count = 0
+    for i in range(begin, end):
+        if -rest_sdf(i) < shell_depth + eps:
+            count += 1
+    # reserve a contiguous range, objects may be appended in parallel
+    first = ti.atomic_add(shell_particle_num[None], count)
+    cursor = first
+    ti.loop_config(serialize=True)
+    for i in range(begin, end):
+        if -rest_sdf(i) < shell_depth + eps:
+            shell_particle[cursor] = i
+            cursor += 1
+    object_shell_begin[object_id] = first
+    object_shell_size[object_id] = count
+
+
+@ti.func
+def init_box_particle(global_id, ijk, center, low_corner, high_corner, rotation, object_id):
+    pos = low_corner + ijk * particle_diameter
+    # inv_m[global_id] = 1.0 / particle_mass
+    # inv_m[global_id] = 1.0 / particle_mass
+    particle_object_id[global_id] = object_id
+
+
+    # sdf------------------------------------------------------------
+    # TODO: we need a better method to calculate sdf and sdf_grad
+    dir = vec3(0.0)
+    sign = vec3(0.0)
+    sdf = 0.0
+    min_dis = inf
+    for d in ti.static(range(3)):
+        signed_dis = 0.0
+        if pos[d] - low_corner[d] > high_corner[d] - pos[d]:
+            signed_dis = high_corner[d] - pos[d]
+            sign[d] = 1
+        else:
+            signed_dis = low_corner[d] - pos[d]
+            sign[d] = -1
+        dir[d] = signed_dis
+        min_dis = ti.min(min_dis, ti.abs(signed_dis))
+
+    if min_dis < eps:
+        # boundary particles
+        for d in ti.static(range(3)):
+            if ti.abs(dir[d]) > eps:
+                dir[d] = 0
+            else:
+                dir[d] = 1.0 * sign[d]
+    else:
+        # if ti.abs(dir[0] - dir[1]) >= eps or ti.abs(dir[0] - dir[2]) >= eps or ti.abs(dir[1] - dir[2]) >= eps:
+        # remain a dim if several signed distance equal the minimum component
+        remain_dim = 0
+        for d in ti.static(range(3)):
+            if ti.abs(ti.abs(dir[d]) - min_dis) < eps:
+                remain_dim = d
+                # break # BUG: we must remove this break, otherwise we get a unexpected result
+        for d in ti.static(range(3)):
+            if d == remain_dim:
+                pass
+                # continue # BUG: we muse use pass instead of continue, otherwise we get a unexpected result
+            else:
+                dir[d] = 0.0
+        sdf = -dir.norm()
+    # sdf------------------------------------------------------------
+
+    pos = rotation @ (pos - center) + center
+    x[global_id] = pos
+    x_old[global_id] = pos
+    store_rest(global_id, pos, sdf, rotation.inverse().transpose() @ dir.normalized())
+
+
+@ti.func
+def inertia_term(q):
+    # inertia tensor of a unit mass at offset q
+    return q.dot(q) * mat33_identity - q.outer_product(q)
+
+
+@ti.func
+def init_box_object(object_id, half_extent, rotation, state, fric_factor, restitution, begin, size, scene):
+    object_rest_rot[object_id] = rotation
+    object_scene[object_id] = scene
+    object_rot_q[object_id] = ti.Vector([0.0, 0.0, 0.0, 1.0])
+    object_v[object_id] = vec3(0.0)
+    object_omega[object_id] = vec3(0.0)
+    object_sent_valid[object_id] = 0
+    object_rest_extent[object_id] = ti.abs(rotation) @ half_extent
+    set_rest_quantum(object_id)
+    object_sweep[object_id] = 0.0
+    object_state[object_id] = state
+    object_sleep[object_id] = 0
+    object_sleep_counter[object_id] = 0
+    object_wake[object_id] = 0
+    object_friction_factor[object_id] = fric_factor
+    object_restitution[object_id] = restitution
+    object_begin[object_id] = begin
+    object_size[object_id] = size
+    object_rest_inertia[object_id] = mat33(0.0)
+    object_haptic_impulse[object_id] = vec3(0.0)
+    object_haptic_angular_impulse[object_id] = vec3(0.0)
+    # object_mass[object_id] = particle_mass * size
+    # empty (rejected) objects keep a unit mass so their Cm stays finite
+    object_mass[object_id] = 1.0 * ti.max(size, 1)
+    if state == STATE_STATIC:
+        static_sdf_ready[None] = 0
+
+
 @ti.func
 def add_box_func(
     center,
@@ -128,86 +1161,41 @@ def add_box_func(
     # !!!
     n3_with_border = int(n3 + vec3(1, 1, 1))
     new_particle_num = n3_with_border.x * n3_with_border.y * n3_with_border.z
+    if particle_num + new_particle_num > max_particle_num:
+        # out of particle storage, add the object as removed and empty
+        capacity_overflow[None] = 1
+        state = STATE_REMOVED
+        n3_with_border = ti.Vector([0, 0, 0])
+        new_particle_num = 0
     object_Cm[object_id] = vec3(0.0)
+    object_rest_Cm[object_id] = vec3(0.0)
 
     for i, j, k in ti.ndrange(n3_with_border.x, n3_with_border.y, n3_with_border.z):
         local_id = i * n3_with_border.z * n3_with_border.y + j * n3_with_border.z + k
         global_id = local_id + particle_num
-        pos = low_corner + ti.Vector([i, j, k]) * particle_diameter
-        x0[global_id] = pos
-        x[global_id] = x0[global_id]
-        x_old[global_id] = x0[global_id]
-        # inv_m[global_id] = 1.0 / particle_mass
-        # inv_m[global_id] = 1.0 / particle_mass
-        particle_object_id[global_id] = object_id
-
-
-        # sdf------------------------------------------------------------
-        # TODO: we need a better method to calculate sdf and sdf_grad
-        dir = vec3(0.0)
-        sign = vec3(0.0)
-        min_dis = inf
-        for d in ti.static(range(3)):
-            signed_dis = 0.0
-            if pos[d] - low_corner[d] > high_corner[d] - pos[d]:
-                signed_dis = high_corner[d] - pos[d]
-                sign[d] = 1
-            else:
-                signed_dis = low_corner[d] - pos[d]
-                sign[d] = -1
-            dir[d] = signed_dis
-            min_dis = ti.min(min_dis, ti.abs(signed_dis))
-
-        if min_dis < eps:
-            # boundary particles
-            particle_sdf[global_id] = 0.0
-            for d in ti.static(range(3)):
-                if ti.abs(dir[d]) > eps:
-                    dir[d] = 0
-                else:
-                    dir[d] = 1.0 * sign[d]
-        else:
-            # if ti.abs(dir[0] - dir[1]) >= eps or ti.abs(dir[0] - dir[2]) >= eps or ti.abs(dir[1] - dir[2]) >= eps:
-            # remain a dim if several signed distance equal the minimum component
-            remain_dim = 0
-            for d in ti.static(range(3)):
-                if ti.abs(ti.abs(dir[d]) - min_dis) < eps:
-                    remain_dim = d
-                    # break # BUG: we must remove this break, otherwise we get a unexpected result
-            for d in ti.static(range(3)):
-                if d == remain_dim:
-                    pass
-                    # continue # BUG: we muse use pass instead of continue, otherwise we get a unexpected result
-                else:
-                    dir[d] = 0.0
-            particle_sdf[global_id] = -dir.norm()
-
-        particle_sdf_grad[global_id] = dir.normalized()
-        # sdf------------------------------------------------------------
-
-
-        x0[global_id] = rotation @ (x0[global_id] - center) + center
-        x[global_id] = x0[global_id]
-        x_old[global_id] = x0[global_id]
-
-        particle_sdf_grad[global_id] = (
-            rotation.inverse().transpose() @ particle_sdf_grad[global_id]
+        init_box_particle(
+            global_id, ti.Vector([i, j, k]), center, low_corner, high_corner, rotation, object_id
         )
 
         ti.atomic_add(
             # object_rest_Cm[object_num], particle_mass * x[global_id]
             object_rest_Cm[object_id], 1.0 * x[global_id]
         )
-    object_rest_rot[object_id] = rotation
-    object_state[object_id] = state
-    object_friction_factor[object_id] = fric_factor
-    object_restitution[object_id] = restitution
-    object_begin[object_id] = particle_num
-    object_size[object_id] = new_particle_num
-    # object_mass[object_id] = particle_mass * new_particle_num
-    object_mass[object_id] = 1.0 * new_particle_num
+    init_box_object(
+        object_id, half_extent, rotation, state, fric_factor, restitution,
+        particle_num, new_particle_num, 0
+    )
     object_rest_Cm[object_id] /= object_mass[object_id]
 
+    # x is still x0
+    for i in range(particle_num, particle_num + new_particle_num):
+        q = x[i] - object_rest_Cm[object_id]
+        store_rest_q(i, q)
+        ti.atomic_add(object_rest_inertia[object_id], inertia_term(q))
+
+    append_reduce_chunks(object_id)
+    append_shell_particles(object_id)
+
     return new_particle_num
 
 @ti.kernel
@@ -227,6 +1215,52 @@ state: ti.i32, object_num: ti.i32):
     particle_num[None] += new_particle_num
 
 
+@ti.func
+def matrix_column(M, c: ti.template()):
+    return vec3(M[0, c], M[1, c], M[2, c])
+
+
+@ti.func
+def quat_mul(a, b):
+    # Hamilton product of (x, y, z, w) quaternions
+    return ti.Vector([
+        a[3] * b[0] + a[0] * b[3] + a[1] * b[2] - a[2] * b[1],
+        a[3] * b[1] - a[0] * b[2] + a[1] * b[3] + a[2] * b[0],
+        a[3] * b[2] + a[0] * b[1] - a[1] * b[0] + a[2] * b[3],
+        a[3] * b[3] - a[0] * b[0] - a[1] * b[1] - a[2] * b[2],
+    ])
+
+
+@ti.func
+def extract_rotation(object_id):
+    # object_rot from object_A, see "rotation extraction" for the two modes
+    if ti.static(rotation_extraction == 'quaternion'):
+        A = object_A[object_id]
+        q = object_rot_q[object_id]
+        for _ in ti.static(range(rotation_extraction_steps)):
+            R = quat_to_mat33(q)
+            omega = vec3(0.0)
+            denom = 0.0
+            for c in ti.static(range(3)):
+                omega += matrix_column(R, c).cross(matrix_column(A, c))
+                denom += matrix_column(R, c).dot(matrix_column(A, c))
+            omega /= ti.abs(denom) + 1e-9
+            w = omega.norm()
+            if w > 1e-9:
+                axis = omega / w
+                dq = ti.Vector([
+                    axis.x * ti.sin(0.5 * w), axis.y * ti.sin(0.5 * w),
+                    axis.z * ti.sin(0.5 * w), ti.cos(0.5 * w)
+                ])
+                q = quat_mul(dq, q).normalized()
+        object_rot_q[object_id] = q
+        object_rot[object_id] = quat_to_mat33(q)
+    else:
+        object_rot[object_id], S = ti.polar_decompose(object_A[object_id])
+        if all(abs(object_rot[object_id]) < eps):
+            object_rot[object_id] = ti.Matrix.identity(ti.f32, 3)
+
+
 # TODO: Reduce optimization
 @ti.func
 def calc_single_object_cm_A_rot(object_id: ti.i32):
@@ -244,7 +1278,7 @@ def calc_single_object_cm_A_rot(object_id: ti.i32):
     object_Cm[object_id] /= object_mass[object_id]
     for i in range(object_begin_t, object_end):
         # A
-        q = x0[i] - object_rest_Cm[object_id]
+        q = rest_q(i, object_id)
         p = x[i] - object_Cm[object_id]
         ti.atomic_add(
             # object_A[object_id], 1.0 / inv_m[i] * p @ q.transpose()
@@ -252,27 +1286,28 @@ def calc_single_object_cm_A_rot(object_id: ti.i32):
         )
 
     # rot
-    object_rot[object_id], S = ti.polar_decompose(object_A[object_id])
-    if all(abs(object_rot[object_id]) < eps):
-        object_rot[object_id] = ti.Matrix.identity(ti.f32, 3)
+    extract_rotation(object_id)
 
 @ti.kernel
 def calc_single_object_cm_A_rot_kernel(object_id: ti.i32):
     calc_single_object_cm_A_rot(object_id)
 
-add_box_GraphBuilder = ti.graph.GraphBuilder()
+@lazy_graph('add_box')
+def build_add_box_graph():
+    add_box_GraphBuilder = GraphBuilder()
 
-add_box_GraphBuilder.dispatch(add_box_kernel, sym_center_x, sym_center_y, sym_center_z, 
-sym_half_extent_x, sym_half_extent_y, sym_half_extent_z,
-sym_state, sym_object_id)
-add_box_GraphBuilder.dispatch(calc_single_object_cm_A_rot_kernel, sym_object_id)
-add_box_graph = add_box_GraphBuilder.compile()
+    add_box_GraphBuilder.dispatch(add_box_kernel, sym_center_x, sym_center_y, sym_center_z, 
+    sym_half_extent_x, sym_half_extent_y, sym_half_extent_z,
+    sym_state, sym_object_id)
+    add_box_GraphBuilder.dispatch(calc_single_object_cm_A_rot_kernel, sym_object_id)
+    return add_box_GraphBuilder.compile()
 
 
 def add_box_mock(center_x: ti.f32, center_y: ti.f32, center_z: ti.f32, 
     half_extent_x: ti.f32, half_extent_y: ti.f32, half_extent_z: ti.f32,
     state: ti.i32, object_id: ti.i32):
-    add_box_graph.run({
+    claim_object_ids(object_id, 1)
+    run_graph('add_box', {
         'center_x' : center_x,
         'center_y' : center_y,
         'center_z' : center_z,
@@ -282,13 +1317,568 @@ def add_box_mock(center_x: ti.f32, center_y: ti.f32, center_z: ti.f32,
         'state' : state,
         'object_id' : object_id
     })
+    check_capacity_overflow(object_id, 1)
     return object_id + 1
 # add_box graph---------------------------------------------------------
 
 
+# add_boxes graph-------------------------------------------------------
+@ti.func
+def quat_to_mat33(q):
+    # q = (x, y, z, w)
+    qx, qy, qz, qw = q[0], q[1], q[2], q[3]
+    return mat33(
+        [
+            [1 - 2 * (qy * qy + qz * qz), 2 * (qx * qy - qz * qw), 2 * (qx * qz + qy * qw)],
+            [2 * (qx * qy + qz * qw), 1 - 2 * (qx * qx + qz * qz), 2 * (qy * qz - qx * qw)],
+            [2 * (qx * qz - qy * qw), 2 * (qy * qz + qx * qw), 1 - 2 * (qx * qx + qy * qy)],
+        ]
+    )
+
+
+@ti.func
+def box_desc_vec3(boxes: ti.template(), b, offset):
+    return vec3(boxes[b][offset], boxes[b][offset + 1], boxes[b][offset + 2])
+
+
+@ti.func
+def box_desc_rotation(boxes: ti.template(), b):
+    return quat_to_mat33(
+        ti.Vector([boxes[b][BOX_DESC_ROTATION + d] for d in ti.static(range(4))])
+    )
+
+
+@ti.func
+def box_desc_n3(boxes: ti.template(), b):
+    return ti.ceil(box_desc_vec3(boxes, b, BOX_DESC_HALF_EXTENT) * 2 / particle_diameter)
+
+
+@ti.kernel
+def add_boxes_kernel(boxes: ti.types.ndarray(field_dim=1), box_num: ti.i32, first_object_id: ti.i32):
+    first_particle = particle_num[None]
+
+    for b in range(box_num):
+        n3_with_border = int(box_desc_n3(boxes, b) + vec3(1, 1, 1))
+        batch_box_size[b] = n3_with_border.x * n3_with_border.y * n3_with_border.z
+
+    # exclusive prefix sum of the box sizes
+    cursor = first_particle
+    ti.loop_config(serialize=True)
+    for b in range(box_num):
+        batch_box_begin[b] = cursor
+        cursor += batch_box_size[b]
+    if cursor > max_particle_num:
+        # out of particle storage, every box of the batch stays empty
+        capacity_overflow[None] = 1
+        cursor = first_particle
+        for b in range(box_num):
+            batch_box_begin[b] = first_particle
+            batch_box_size[b] = 0
+    particle_num[None] = cursor
+
+    # fill all new particles in one pass, each one binary searches its box
+    for global_id in range(first_particle, particle_num[None]):
+        lo, hi = 0, box_num - 1
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if batch_box_begin[mid] <= global_id:
+                lo = mid
+            else:
+                hi = mid - 1
+        b = lo
+        n3 = box_desc_n3(boxes, b)
+        n3_with_border = int(n3 + vec3(1, 1, 1))
+        half_extent = n3 * particle_diameter / 2
+        center = box_desc_vec3(boxes, b, BOX_DESC_CENTER)
+
+        local_id = global_id - batch_box_begin[b]
+        i = local_id // (n3_with_border.z * n3_with_border.y)
+        j = (local_id // n3_with_border.z) % n3_with_border.y
+        k = local_id % n3_with_border.z
+        init_box_particle(
+            global_id, ti.Vector([i, j, k]), center, center - half_extent, center + half_extent,
+            box_desc_rotation(boxes, b), first_object_id + b
+        )
+        v[global_id] = box_desc_vec3(boxes, b, BOX_DESC_VELOCITY)
+
+    for b in range(box_num):
+        object_id = first_object_id + b
+        begin = batch_box_begin[b]
+        end = begin + batch_box_size[b]
+        state = ti.cast(boxes[b][BOX_DESC_STATE], ti.i32)
+        if end == begin:
+            state = STATE_REMOVED
+        init_box_object(
+            object_id,
+            box_desc_n3(boxes, b) * particle_diameter / 2,
+            box_desc_rotation(boxes, b),
+            state,
+            vec2(boxes[b][BOX_DESC_FRICTION], boxes[b][BOX_DESC_FRICTION + 1]),
+            boxes[b][BOX_DESC_RESTITUTION],
+            begin, end - begin,
+            ti.cast(boxes[b][BOX_DESC_SCENE], ti.i32)
+        )
+        object_v[object_id] = box_desc_vec3(boxes, b, BOX_DESC_VELOCITY)
+
+        # x is still x0
+        rest_Cm = vec3(0.0)
+        for i in range(begin, end):
+            rest_Cm += x[i]
+        rest_Cm /= object_mass[object_id]
+        object_rest_Cm[object_id] = rest_Cm
+        object_Cm[object_id] = rest_Cm
+        object_rot[object_id] = mat33_identity
+        rest_inertia = mat33(0.0)
+        for i in range(begin, end):
+            q = x[i] - rest_Cm
+            store_rest_q(i, q)
+            rest_inertia += inertia_term(q)
+        object_rest_inertia[object_id] = rest_inertia
+
+        append_reduce_chunks(object_id)
+        append_shell_particles(object_id)
+
+@lazy_graph('add_boxes')
+def build_add_boxes_graph():
+    add_boxes_GraphBuilder = GraphBuilder()
+    add_boxes_GraphBuilder.dispatch(add_boxes_kernel, sym_boxes, sym_box_num, sym_object_id)
+    return add_boxes_GraphBuilder.compile()
+
+
+def box_desc(center, half_extent, rotation=(0.0, 0.0, 0.0, 1.0), state=STATE_DYNAMIC,
+    friction=(1.0, 1.0), restitution=1.0, velocity=(0.0, 0.0, 0.0), scene=0):
+    # one add_boxes descriptor, rotation is a quaternion (x, y, z, w)
+    desc = np.zeros(box_desc_size, dtype=np.float32)
+    desc[BOX_DESC_CENTER:BOX_DESC_CENTER + 3] = center
+    desc[BOX_DESC_HALF_EXTENT:BOX_DESC_HALF_EXTENT + 3] = half_extent
+    desc[BOX_DESC_ROTATION:BOX_DESC_ROTATION + 4] = rotation
+    desc[BOX_DESC_STATE] = state
+    desc[BOX_DESC_FRICTION:BOX_DESC_FRICTION + 2] = friction
+    desc[BOX_DESC_RESTITUTION] = restitution
+    desc[BOX_DESC_VELOCITY:BOX_DESC_VELOCITY + 3] = velocity
+    desc[BOX_DESC_SCENE] = scene
+    return desc
+
+
+def add_boxes_mock(descs, first_object_id: ti.i32):
+    descs = np.asarray(descs, dtype=np.float32).reshape(-1, box_desc_size)
+    check_scenes(descs[:, BOX_DESC_SCENE])
+    claim_object_ids(first_object_id, len(descs))
+    boxes_np = np.zeros((max_object_num, box_desc_size), dtype=np.float32)
+    boxes_np[:len(descs)] = descs
+    boxes_to_device.from_numpy(boxes_np)
+    run_graph('add_boxes', {
+        'boxes' : boxes_to_device,
+        'box_num' : len(descs),
+        'object_id' : first_object_id
+    })
+    check_capacity_overflow(first_object_id, len(descs))
+    return first_object_id + len(descs)
+# add_boxes graph-------------------------------------------------------
+
+
+# add_mesh graph--------------------------------------------------------
+@ti.kernel
+def add_mesh_kernel(mesh_particles: ti.types.ndarray(field_dim=1), mesh_particle_num: ti.i32,
+    boxes: ti.types.ndarray(field_dim=1), object_id: ti.i32):
+    begin = particle_num[None]
+    size = mesh_particle_num
+    state = ti.cast(boxes[0][BOX_DESC_STATE], ti.i32)
+    if begin + size > max_particle_num:
+        # out of particle storage, add the object as removed and empty
+        capacity_overflow[None] = 1
+        state = STATE_REMOVED
+        size = 0
+    particle_num[None] = begin + size
+
+    center = box_desc_vec3(boxes, 0, BOX_DESC_CENTER)
+    rotation = box_desc_rotation(boxes, 0)
+    for k in range(size):
+        i = begin + k
+        pos = vec3(
+            mesh_particles[k][MESH_PARTICLE_POS],
+            mesh_particles[k][MESH_PARTICLE_POS + 1],
+            mesh_particles[k][MESH_PARTICLE_POS + 2],
+        )
+        grad = vec3(
+            mesh_particles[k][MESH_PARTICLE_SDF_GRAD],
+            mesh_particles[k][MESH_PARTICLE_SDF_GRAD + 1],
+            mesh_particles[k][MESH_PARTICLE_SDF_GRAD + 2],
+        )
+        pos = rotation @ pos + center
+        x[i] = pos
+        x_old[i] = pos
+        v[i] = box_desc_vec3(boxes, 0, BOX_DESC_VELOCITY)
+        store_rest(i, pos, mesh_particles[k][MESH_PARTICLE_SDF], rotation @ grad)
+        particle_object_id[i] = object_id
+
+    # rest extent grows below to the largest offset from rest_Cm per axis
+    init_box_object(
+        object_id, vec3(0.0), rotation, state,
+        vec2(boxes[0][BOX_DESC_FRICTION], boxes[0][BOX_DESC_FRICTION + 1]),
+        boxes[0][BOX_DESC_RESTITUTION],
+        begin, size,
+        ti.cast(boxes[0][BOX_DESC_SCENE], ti.i32)
+    )
+    object_v[object_id] = box_desc_vec3(boxes, 0, BOX_DESC_VELOCITY)
+    object_rest_Cm[object_id] = vec3(0.0)
+    for i in range(begin, begin + size):
+        ti.atomic_add(object_rest_Cm[object_id], x[i])
+    object_rest_Cm[object_id] /= object_mass[object_id]
+    object_Cm[object_id] = object_rest_Cm[object_id]
+    object_rot[object_id] = mat33_identity
+
+    for i in range(begin, begin + size):
+        q = x[i] - object_rest_Cm[object_id]
+        ti.atomic_add(object_rest_inertia[object_id], inertia_term(q))
+        for d in ti.static(range(3)):
+            ti.atomic_max(object_rest_extent[object_id][d], ti.abs(q[d]))
+    # the compact quantum depends on the final extent
+    set_rest_quantum(object_id)
+    for i in range(begin, begin + size):
+        store_rest_q(i, x[i] - object_rest_Cm[object_id])
+
+    append_reduce_chunks(object_id)
+    append_shell_particles(object_id)
+
+@lazy_graph('add_mesh')
+def build_add_mesh_graph():
+    add_mesh_GraphBuilder = GraphBuilder()
+    add_mesh_GraphBuilder.dispatch(
+        add_mesh_kernel, sym_mesh_particles, sym_mesh_particle_num, sym_boxes, sym_object_id
+    )
+    return add_mesh_GraphBuilder.compile()
+
+
+def add_mesh_mock(mesh_particles, desc, object_id: ti.i32):
+    # mesh_particles: (n, mesh_particle_size) rows from mesh_import.mesh_particles,
+    # desc: box_desc with the pose, state and material of the object
+    mesh_particles = np.asarray(mesh_particles, dtype=np.float32).reshape(-1, mesh_particle_size)
+    mesh_np = np.zeros((max_particle_num, mesh_particle_size), dtype=np.float32)
+    mesh_np[:min(len(mesh_particles), max_particle_num)] = mesh_particles[:max_particle_num]
+    mesh_particles_to_device.from_numpy(mesh_np)
+    check_scenes([desc[BOX_DESC_SCENE]])
+    claim_object_ids(object_id, 1)
+    boxes_np = np.zeros((max_object_num, box_desc_size), dtype=np.float32)
+    boxes_np[0] = desc
+    boxes_to_device.from_numpy(boxes_np)
+    run_graph('add_mesh', {
+        'mesh_particles' : mesh_particles_to_device,
+        'mesh_particle_num' : len(mesh_particles),
+        'boxes' : boxes_to_device,
+        'object_id' : object_id
+    })
+    check_capacity_overflow(object_id, 1)
+    return object_id + 1
+# add_mesh graph--------------------------------------------------------
+
+
+# remove graph----------------------------------------------------------
+@ti.kernel
+def remove_object_kernel(object_id: ti.i32):
+    if object_state[object_id] == STATE_STATIC:
+        static_sdf_ready[None] = 0
+    object_state[object_id] = STATE_REMOVED
+    object_sleep[object_id] = 0
+    object_sleep_counter[object_id] = 0
+    object_wake[object_id] = 0
+
+
+@ti.kernel
+def compact_objects(object_num: ti.i32):
+    old_particle_num = particle_num[None]
+
+    for i in range(object_num):
+        if object_state[i] == STATE_REMOVED:
+            object_size[i] = 0
+
+    cursor = 0
+    ti.loop_config(serialize=True)
+    for i in range(object_num):
+        compact_object_begin[i] = cursor
+        cursor += object_size[i]
+    particle_num[None] = cursor
+
+    for i in range(old_particle_num):
+        object_id = particle_object_id[i]
+        if object_state[object_id] != STATE_REMOVED:
+            particle_perm[compact_object_begin[object_id] + i - object_begin[object_id]] = i
+
+    compact_old_particle_num[None] = old_particle_num
+
+    for i in range(object_num):
+        object_begin[i] = compact_object_begin[i]
+
+
+@ti.kernel
+def park_compacted_particles():
+    # the slots freed at the end, once permute_particles read them
+    for i in range(particle_num[None], compact_old_particle_num[None]):
+        x[i] = ti.Vector([1e20, 1e20, 1e20])
+
+
+@ti.kernel
+def permute_particles():
+    # gather every persistent per-particle field through particle_perm
+    n = particle_num[None]
+    for f in ti.static([x, x_old, v]):
+        for i in range(n):
+            permute_vec3[i] = f[particle_perm[i]]
+        for i in range(n):
+            f[i] = permute_vec3[i]
+    if ti.static(rest_storage == 'compact'):
+        for c in ti.static(range(3)):
+            for i in range(n):
+                permute_i32[i] = particle_rest[particle_perm[i]][c]
+            for i in range(n):
+                particle_rest[i][c] = permute_i32[i]
+    else:
+        for f in ti.static([x0, particle_sdf_grad, particle_rest_q]):
+            for i in range(n):
+                permute_vec3[i] = f[particle_perm[i]]
+            for i in range(n):
+                f[i] = permute_vec3[i]
+        for i in range(n):
+            permute_f32[i] = particle_sdf[particle_perm[i]]
+        for i in range(n):
+            particle_sdf[i] = permute_f32[i]
+    for i in range(n):
+        permute_i32[i] = particle_object_id[particle_perm[i]]
+    for i in range(n):
+        particle_object_id[i] = permute_i32[i]
+
+
+@ti.kernel
+def rebuild_object_tables(object_num: ti.i32):
+    reduce_chunk_num[None] = 0
+    shell_particle_num[None] = 0
+    for i in range(object_num):
+        append_reduce_chunks(i)
+        append_shell_particles(i)
+
+@lazy_graph('remove_object')
+def build_remove_object_graph():
+    remove_object_GraphBuilder = GraphBuilder()
+    remove_object_GraphBuilder.dispatch(remove_object_kernel, sym_object_id)
+    return remove_object_GraphBuilder.compile()
+
+@lazy_graph('compact')
+def build_compact_graph():
+    compact_GraphBuilder = GraphBuilder()
+    compact_GraphBuilder.dispatch(compact_objects, sym_total_objects)
+    compact_GraphBuilder.dispatch(permute_particles)
+    compact_GraphBuilder.dispatch(park_compacted_particles)
+    compact_GraphBuilder.dispatch(rebuild_object_tables, sym_total_objects)
+    # the query grid holds particle indices
+    compact_GraphBuilder.dispatch(build_query_grid)
+    return compact_GraphBuilder.compile()
+
+# host side free list of removed object slots
+free_object_ids = []
+
+
+def allocate_object_id(object_num: ti.i32):
+    # reuse a removed slot if there is one, otherwise append at object_num
+    if free_object_ids:
+        return free_object_ids.pop()
+    return object_num
+
+
+def remove_objects_mock(object_ids, object_num: ti.i32):
+    # remove several objects and compact once, returns the new object count
+    for object_id in object_ids:
+        run_graph('remove_object', {'object_id': object_id})
+        free_object_ids.append(object_id)
+        kinematic_poses_np[object_id] = 0.0
+    run_graph('compact', {'total_objects': object_num})
+    # trailing free slots shrink the object count instead of staying in the list
+    while object_num > 0 and object_num - 1 in free_object_ids:
+        free_object_ids.remove(object_num - 1)
+        object_num -= 1
+    return object_num
+
+
+def claim_object_ids(first_object_id: ti.i32, count: ti.i32):
+    # before an add: the slots must exist, and are no longer free however
+    # the caller picked them
+    if first_object_id < 0 or first_object_id + count > max_object_num:
+        raise RuntimeError('object capacity {} exceeded, {} object(s) from id {} were not added '
+            '(set TIOUCH_MAX_OBJECTS)'.format(max_object_num, count, first_object_id))
+    free_object_ids[:] = [i for i in free_object_ids if not first_object_id <= i < first_object_id + count]
+
+
+def check_capacity_overflow(first_object_id: ti.i32, count: ti.i32):
+    # after an add: the rejected objects are empty and removed, free their slots
+    if capacity_overflow[None]:
+        capacity_overflow[None] = 0
+        free_object_ids.extend(range(first_object_id, first_object_id + count))
+        raise RuntimeError('particle capacity {} exceeded, {} object(s) from id {} were not added '
+            '(set TIOUCH_MAX_PARTICLES)'.format(max_particle_num, count, first_object_id))
+# remove graph----------------------------------------------------------
+
+
+# reorder graph---------------------------------------------------------
+@ti.func
+def morton_spread(v):
+    # the low 10 bits of v moved to every third bit
+    v = (v | (v << 16)) & 0x030000FF
+    v = (v | (v << 8)) & 0x0300F00F
+    v = (v | (v << 4)) & 0x030C30C3
+    v = (v | (v << 2)) & 0x09249249
+    return v
+
+
+@ti.kernel
+def compute_reorder_keys():
+    n = particle_num[None]
+    half = 1 << (morton_bits - 1)
+    for i in range(reorder_sort_size):
+        # padding sorts behind every particle
+        key = ti.Vector([2147483647, 0])
+        if i < n:
+            object_id = particle_object_id[i]
+            cell = grid_cell(x[i] - object_Cm[object_id]) + half
+            cell = ti.max(ti.min(cell, 2 * half - 1), 0)
+            key = ti.Vector([
+                object_begin[object_id],
+                morton_spread(cell.x) | (morton_spread(cell.y) << 1) | (morton_spread(cell.z) << 2),
+            ])
+        reorder_key[i] = key
+        reorder_index[i] = i
+
+    size = 1
+    while size < n:
+        size *= 2
+    reorder_size[None] = size
+    reorder_stage[None] = ti.Vector([2, 1])
+
+
+@ti.func
+def bitonic_key_greater(key: ti.template(), index: ti.template(), a, b):
+    ka = key[a]
+    kb = key[b]
+    greater = index[a] > index[b]
+    if ka[0] != kb[0]:
+        greater = ka[0] > kb[0]
+    elif ka[1] != kb[1]:
+        greater = ka[1] > kb[1]
+    return greater
+
+
+@ti.func
+def bitonic_sort_step(key: ti.template(), index: ti.template(), stage: ti.template(), sort_size: ti.template()):
+    # one compare-exchange step (k, j) of the bitonic network over the
+    # (key, index) pairs, steps with k above sort_size are skipped
+    k = stage[None][0]
+    j = stage[None][1]
+    size = sort_size[None]
+    for t in range(ti.select(k <= size, size // 2, 0)):
+        a = ((t & ~(j - 1)) << 1) | (t & (j - 1))
+        b = a + j
+        if bitonic_key_greater(key, index, a, b) == ((a & k) == 0):
+            ka = key[a]
+            ia = index[a]
+            key[a] = key[b]
+            index[a] = index[b]
+            key[b] = ka
+            index[b] = ia
+
+    if j > 1:
+        stage[None][1] = j // 2
+    else:
+        stage[None] = ti.Vector([2 * k, k])
+
+
+@ti.kernel
+def reorder_sort_step():
+    bitonic_sort_step(reorder_key, reorder_index, reorder_stage, reorder_size)
+
+
+@ti.kernel
+def reorder_to_perm():
+    for i in range(particle_num[None]):
+        particle_perm[i] = reorder_index[i]
+
+
+@lazy_graph('reorder')
+def build_reorder_graph():
+    reorder_GraphBuilder = GraphBuilder()
+    reorder_GraphBuilder.dispatch(compute_reorder_keys)
+    for _ in range(reorder_step_num):
+        reorder_GraphBuilder.dispatch(reorder_sort_step)
+    reorder_GraphBuilder.dispatch(reorder_to_perm)
+    reorder_GraphBuilder.dispatch(permute_particles)
+    # the shell list and the query grid hold particle indices
+    reorder_GraphBuilder.dispatch(rebuild_object_tables, sym_total_objects)
+    reorder_GraphBuilder.dispatch(build_query_grid)
+    return reorder_GraphBuilder.compile()
+
+
+def reorder_mock(object_num: ti.i32):
+    run_graph('reorder', {'total_objects': object_num})
+# reorder graph---------------------------------------------------------
+
+
 # update graph----------------------------------------------------------
 @ti.func
 def calc_all_object_cm_A_rot(object_num):
+    # object_num is 0 when a skipped solver iteration calls this
+    chunk_num = ti.select(object_num > 0, reduce_chunk_num[None], 0)
+
+    for c in range(chunk_num):
+        object_id = reduce_chunk_object[c]
+        if not object_is_active(object_id):
+            continue
+        chunk_end = ti.min(
+            reduce_chunk_begin[c] + reduce_chunk_size,
+            object_begin[object_id] + object_size[object_id],
+        )
+        cm = vec3(0.0)
+        for i in range(reduce_chunk_begin[c], chunk_end):
+            # cm += 1.0 / inv_m[i] * x[i]
+            cm += 1.0 * x[i]
+        reduce_chunk_cm[c] = cm
+
+    for i in range(object_num):
+        if not object_is_active(i):
+            continue
+        cm = vec3(0.0)
+        for c in range(object_chunk_begin[i], object_chunk_begin[i] + object_chunk_num[i]):
+            cm += reduce_chunk_cm[c]
+        object_Cm[i] = cm / object_mass[i]
+        object_sweep[i] = 0.0
+
+    for c in range(chunk_num):
+        # A
+        object_id = reduce_chunk_object[c]
+        if not object_is_active(object_id):
+            continue
+        chunk_end = ti.min(
+            reduce_chunk_begin[c] + reduce_chunk_size,
+            object_begin[object_id] + object_size[object_id],
+        )
+        A = mat33(0.0)
+        for i in range(reduce_chunk_begin[c], chunk_end):
+            p = x[i] - object_Cm[object_id]
+            # A += 1.0 / inv_m[i] * p @ q.transpose()
+            A += 1.0 * p.outer_product(rest_q(i, object_id))
+        reduce_chunk_A[c] = A
+
+    for i in range(object_num):
+        if not object_is_active(i):
+            continue
+        A = mat33(0.0)
+        for c in range(object_chunk_begin[i], object_chunk_begin[i] + object_chunk_num[i]):
+            A += reduce_chunk_A[c]
+        object_A[i] = A
+        # rot
+        extract_rotation(i)
+
+
+# one atomic per particle into its object's slot, kept as the reference
+# for scripts/benchmark_reduction.py
+@ti.func
+def calc_all_object_cm_A_rot_atomic(object_num):
     part_num = particle_num[None]
     for i in range(object_num):
         object_Cm[i] = vec3(0.0)
@@ -301,11 +1891,12 @@ def calc_all_object_cm_A_rot(object_num):
 
     for i in range(object_num):
         object_Cm[i] /= object_mass[i]
+        object_sweep[i] = 0.0
 
     for i in range(part_num):
         # A
         object_id = particle_object_id[i]
-        q = x0[i] - object_rest_Cm[object_id]
+        q = rest_q(i, object_id)
         p = x[i] - object_Cm[object_id]
         ti.atomic_add(
             # object_A[object_id], 1.0 / inv_m[i] * p @ q.transpose()
@@ -314,181 +1905,1002 @@ def calc_all_object_cm_A_rot(object_num):
 
     for i in range(object_num):
         # rot
-        object_rot[i], S = ti.polar_decompose(object_A[i])
-        if all(abs(object_rot[i]) < eps):
-            object_rot[i] = ti.Matrix.identity(ti.f32, 3)
+        extract_rotation(i)
+
+@ti.kernel
+def calc_all_object_cm_A_rot_kernel(object_num: ti.i32):
+    calc_all_object_cm_A_rot(object_num)
+
+@ti.kernel
+def calc_all_object_cm_A_rot_atomic_kernel(object_num: ti.i32):
+    calc_all_object_cm_A_rot_atomic(object_num)
+
+@ti.func
+def object_is_active(object_id):
+    return object_state[object_id] == STATE_DYNAMIC and object_sleep[object_id] == 0
+
+
+@ti.func
+def kinematic_wakes(k, other):
+    # kinematic object k moved this frame next to the sleeping object other
+    return (
+        object_state[k] == STATE_KINIMATIC
+        and object_sweep[k] > 0.0
+        and object_sleep[other] == 1
+    )
+
+
+@ti.func
+def scene_value(object_id, table: ti.template(), default):
+    # per-scene parameter of the object's scene, default unless set_scenes gave one
+    value = default
+    s = object_scene[object_id]
+    if scene_override[s]:
+        value = table[s]
+    return value
+
+
+@ti.kernel
+def apply_kinematic_poses(object_num: ti.i32, kinematic_poses: ti.types.ndarray(field_dim=1), h: ti.f32):
+    for i in range(object_num):
+        if object_state[i] == STATE_KINIMATIC:
+            q = ti.Vector([kinematic_poses[i][KINEMATIC_POSE_ROTATION + d] for d in ti.static(range(4))])
+            object_sweep[i] = 0.0
+            if q.norm() > eps:
+                object_Cm[i] = vec3(
+                    kinematic_poses[i][KINEMATIC_POSE_POSITION],
+                    kinematic_poses[i][KINEMATIC_POSE_POSITION + 1],
+                    kinematic_poses[i][KINEMATIC_POSE_POSITION + 2],
+                )
+                object_rot[i] = quat_to_mat33(q.normalized())
+
+    for c in range(reduce_chunk_num[None]):
+        object_id = reduce_chunk_object[c]
+        q = ti.Vector([kinematic_poses[object_id][KINEMATIC_POSE_ROTATION + d] for d in ti.static(range(4))])
+        if object_id < object_num and object_state[object_id] == STATE_KINIMATIC and q.norm() > eps:
+            chunk_end = ti.min(
+                reduce_chunk_begin[c] + reduce_chunk_size,
+                object_begin[object_id] + object_size[object_id],
+            )
+            for i in range(reduce_chunk_begin[c], chunk_end):
+                x_old[i] = x[i]
+                x[i] = object_Cm[object_id] + object_rot[object_id] @ rest_q(i, object_id)
+                v[i] = (x[i] - x_old[i]) / h
+                ti.atomic_max(object_sweep[object_id], (x[i] - x_old[i]).norm())
+
+
+@ti.kernel
+def build_active_particles(object_num: ti.i32):
+    # objects woken by a contact start again from rest
+    for c in range(reduce_chunk_num[None]):
+        object_id = reduce_chunk_object[c]
+        if object_wake[object_id] and object_sleep[object_id]:
+            chunk_end = ti.min(
+                reduce_chunk_begin[c] + reduce_chunk_size,
+                object_begin[object_id] + object_size[object_id],
+            )
+            for i in range(reduce_chunk_begin[c], chunk_end):
+                v[i] = vec3(0.0)
+
+    for i in range(object_num):
+        if object_wake[i]:
+            if object_sleep[i]:
+                object_v[i] = vec3(0.0)
+                object_omega[i] = vec3(0.0)
+            object_sleep[i] = 0
+            object_sleep_counter[i] = 0
+            object_wake[i] = 0
+
+    active_particle_num[None] = 0
+    ti.loop_config(serialize=True)
+    for i in range(object_num):
+        object_active_begin[i] = active_particle_num[None]
+        if object_is_active(i):
+            if ti.static(solver_body_model == 'rigid'):
+                active_particle_num[None] += object_shell_size[i]
+            else:
+                active_particle_num[None] += object_size[i]
+
+    if ti.static(solver_body_model == 'rigid'):
+        # the rigid body model only places the shell particles
+        for k in range(shell_particle_num[None]):
+            i = shell_particle[k]
+            object_id = particle_object_id[i]
+            if object_is_active(object_id):
+                active_particle[object_active_begin[object_id] + k - object_shell_begin[object_id]] = i
+    else:
+        for c in range(reduce_chunk_num[None]):
+            object_id = reduce_chunk_object[c]
+            if object_is_active(object_id):
+                chunk_end = ti.min(
+                    reduce_chunk_begin[c] + reduce_chunk_size,
+                    object_begin[object_id] + object_size[object_id],
+                )
+                for i in range(reduce_chunk_begin[c], chunk_end):
+                    active_particle[object_active_begin[object_id] + i - object_begin[object_id]] = i
+
 
 @ti.kernel
 def semi_euler(h: ti.f32):
+    solver_iter[None] = 0
+    solver_residual[None] = inf
     gravity = ti.Vector([0.0, -9.8, 0.0])
-    for i in range(particle_num[None]):
-        if object_state[particle_object_id[i]] == STATE_STATIC:
-            continue
+    for k in range(active_particle_num[None]):
+        i = active_particle[k]
         v[i] += h * gravity
         x_old[i] = x[i]
         x[i] += h * v[i]
+        ti.atomic_max(object_sweep[particle_object_id[i]], h * v[i].norm())
 
 
-@ti.kernel
-def solve_constraints( object_num: ti.i32, corr_rate: ti.f32):
-    part_num = particle_num[None]
+@ti.func
+def rotate_quaternion(q, theta):
+    # q turned by the rotation vector theta, first order
+    dq = quat_mul(ti.Vector([theta.x, theta.y, theta.z, 0.0]), q)
+    return (q + 0.5 * dq).normalized()
 
-    for i in range(part_num):
-        delta_x[i] = vec3(0.0)
 
-    for i in range(part_num):
+@ti.func
+def object_angular_change(object_id, L):
+    # I^-1 L with the inertia of the object's pose, 0 when it is degenerate
+    rot = object_rot[object_id]
+    inertia = rot @ object_rest_inertia[object_id] @ rot.transpose()
+    omega = vec3(0.0)
+    if ti.abs(inertia.determinant()) > eps:
+        omega = inertia.inverse() @ L
+    return omega
 
-        if object_state[particle_object_id[i]] == STATE_STATIC:
-            continue
 
-        for j in range(part_num):
-            if particle_object_id[i] != particle_object_id[j]:
-                pij = x[i] - x[j]
-                pij_ = pij.norm()
+@ti.func
+def posed_particle(i):
+    object_id = particle_object_id[i]
+    return object_Cm[object_id] + object_rot[object_id] @ rest_q(i, object_id)
 
-                # if pij_ < particle_diameter or pij_ < ti.abs(
-                if pij_ < particle_radius or pij_ < ti.abs(particle_sdf[i]) + ti.abs(particle_sdf[j]):
-                    # if pij_ < particle_diameter or pij_ < ti.max(ti.abs(particle_sdf[i]), ti.abs(particle_sdf[j])):
 
-                    nij = vec3(0.0)
-                    d = 0.0
+@ti.func
+def pose_active_particles(active_num):
+    for k in range(active_num):
+        i = active_particle[k]
+        x[i] = posed_particle(i)
 
-                    nij = pij
-                    d = pij_ - (
-                        ti.abs(particle_sdf[i]) + ti.abs(particle_sdf[j])
-                    )
 
-                    new_nij = nij
-                    # boundary particles ???
-                    if -particle_sdf[i] < eps and -particle_sdf[j] < eps:
-                        if pij.dot(nij) < 0.0:
-                            new_nij = pij - 2 * pij.dot(nij) * nij
-                        else:
-                            new_nij = pij
-                        d = pij_ - particle_diameter
-
-                    delta_x[i] += -0.5 * d * new_nij / (new_nij.norm() + 0.1)
-
-                    if (
-                        -particle_sdf[i] < eps
-                        and -particle_sdf[j] < eps
-                        and pij.dot(nij) >= 0.0
-                    ):
-                        p = delta_x[i]
-                        vel = p
-                        n = -pij
-                        vn = n.dot(vel) * n
-                        vt = vel - vn
-                        stress = d * 1.0
-                        mu_s_i = object_friction_factor[
-                            particle_object_id[i]
-                        ][0]
-                        mu_k_i = object_friction_factor[
-                            particle_object_id[i]
-                        ][1]
-                        mu_s_j = object_friction_factor[
-                            particle_object_id[j]
-                        ][0]
-                        mu_k_j = object_friction_factor[
-                            particle_object_id[j]
-                        ][1]
-                        if vt.norm() < stress * mu_s_i * mu_s_j:
-                            p -= vt
-                        else:
-                            delta = vt * ti.min(
-                                stress * mu_k_i * mu_k_j / vt.norm(), 1.0
-                            )
-                            p -= delta
-                        delta_x[i] = p
+@ti.func
+def project_particles_to_objects(object_num):
+    # rigid body model: what moved an active particle off its pose moves its
+    # object. Each push becomes the impulse that moves its particle by that
+    # much (push / w, w the inverse mass of the object at that point along the
+    # push), and the impulses of one object are averaged, Jacobi style.
+    active_num = solver_iteration_range(active_particle_num[None])
+    obj_num = solver_iteration_range(object_num)
+    for i in range(obj_num):
+        object_inv_inertia[i] = mat33(0.0)
+        rot = object_rot[i]
+        inertia = rot @ object_rest_inertia[i] @ rot.transpose()
+        if ti.abs(inertia.determinant()) > eps:
+            object_inv_inertia[i] = inertia.inverse()
+
+    for k in range(active_num):
+        i = active_particle[k]
+        object_id = particle_object_id[i]
+        pose = posed_particle(i)
+        push = x[i] - pose
+        if push.norm_sqr() > 0.0:
+            r = pose - object_Cm[object_id]
+            rn = r.cross(push.normalized())
+            w = 1.0 / object_mass[object_id] + rn.dot(object_inv_inertia[object_id] @ rn)
+            ti.atomic_add(object_correction[object_id], push / w)
+            ti.atomic_add(object_angular_correction[object_id], r.cross(push / w))
+            ti.atomic_add(object_correction_count[object_id], 1)
+
+    for i in range(obj_num):
+        n = object_correction_count[i]
+        if object_is_active(i) and n > 0:
+            move = object_correction[i] / (n * object_mass[i])
+            theta = object_inv_inertia[i] @ object_angular_correction[i] / n
+            object_Cm[i] += move
+            object_rot_q[i] = rotate_quaternion(object_rot_q[i], theta)
+            object_rot[i] = quat_to_mat33(object_rot_q[i])
+            update_solver_residual(move.norm() + theta.norm() * object_rest_extent[i].norm())
+        object_correction[i] = vec3(0.0)
+        object_angular_correction[i] = vec3(0.0)
+        object_correction_count[i] = 0
+
+    pose_active_particles(active_num)
 
-    for i in range(part_num):
+
+@ti.kernel
+def integrate_objects(object_num: ti.i32, h: ti.f32):
+    # semi_euler of the rigid body model
+    solver_iter[None] = 0
+    solver_residual[None] = inf
+    gravity = ti.Vector([0.0, -9.8, 0.0])
+    for i in range(object_num):
+        if object_is_active(i):
+            object_v[i] += h * gravity
+            object_Cm_old[i] = object_Cm[i]
+            object_rot_q_old[i] = object_rot_q[i]
+            object_Cm[i] += h * object_v[i]
+            object_rot_q[i] = rotate_quaternion(object_rot_q[i], h * object_omega[i])
+            object_rot[i] = quat_to_mat33(object_rot_q[i])
+            object_sweep[i] = 0.0
+
+    for k in range(active_particle_num[None]):
+        i = active_particle[k]
+        x_old[i] = x[i]
+    pose_active_particles(active_particle_num[None])
+
+
+@ti.kernel
+def project_particles(object_num: ti.i32):
+    project_particles_to_objects(object_num)
+
+
+@ti.func
+def solve_contact_pair(i, j):
+    # returns the penetration depth, negative when i and j do not touch
+    penetration = -1.0
+    pij = x[i] - x[j]
+    pij_ = pij.norm()
+    sdf_i = rest_sdf(i)
+    sdf_j = rest_sdf(j)
+
+    # if pij_ < particle_diameter or pij_ < ti.abs(
+    if pij_ < particle_radius or pij_ < ti.abs(sdf_i) + ti.abs(sdf_j):
+        # if pij_ < particle_diameter or pij_ < ti.max(ti.abs(particle_sdf[i]), ti.abs(particle_sdf[j])):
+
+        nij = vec3(0.0)
+        d = 0.0
+
+        nij = pij
+        d = pij_ - (
+            ti.abs(sdf_i) + ti.abs(sdf_j)
+        )
+
+        new_nij = nij
+        # boundary particles ???
+        if -sdf_i < eps and -sdf_j < eps:
+            if pij.dot(nij) < 0.0:
+                new_nij = pij - 2 * pij.dot(nij) * nij
+            else:
+                new_nij = pij
+            d = pij_ - particle_diameter
+        penetration = ti.max(-d, 0.0)
+
+        delta_x[i] += -0.5 * d * new_nij / (new_nij.norm() + 0.1)
+
+        if (
+            -sdf_i < eps
+            and -sdf_j < eps
+            and pij.dot(nij) >= 0.0
+        ):
+            p = delta_x[i]
+            vel = p
+            n = -pij
+            vn = n.dot(vel) * n
+            vt = vel - vn
+            stress = d * 1.0
+            mu_s_i = object_friction_factor[
+                particle_object_id[i]
+            ][0]
+            mu_k_i = object_friction_factor[
+                particle_object_id[i]
+            ][1]
+            mu_s_j = object_friction_factor[
+                particle_object_id[j]
+            ][0]
+            mu_k_j = object_friction_factor[
+                particle_object_id[j]
+            ][1]
+            if vt.norm() < stress * mu_s_i * mu_s_j:
+                p -= vt
+            else:
+                delta = vt * ti.min(
+                    stress * mu_k_i * mu_k_j / vt.norm(), 1.0
+                )
+                p -= delta
+            delta_x[i] = p
+    return penetration
+
+
+@ti.func
+def apply_delta(active_num):
+    for k in range(active_num):
+        i = active_particle[k]
         x[i] += delta_x[i]
 
+
+@ti.func
+def apply_delta_and_shape_matching(object_num, corr_rate, delta_applied: ti.template()):
+    # delta_applied: the contact pass already moved the particles by delta_x
+    active_num = solver_iteration_range(active_particle_num[None])
+
+    if ti.static(not delta_applied):
+        apply_delta(active_num)
+
     # TODO: error here!!!
-    calc_all_object_cm_A_rot(object_num)
+    calc_all_object_cm_A_rot(solver_iteration_range(object_num))
 
-    for i in range(part_num):
+    for k in range(active_num):
+        i = active_particle[k]
         obj_id = particle_object_id[i]
-        goal = object_Cm[obj_id] + object_rot[obj_id] @ (
-            x0[i] - object_rest_Cm[obj_id]
-        )
+        goal = object_Cm[obj_id] + object_rot[obj_id] @ rest_q(i, obj_id)
         # corr = (goal - x[i]) * 0.8
-        corr = (goal - x[i]) * corr_rate
+        corr = (goal - x[i]) * scene_value(obj_id, scene_corr_rate, corr_rate)
         x[i] += corr
+        update_solver_residual((delta_x[i] + corr).norm())
+
+
+@ti.func
+def solver_iteration_range(n):
+    return n * solver_running[None]
+
+
+@ti.func
+def update_solver_residual(r):
+    if r > solver_residual[None]:
+        ti.atomic_max(solver_residual[None], r)
 
 
 @ti.kernel
-def collision_response( boundary_box: ti.types.ndarray()):
-    for i in range(particle_num[None]):
-        if object_state[particle_object_id[i]] == STATE_STATIC:
+def begin_solver_iteration(iterations: ti.i32, tolerance: ti.f32):
+    solver_running[None] = 0
+    if solver_iter[None] < iterations and solver_residual[None] >= tolerance:
+        solver_running[None] = 1
+        solver_iter[None] += 1
+        solver_residual[None] = 0.0
+
+
+@ti.func
+def grid_cell(p):
+    return ti.cast(ti.floor(p / grid_cell_size), ti.i32)
+
+
+@ti.func
+def grid_hash(cell, scene):
+    h = (cell.x * 73856093) ^ (cell.y * 19349663) ^ (cell.z * 83492791) ^ (scene * 50331653)
+    return h % grid_table_size
+
+
+@ti.func
+def object_pair_home(a, b):
+    return ((a * 73856093) ^ (b * 19349663)) & object_pair_table_mask[None]
+
+
+@ti.func
+def insert_object_pair(a, b):
+    # lock free linear probing: a slot only ever takes a larger key, the
+    # key it held probes on from the next slot
+    h = object_pair_home(a, b)
+    key = a * max_object_num + b
+    for n in range(object_pair_table_mask[None] + 1):
+        key = ti.min(ti.atomic_max(object_pair_table[(h + n) & object_pair_table_mask[None]], key), key)
+        if key < 0:
+            break
+
+
+@ti.func
+def find_object_pair(obj_i, obj_j):
+    # slot of the overlapping pair of two objects in object_pair_table, -1
+    # if they do not overlap
+    a = ti.min(obj_i, obj_j)
+    b = ti.max(obj_i, obj_j)
+    key = a * max_object_num + b
+    slot = -1
+    h = object_pair_home(a, b)
+    for n in range(object_pair_table_mask[None] + 1):
+        s = (h + n) & object_pair_table_mask[None]
+        if object_pair_table[s] == key:
+            slot = s
+            break
+        if object_pair_table[s] < 0:
+            break
+    return slot
+
+
+@ti.func
+def object_aabb(i):
+    half = ti.abs(object_rot[i]) @ object_rest_extent[i] + particle_diameter + object_sweep[i]
+    lower = object_Cm[i] - half
+    upper = object_Cm[i] + half
+    if object_state[i] == STATE_REMOVED:
+        # empty box, sorts last and overlaps nothing
+        lower = vec3(inf)
+        upper = vec3(-inf)
+    return lower, upper
+
+
+@ti.func
+def float_order_bits(f):
+    # i32 with the order of the f32 f
+    bits = ti.bit_cast(f, ti.i32)
+    if bits < 0:
+        bits ^= 0x7FFFFFFF
+    return bits
+
+
+@ti.kernel
+def compute_object_sort_keys(object_num: ti.i32):
+    # once per frame: group the objects by scene, in each scene by
+    # aabb_min.x, for the sweep of every solver iteration
+    for s in range(max_scene_num):
+        scene_object_count[s] = 0
+    for i in range(object_sap_sort_size):
+        # padding sorts behind every object
+        key = ti.Vector([2147483647, 0])
+        if i < object_num:
+            lower, _ = object_aabb(i)
+            object_sap_min_x[i] = lower.x
+            key = ti.Vector([object_scene[i], float_order_bits(lower.x)])
+            ti.atomic_add(scene_object_count[object_scene[i]], 1)
+        object_sap_key[i] = key
+        object_sap_order[i] = i
+
+    cursor = 0
+    ti.loop_config(serialize=True)
+    for s in range(max_scene_num):
+        scene_object_begin[s] = cursor
+        cursor += scene_object_count[s]
+
+    size = 1
+    while size < object_num:
+        size *= 2
+    object_sap_size[None] = size
+    object_sap_stage[None] = ti.Vector([2, 1])
+
+
+@ti.kernel
+def object_sort_step():
+    bitonic_sort_step(object_sap_key, object_sap_order, object_sap_stage, object_sap_size)
+
+
+def sort_objects(object_num: ti.i32):
+    # the object sort of the update graph, for callers of build_object_pairs
+    # outside of it
+    compute_object_sort_keys(object_num)
+    for _ in range(object_sap_step_num):
+        object_sort_step()
+
+
+@ti.kernel
+def build_object_pairs(object_num: ti.i32):
+    shell_num = solver_iteration_range(shell_particle_num[None])
+    obj_num = solver_iteration_range(object_num)
+
+    if solver_running[None]:
+        object_pair_num[None] = 0
+        contact_particle_num[None] = 0
+        object_sap_slack[None] = 0.0
+
+    for i in range(obj_num):
+        lower, upper = object_aabb(i)
+        object_aabb_min[i] = lower
+        object_aabb_max[i] = upper
+        if object_state[i] != STATE_REMOVED:
+            ti.atomic_max(object_sap_slack[None], object_sap_min_x[i] - lower.x)
+        object_contact_flag[i] = 0
+
+    # sweep in the order of compute_object_sort_keys: no aabb_min.x fell more
+    # than the slack since, so once a sorted min x less the slack passes
+    # aabb_max.x of a, no later object of the scene overlaps a
+    for r in range(obj_num):
+        a = object_sap_order[r]
+        scene_end = scene_object_begin[object_scene[a]] + scene_object_count[object_scene[a]]
+        for s in range(r + 1, scene_end):
+            b = object_sap_order[s]
+            if object_sap_min_x[b] - object_sap_slack[None] > object_aabb_max[a].x:
+                break
+            if not object_is_active(a) and not object_is_active(b):
+                if not kinematic_wakes(a, b) and not kinematic_wakes(b, a):
+                    continue
+            if in_static_sdf(a) or in_static_sdf(b):
+                continue
+            if (
+                object_aabb_min[b].x <= object_aabb_max[a].x
+                and object_aabb_min[a].x <= object_aabb_max[b].x
+                and object_aabb_min[b].y <= object_aabb_max[a].y
+                and object_aabb_min[a].y <= object_aabb_max[b].y
+                and object_aabb_min[b].z <= object_aabb_max[a].z
+                and object_aabb_min[a].z <= object_aabb_max[b].z
+            ):
+                slot = ti.atomic_add(object_pair_num[None], 1)
+                if slot < max_object_pair_num:
+                    object_pair[slot] = ti.Vector([ti.min(a, b), ti.max(a, b)])
+                    object_contact_flag[a] = 1
+                    object_contact_flag[b] = 1
+                    if kinematic_wakes(a, b):
+                        object_wake[b] = 1
+                    if kinematic_wakes(b, a):
+                        object_wake[a] = 1
+                else:
+                    object_pair_overflow[None] = 1
+
+    pair_num = solver_iteration_range(ti.min(object_pair_num[None], max_object_pair_num))
+    if solver_running[None]:
+        table_size = 1
+        while table_size < 2 * pair_num + 1:
+            table_size *= 2
+        object_pair_table_mask[None] = table_size - 1
+    for s in range(solver_iteration_range(object_pair_table_mask[None] + 1)):
+        object_pair_table[s] = -1
+    for k in range(pair_num):
+        insert_object_pair(object_pair[k][0], object_pair[k][1])
+
+    # shell particles of flagged objects, laid out object by object
+    ti.loop_config(serialize=True)
+    for i in range(obj_num):
+        object_contact_begin[i] = contact_particle_num[None]
+        if object_contact_flag[i]:
+            contact_particle_num[None] += object_shell_size[i]
+
+    for k in range(shell_num):
+        i = shell_particle[k]
+        obj_id = particle_object_id[i]
+        if object_contact_flag[obj_id]:
+            contact_particle[object_contact_begin[obj_id] + k - object_shell_begin[obj_id]] = i
+
+
+@ti.func
+def fill_grid(enabled):
+    # hash every particle of contact_particle into the grid, enabled is 0 or 1
+    table_size = enabled * grid_table_size
+    block_num = enabled * grid_block_num
+    contact_num = enabled * contact_particle_num[None]
+
+    for h in range(table_size):
+        grid_count[h] = 0
+
+    for k in range(contact_num):
+        i = contact_particle[k]
+        cell = grid_cell(x[i])
+        h = grid_hash(cell, object_scene[particle_object_id[i]])
+        particle_cell[i] = cell
+        particle_hash[i] = h
+        ti.atomic_add(grid_count[h], 1)
+
+    # exclusive prefix sum of grid_count: block-local sums, a serial scan
+    # over the blocks, then per-block scans offset by the block prefix
+    for b in range(block_num):
+        block_sum = 0
+        for h in range(b * grid_block_size, ti.min((b + 1) * grid_block_size, grid_table_size)):
+            block_sum += grid_count[h]
+        grid_block_sum[b] = block_sum
+
+    ti.loop_config(serialize=True)
+    for b in range(1, block_num):
+        grid_block_sum[b] += grid_block_sum[b - 1]
+
+    for b in range(block_num):
+        cursor = 0
+        if b > 0:
+            cursor = grid_block_sum[b - 1]
+        for h in range(b * grid_block_size, ti.min((b + 1) * grid_block_size, grid_table_size)):
+            grid_end[h] = cursor
+            cursor += grid_count[h]
+
+    # scatter, afterwards grid_end[h] points one past the last particle of h
+    for k in range(contact_num):
+        i = contact_particle[k]
+        slot = ti.atomic_add(grid_end[particle_hash[i]], 1)
+        grid_particle[slot] = i
+
+
+@ti.kernel
+def build_grid():
+    fill_grid(solver_running[None])
+
+
+@ti.kernel
+def build_query_grid():
+    # every live shell particle, so queries after the step see all objects
+    contact_particle_num[None] = 0
+    for k in range(shell_particle_num[None]):
+        i = shell_particle[k]
+        if object_state[particle_object_id[i]] != STATE_REMOVED:
+            contact_particle[ti.atomic_add(contact_particle_num[None], 1)] = i
+    fill_grid(1)
+
+
+@ti.kernel
+def apply_haptic_impulse(object_num: ti.i32):
+    # reaction of the haptic queries since the last update, as a velocity change
+    if ti.static(solver_body_model == 'rigid'):
+        for i in range(object_num):
+            if object_is_active(i):
+                object_v[i] += object_haptic_impulse[i] / object_mass[i]
+                object_omega[i] += object_angular_change(i, object_haptic_angular_impulse[i])
+    else:
+        for k in range(active_particle_num[None]):
+            i = active_particle[k]
+            object_id = particle_object_id[i]
+            J = object_haptic_impulse[object_id]
+            L = object_haptic_angular_impulse[object_id]
+            if J.norm_sqr() + L.norm_sqr() > 0.0:
+                omega = object_angular_change(object_id, L)
+                v[i] += J / object_mass[object_id] + omega.cross(x[i] - object_Cm[object_id])
+
+    for i in range(object_num):
+        object_haptic_impulse[i] = vec3(0.0)
+        object_haptic_angular_impulse[i] = vec3(0.0)
+
+
+@ti.kernel
+def begin_contact_output(object_num: ti.i32, h: ti.f32):
+    contact_output_h[None] = h
+    for i in range(object_num):
+        object_contact_correction[i] = vec3(0.0)
+        object_contact_angular_correction[i] = vec3(0.0)
+        object_contact_count[i] = 0
+
+
+@ti.func
+def begin_iteration_contact_count(object_num):
+    if ti.static(contact_output_enabled):
+        for i in range(solver_iteration_range(object_num)):
+            object_contact_count[i] = 0
+
+
+@ti.func
+def add_contact_correction(i, correction):
+    object_id = particle_object_id[i]
+    ti.atomic_add(object_contact_correction[object_id], correction)
+    ti.atomic_add(object_contact_angular_correction[object_id],
+        (x[i] - object_Cm[object_id]).cross(correction))
+
+
+@ti.func
+def add_contact_reaction(j, obj_j, push, penetration):
+    # objects that are not solved get the reaction of the push particle j gave
+    if penetration >= 0.0 and not object_is_active(obj_j):
+        add_contact_correction(j, -push)
+        ti.atomic_add(object_contact_count[obj_j], 1)
+
+
+@ti.func
+def accumulate_contact_output(active_num):
+    # delta_x of this iteration's contact pass into the contact output
+    if ti.static(contact_output_enabled):
+        for k in range(active_num):
+            i = active_particle[k]
+            if delta_x[i].norm_sqr() > 0.0:
+                add_contact_correction(i, delta_x[i])
+
+
+@ti.func
+def collect_contacts(i, obj_i):
+    # delta_x[i] from the grid neighbours of i, returns how many it touches
+    contact_num = 0
+    # neighbours of other objects mostly come from one partner, look its
+    # pair up again only when the partner changes
+    last_obj = -1
+    pair_slot = -1
+    for offset in ti.grouped(ti.ndrange((-1, 2), (-1, 2), (-1, 2))):
+        cell = particle_cell[i] + offset
+        h = grid_hash(cell, object_scene[obj_i])
+        for k in range(grid_end[h] - grid_count[h], grid_end[h]):
+            j = grid_particle[k]
+            obj_j = particle_object_id[j]
+            # skip hash collisions with other cells
+            if obj_j == obj_i or any(particle_cell[j] != cell):
+                continue
+            if obj_j != last_obj:
+                last_obj = obj_j
+                pair_slot = find_object_pair(obj_i, obj_j)
+            if pair_slot >= 0:
+                before = delta_x[i]
+                penetration = solve_contact_pair(i, j)
+                if penetration >= 0.0:
+                    contact_num += 1
+                if ti.static(contact_output_enabled):
+                    add_contact_reaction(j, obj_j, delta_x[i] - before, penetration)
+                if object_sleep[obj_j]:
+                    object_wake[obj_j] = 1
+    return contact_num
+
+
+@ti.func
+def grid_cell_color(cell):
+    return (cell.x & 1) | ((cell.y & 1) << 1) | ((cell.z & 1) << 2)
+
+
+@ti.func
+def solve_contacts_colored():
+    contact_num = solver_iteration_range(contact_particle_num[None])
+    if solver_running[None]:
+        grid_slot_num[None] = 0
+    for k in range(contact_num):
+        h = particle_hash[grid_particle[k]]
+        if k == grid_end[h] - grid_count[h]:
+            grid_slot[ti.atomic_add(grid_slot_num[None], 1)] = h
+
+    slot_num = solver_iteration_range(grid_slot_num[None])
+    for color in ti.static(range(8)):
+        for s in range(slot_num):
+            h = grid_slot[s]
+            for k in range(grid_end[h] - grid_count[h], grid_end[h]):
+                i = grid_particle[k]
+                obj_i = particle_object_id[i]
+                if grid_cell_color(particle_cell[i]) == color and object_is_active(obj_i):
+                    contact_num = collect_contacts(i, obj_i)
+                    if ti.static(contact_output_enabled):
+                        ti.atomic_add(object_contact_count[obj_i], contact_num)
+                    x[i] += delta_x[i]
+
+
+@ti.kernel
+def solve_constraints( object_num: ti.i32, corr_rate: ti.f32):
+    for k in range(solver_iteration_range(active_particle_num[None])):
+        delta_x[active_particle[k]] = vec3(0.0)
+    begin_iteration_contact_count(object_num)
+
+    if ti.static(contact_schedule == 'colored'):
+        solve_contacts_colored()
+    else:
+        for n in range(solver_iteration_range(contact_particle_num[None])):
+            i = contact_particle[n]
+            obj_i = particle_object_id[i]
+
+            if not object_is_active(obj_i):
+                continue
+
+            contact_num = collect_contacts(i, obj_i)
+            if ti.static(contact_output_enabled):
+                ti.atomic_add(object_contact_count[obj_i], contact_num)
+            if ti.static(contact_schedule == 'jacobi_sor'):
+                if contact_num > 0:
+                    delta_x[i] *= contact_sor / contact_num
+
+    accumulate_contact_output(solver_iteration_range(active_particle_num[None]))
+    delta_applied = ti.static(contact_schedule == 'colored')
+    if ti.static(solver_body_model == 'rigid'):
+        # project_particles moves the objects after collision_response
+        if ti.static(not delta_applied):
+            apply_delta(solver_iteration_range(active_particle_num[None]))
+    else:
+        apply_delta_and_shape_matching(object_num, corr_rate, delta_applied)
+
+
+@ti.kernel
+def solve_constraints_all_pairs( object_num: ti.i32, corr_rate: ti.f32):
+    part_num = solver_iteration_range(particle_num[None])
+
+    for i in range(part_num):
+        delta_x[i] = vec3(0.0)
+    begin_iteration_contact_count(object_num)
+
+    for i in range(part_num):
+
+        if not object_is_active(particle_object_id[i]):
             continue
+
+        for j in range(part_num):
+            if in_static_sdf(particle_object_id[j]):
+                continue
+            if object_scene[particle_object_id[i]] != object_scene[particle_object_id[j]]:
+                continue
+            if particle_object_id[i] != particle_object_id[j]:
+                before = delta_x[i]
+                penetration = solve_contact_pair(i, j)
+                if ti.static(contact_output_enabled):
+                    if penetration >= 0.0:
+                        ti.atomic_add(object_contact_count[particle_object_id[i]], 1)
+                    add_contact_reaction(j, particle_object_id[j], delta_x[i] - before, penetration)
+                if object_sleep[particle_object_id[j]]:
+                    object_wake[particle_object_id[j]] = 1
+
+    accumulate_contact_output(solver_iteration_range(active_particle_num[None]))
+    if ti.static(solver_body_model == 'rigid'):
+        apply_delta(solver_iteration_range(active_particle_num[None]))
+    else:
+        apply_delta_and_shape_matching(object_num, corr_rate, False)
+
+
+@ti.func
+def resolve_surface_contact(i, p, collision_normal, stress):
+    # move particle i to p on a static surface with friction
+    vel = p - x_old[i]
+    vn = collision_normal.dot(vel) * collision_normal
+    vt = vel - vn
+    mu_s = object_friction_factor[particle_object_id[i]][0]
+    mu_k = object_friction_factor[particle_object_id[i]][1]
+    if vt.norm() < stress * mu_s:
+        p -= vt
+    else:
+        delta = vt * ti.min(stress * mu_k / vt.norm(), 1.0)
+        p -= delta
+    v[i] -= (
+        1.0 + object_restitution[particle_object_id[i]]
+    ) * vn
+    update_solver_residual((p - x[i]).norm())
+    if ti.static(contact_output_enabled):
+        add_contact_correction(i, p - x[i])
+        ti.atomic_add(object_contact_count[particle_object_id[i]], 1)
+    x[i] = p
+
+
+@ti.kernel
+def collision_response( boundary_box: ti.types.ndarray()):
+    for k in range(solver_iteration_range(active_particle_num[None])):
+        i = active_particle[k]
         p = x[i]
         dir = vec3(0.0)
         collision_normal = ti.Vector([0.0, 0.0, 0.0])
+        lower = scene_value(particle_object_id[i], scene_boundary_lower,
+            ti.Vector([boundary_box[0][j] for j in ti.static(range(3))]))
+        upper = scene_value(particle_object_id[i], scene_boundary_upper,
+            ti.Vector([boundary_box[1][j] for j in ti.static(range(3))]))
         for j in ti.static(range(3)):
-            if p[j] < boundary_box[0][j]:
-                p[j] = boundary_box[0][j]
+            if p[j] < lower[j]:
+                p[j] = lower[j]
                 collision_normal[j] += -1.0
-                dir[j] += boundary_box[0][j] - x[i][j]
+                dir[j] += lower[j] - x[i][j]
         for j in ti.static(range(3)):
-            if p[j] > boundary_box[1][j] and j != 1:
-                p[j] = boundary_box[1][j]
+            if p[j] > upper[j] and j != 1:
+                p[j] = upper[j]
                 collision_normal[j] += 1.0
-                dir[j] += boundary_box[1][j] - x[i][j]
+                dir[j] += upper[j] - x[i][j]
 
         # velocity
         collision_normal_length = collision_normal.norm()
         if collision_normal_length > eps:
-            collision_normal /= collision_normal_length
-            vel = p - x_old[i]
-            vn = collision_normal.dot(vel) * collision_normal
-            vt = vel - vn
             # use dir.norm() as stress
-            stress = dir.norm() * 1.0
-            mu_s = object_friction_factor[particle_object_id[i]][0]
-            mu_k = object_friction_factor[particle_object_id[i]][1]
-            if vt.norm() < stress * mu_s:
-                p -= vt
-            else:
-                delta = vt * ti.min(stress * mu_k / vt.norm(), 1.0)
-                p -= delta
-            v[i] -= (
-                1.0 + object_restitution[particle_object_id[i]]
-            ) * vn
-            x[i] = p
+            resolve_surface_contact(i, p, collision_normal / collision_normal_length, dir.norm() * 1.0)
+
+        # static geometry, both surfaces pass through the centers of the
+        # particles with sdf 0 as in the pair contacts, i sits -sdf deep
+        phi, grad = sample_static_sdf(x[i], object_scene[particle_object_id[i]])
+        depth = -rest_sdf(i) - phi
+        grad_length = grad.norm()
+        if depth > 0.0 and grad_length > eps:
+            n = grad / grad_length
+            resolve_surface_contact(i, x[i] + depth * n, n, depth)
 
 
 @ti.kernel
 def update_velocities( h: ti.f32, damp:ti.f32):
-    for i in range(particle_num[None]):
+    for k in range(active_particle_num[None]):
+        i = active_particle[k]
         dx = x[i] - x_old[i]
         if dx.norm() < eps:
             v[i] = vec3(0.0)
             x[i] = x_old[i]
         else:
             v[i] = dx / h
-        v[i] *= damp
-        
+        v[i] *= scene_value(particle_object_id[i], scene_damp, damp)
 
-update_GraphBuilder = ti.graph.GraphBuilder()
 
-max_iter = 30
-update_GraphBuilder.dispatch(semi_euler, sym_dt)
-for i in range(30):
-    update_GraphBuilder.dispatch(solve_constraints, sym_total_objects, sym_corr_rate)
-    update_GraphBuilder.dispatch(collision_response, sym_boundary_box)
-update_GraphBuilder.dispatch(update_velocities, sym_dt, sym_damp)
+@ti.kernel
+def update_object_velocities(object_num: ti.i32, h: ti.f32, damp: ti.f32):
+    # update_velocities of the rigid body model
+    for i in range(object_num):
+        if object_is_active(i):
+            q_old = object_rot_q_old[i]
+            dq = quat_mul(object_rot_q[i], ti.Vector([-q_old[0], -q_old[1], -q_old[2], q_old[3]]))
+            if dq[3] < 0.0:
+                dq = -dq
+            theta = 2.0 * vec3(dq[0], dq[1], dq[2])
+            move = object_Cm[i] - object_Cm_old[i]
+            if move.norm() + theta.norm() * object_rest_extent[i].norm() < eps:
+                object_v[i] = vec3(0.0)
+                object_omega[i] = vec3(0.0)
+                object_Cm[i] = object_Cm_old[i]
+                object_rot_q[i] = q_old
+                object_rot[i] = quat_to_mat33(q_old)
+            else:
+                object_v[i] = move / h
+                object_omega[i] = theta / h
+            object_v[i] *= scene_value(i, scene_damp, damp)
+            object_omega[i] *= scene_value(i, scene_damp, damp)
+
+    # every particle of an active object follows its pose
+    for c in range(reduce_chunk_num[None]):
+        object_id = reduce_chunk_object[c]
+        if object_is_active(object_id):
+            chunk_end = ti.min(
+                reduce_chunk_begin[c] + reduce_chunk_size,
+                object_begin[object_id] + object_size[object_id],
+            )
+            for i in range(reduce_chunk_begin[c], chunk_end):
+                x[i] = posed_particle(i)
+                v[i] = object_v[object_id] + object_omega[object_id].cross(x[i] - object_Cm[object_id])
+
 
-update_graph = update_GraphBuilder.compile()
+@ti.kernel
+def update_sleep_state(object_num: ti.i32):
+    for c in range(reduce_chunk_num[None]):
+        object_id = reduce_chunk_object[c]
+        chunk_end = ti.min(
+            reduce_chunk_begin[c] + reduce_chunk_size,
+            object_begin[object_id] + object_size[object_id],
+        )
+        speed = 0.0
+        if object_is_active(object_id):
+            for i in range(reduce_chunk_begin[c], chunk_end):
+                speed = ti.max(speed, v[i].norm())
+        reduce_chunk_speed[c] = speed
 
-def update_mock(object_num: ti.i32, dt:ti.f32, corr_rate:ti.f32, damp:ti.f32):
-    update_graph.run({
+    for i in range(object_num):
+        if not object_is_active(i):
+            continue
+        speed = 0.0
+        for c in range(object_chunk_begin[i], object_chunk_begin[i] + object_chunk_num[i]):
+            speed = ti.max(speed, reduce_chunk_speed[c])
+        rot_change = (object_rot[i] - object_prev_rot[i]).norm()
+        object_prev_rot[i] = object_rot[i]
+        if speed < sleep_speed and rot_change < sleep_rotation:
+            object_sleep_counter[i] += 1
+        else:
+            object_sleep_counter[i] = 0
+        if object_sleep_counter[i] >= sleep_frame_num:
+            object_sleep[i] = 1
+
+@lazy_graph('update')
+def build_update_graph():
+    update_GraphBuilder = GraphBuilder()
+
+    update_GraphBuilder.dispatch(apply_kinematic_poses, sym_total_objects, sym_kinematic_poses, sym_dt)
+    update_GraphBuilder.dispatch(build_active_particles, sym_total_objects)
+    update_GraphBuilder.dispatch(apply_haptic_impulse, sym_total_objects)
+    if contact_output_enabled:
+        update_GraphBuilder.dispatch(begin_contact_output, sym_total_objects, sym_dt)
+    if solver_body_model == 'rigid':
+        update_GraphBuilder.dispatch(integrate_objects, sym_total_objects, sym_dt)
+    else:
+        update_GraphBuilder.dispatch(semi_euler, sym_dt)
+    if use_grid_broad_phase:
+        update_GraphBuilder.dispatch(compute_object_sort_keys, sym_total_objects)
+        for _ in range(object_sap_step_num):
+            update_GraphBuilder.dispatch(object_sort_step)
+    for i in range(max_iter):
+        update_GraphBuilder.dispatch(begin_solver_iteration, sym_iterations, sym_tolerance)
+        if use_grid_broad_phase:
+            update_GraphBuilder.dispatch(build_object_pairs, sym_total_objects)
+            update_GraphBuilder.dispatch(build_grid)
+            update_GraphBuilder.dispatch(solve_constraints, sym_total_objects, sym_corr_rate)
+        else:
+            update_GraphBuilder.dispatch(solve_constraints_all_pairs, sym_total_objects, sym_corr_rate)
+        update_GraphBuilder.dispatch(collision_response, sym_boundary_box)
+        if solver_body_model == 'rigid':
+            update_GraphBuilder.dispatch(project_particles, sym_total_objects)
+    if solver_body_model == 'rigid':
+        update_GraphBuilder.dispatch(update_object_velocities, sym_total_objects, sym_dt, sym_damp)
+    else:
+        update_GraphBuilder.dispatch(update_velocities, sym_dt, sym_damp)
+    update_GraphBuilder.dispatch(update_sleep_state, sym_total_objects)
+    update_GraphBuilder.dispatch(build_query_grid)
+
+    return update_GraphBuilder.compile()
+
+update_frame = 0  # updates run, reorder_mock runs every reorder_interval
+
+
+def update_mock(object_num: ti.i32, dt:ti.f32, corr_rate:ti.f32, damp:ti.f32,
+    iterations: ti.i32 = max_iter, tolerance: ti.f32 = 0.0):
+    # iterations is clamped to max_iter, tolerance 0 disables the early exit
+    global update_frame
+    kinematic_poses_to_device.from_numpy(kinematic_poses_np)
+    run_graph('update', {
         'total_objects': object_num,
+        'kinematic_poses': kinematic_poses_to_device,
         'boundary_box': boundary_box,
         'dt': dt,
         'corr_rate' : corr_rate,
-        'damp': damp
+        'damp': damp,
+        'iterations': iterations,
+        'tolerance': tolerance
     })
+    update_frame += 1
+    if reorder_interval > 0 and update_frame % reorder_interval == 0:
+        reorder_mock(object_num)
+    profile_frame_end()
+    check_object_pair_overflow()
+
+
+def check_object_pair_overflow():
+    # after an update: the frame ran without the contacts of the dropped pairs
+    if object_pair_overflow[None]:
+        object_pair_overflow[None] = 0
+        raise RuntimeError('object pair capacity {} exceeded, the contacts of the other pairs were '
+            'dropped this frame (set TIOUCH_MAX_OBJECT_PAIRS)'.format(max_object_pair_num))
 # update graph----------------------------------------------------------
 
 # set initial velocity -------------------------------------------------
@@ -500,22 +2912,79 @@ def set_ini_velocity(object_id:ti.i32, v_x:ti.f32, v_y:ti.f32, v_z:ti.f32):
     v_new = ti.Vector([v_x, v_y, v_z])
     for i in range(object_begin_t, object_end):
         v[i] = v_new
+    object_v[object_id] = v_new
+    object_omega[object_id] = vec3(0.0)
+    object_sleep[object_id] = 0
+    object_sleep_counter[object_id] = 0
 
-set_ini_velocity_GraphBuilder = ti.graph.GraphBuilder()
-set_ini_velocity_GraphBuilder.dispatch(set_ini_velocity, sym_object_id, sym_v_x, sym_v_y, sym_v_z)
-set_ini_velocity_graph = set_ini_velocity_GraphBuilder.compile()
+@lazy_graph('set_ini_velocity')
+def build_set_ini_velocity_graph():
+    set_ini_velocity_GraphBuilder = GraphBuilder()
+    set_ini_velocity_GraphBuilder.dispatch(set_ini_velocity, sym_object_id, sym_v_x, sym_v_y, sym_v_z)
+    return set_ini_velocity_GraphBuilder.compile()
 
 def set_ini_velocity_mock(object_id:ti.i32, v_x, v_y, v_z):
-    set_ini_velocity_graph.run({
+    run_graph('set_ini_velocity', {
         'object_id':object_id,
         'v_x':v_x,
         'v_y':v_y,
         'v_z':v_z,
     })
 
+
+def set_kinematic_pose(object_id: ti.i32, position, rotation=(0.0, 0.0, 0.0, 1.0)):
+    # pose of a STATE_KINIMATIC object for the next update_mock, rotation is
+    # a quaternion (x, y, z, w) relative to the rest pose
+    kinematic_poses_np[object_id, KINEMATIC_POSE_POSITION:KINEMATIC_POSE_POSITION + 3] = position
+    kinematic_poses_np[object_id, KINEMATIC_POSE_ROTATION:KINEMATIC_POSE_ROTATION + 4] = rotation
 # set initial velocity -------------------------------------------------
 
 
+# scenes graph----------------------------------------------------------
+@ti.kernel
+def set_scenes(scenes: ti.types.ndarray(field_dim=1), scene_num: ti.i32):
+    for s in range(scene_num):
+        scene_override[s] = 1
+        scene_boundary_lower[s] = box_desc_vec3(scenes, s, SCENE_DESC_BOUNDARY_LOWER)
+        scene_boundary_upper[s] = box_desc_vec3(scenes, s, SCENE_DESC_BOUNDARY_UPPER)
+        scene_corr_rate[s] = scenes[s][SCENE_DESC_CORR_RATE]
+        scene_damp[s] = scenes[s][SCENE_DESC_DAMP]
+
+@lazy_graph('set_scenes')
+def build_set_scenes_graph():
+    set_scenes_GraphBuilder = GraphBuilder()
+    set_scenes_GraphBuilder.dispatch(set_scenes, sym_scenes, sym_scene_num)
+    return set_scenes_GraphBuilder.compile()
+
+
+def scene_desc(boundary_lower, boundary_upper, corr_rate, damp):
+    desc = np.zeros(scene_desc_size, dtype=np.float32)
+    desc[SCENE_DESC_BOUNDARY_LOWER:SCENE_DESC_BOUNDARY_LOWER + 3] = boundary_lower
+    desc[SCENE_DESC_BOUNDARY_UPPER:SCENE_DESC_BOUNDARY_UPPER + 3] = boundary_upper
+    desc[SCENE_DESC_CORR_RATE] = corr_rate
+    desc[SCENE_DESC_DAMP] = damp
+    return desc
+
+
+def set_scenes_mock(descs):
+    # row s overrides the update arguments of scene s, scenes past the rows keep the defaults
+    descs = np.asarray(descs, dtype=np.float32).reshape(-1, scene_desc_size)
+    check_scenes([len(descs) - 1])
+    scenes_np = np.zeros((max_scene_num, scene_desc_size), dtype=np.float32)
+    scenes_np[:len(descs)] = descs
+    scenes_to_device.from_numpy(scenes_np)
+    run_graph('set_scenes', {
+        'scenes' : scenes_to_device,
+        'scene_num' : len(descs)
+    })
+
+
+def check_scenes(scenes):
+    if len(scenes) and (np.max(scenes) >= max_scene_num or np.min(scenes) < 0):
+        raise ValueError('scene out of range, max_scene_num is {}'.format(max_scene_num))
+# scenes graph----------------------------------------------------------
+
+
 # copy_to_ndarray graph-------------------------------------------------
 @ti.kernel
 def copy_to_nd(total_objects: ti.i32, 
@@ -525,18 +2994,383 @@ def copy_to_nd(total_objects: ti.i32,
         object_cm_to_host[i] = object_Cm[i]
         object_rot_to_host[i] = object_rot[i]
 
-copy_to_nd_GraphBuilder = ti.graph.GraphBuilder()
-copy_to_nd_GraphBuilder.dispatch(copy_to_nd, sym_total_objects, sym_object_cm, sym_object_rot)
-copy_to_end_graph = copy_to_nd_GraphBuilder.compile()
+@ti.kernel
+def copy_contacts(total_objects: ti.i32, object_contacts: ti.types.ndarray(field_dim=1)):
+    # impulse, force, torque, contacts of the last update, see contact output
+    h = ti.max(contact_output_h[None], eps)
+    for i in range(total_objects):
+        impulse = object_contact_correction[i] / h
+        torque = object_contact_angular_correction[i] / (h * h)
+        for d in ti.static(range(3)):
+            object_contacts[i][d] = impulse[d]
+            object_contacts[i][3 + d] = impulse[d] / h
+            object_contacts[i][6 + d] = torque[d]
+        object_contacts[i][9] = ti.cast(object_contact_count[i], ti.f32)
+
+@lazy_graph('copy_to_nd')
+def build_copy_to_nd_graph():
+    copy_to_nd_GraphBuilder = GraphBuilder()
+    copy_to_nd_GraphBuilder.dispatch(copy_to_nd, sym_total_objects, sym_object_cm, sym_object_rot)
+    if contact_output_enabled:
+        copy_to_nd_GraphBuilder.dispatch(copy_contacts, sym_total_objects, sym_object_contacts)
+    return copy_to_nd_GraphBuilder.compile()
 
 def copy_to_nd_mock(total_objects: ti.i32):
-    copy_to_end_graph.run({
+    args = {
         'total_objects': total_objects,
         'object_cm' : object_cm_to_host,
         'object_rot' : object_rot_to_host,
-    })
+    }
+    if contact_output_enabled:
+        args['object_contacts'] = object_contacts_to_host
+    run_graph('copy_to_nd', args)
 # copy_to_ndarray graph-------------------------------------------------
 
+# transform readback graph----------------------------------------------
+@ti.func
+def mat33_to_quat(m):
+    # (x, y, z, w) of a rotation matrix, branch on the largest diagonal term
+    q = ti.Vector([0.0, 0.0, 0.0, 1.0])
+    trace = m[0, 0] + m[1, 1] + m[2, 2]
+    if trace > 0.0:
+        s = ti.sqrt(trace + 1.0) * 2.0
+        q = ti.Vector([(m[2, 1] - m[1, 2]) / s, (m[0, 2] - m[2, 0]) / s, (m[1, 0] - m[0, 1]) / s, 0.25 * s])
+    elif m[0, 0] > m[1, 1] and m[0, 0] > m[2, 2]:
+        s = ti.sqrt(1.0 + m[0, 0] - m[1, 1] - m[2, 2]) * 2.0
+        q = ti.Vector([0.25 * s, (m[0, 1] + m[1, 0]) / s, (m[0, 2] + m[2, 0]) / s, (m[2, 1] - m[1, 2]) / s])
+    elif m[1, 1] > m[2, 2]:
+        s = ti.sqrt(1.0 + m[1, 1] - m[0, 0] - m[2, 2]) * 2.0
+        q = ti.Vector([(m[0, 1] + m[1, 0]) / s, 0.25 * s, (m[1, 2] + m[2, 1]) / s, (m[0, 2] - m[2, 0]) / s])
+    else:
+        s = ti.sqrt(1.0 + m[2, 2] - m[0, 0] - m[1, 1]) * 2.0
+        q = ti.Vector([(m[0, 2] + m[2, 0]) / s, (m[1, 2] + m[2, 1]) / s, 0.25 * s, (m[1, 0] - m[0, 1]) / s])
+    return q.normalized()
+
+
+@ti.kernel
+def copy_transforms(total_objects: ti.i32, position_threshold: ti.f32, rotation_threshold: ti.f32,
+    transforms: ti.types.ndarray(field_dim=1), transform_ids: ti.types.ndarray(field_dim=1)):
+    transform_ids[0] = 0
+    for i in range(total_objects):
+        if object_state[i] == STATE_REMOVED:
+            continue
+        if (
+            not object_sent_valid[i]
+            or (object_Cm[i] - object_sent_Cm[i]).norm() > position_threshold
+            or (object_rot[i] - object_sent_rot[i]).norm() > rotation_threshold
+        ):
+            slot = ti.atomic_add(transform_ids[0], 1)
+            transform_ids[slot + 1] = i
+            q = mat33_to_quat(object_rot[i])
+            for d in ti.static(range(3)):
+                transforms[slot][d] = object_Cm[i][d]
+            for d in ti.static(range(4)):
+                transforms[slot][3 + d] = q[d]
+            object_sent_Cm[i] = object_Cm[i]
+            object_sent_rot[i] = object_rot[i]
+            object_sent_valid[i] = 1
+
+@lazy_graph('copy_transforms')
+def build_copy_transforms_graph():
+    copy_transforms_GraphBuilder = GraphBuilder()
+    copy_transforms_GraphBuilder.dispatch(
+        copy_transforms, sym_total_objects, sym_position_threshold, sym_rotation_threshold,
+        sym_transforms, sym_transform_ids
+    )
+    if contact_output_enabled:
+        copy_transforms_GraphBuilder.dispatch(copy_contacts, sym_total_objects, sym_object_contacts)
+    return copy_transforms_GraphBuilder.compile()
+
+readback_frame = 0  # frames written into the ring so far
+
+
+def copy_transforms_mock(total_objects: ti.i32, compact=True, position_threshold=1e-4,
+    rotation_threshold=1e-4):
+    # write this frame into the next ring slot, returns the slot of the frame
+    # before (None until there is one); read it with read_transforms
+    global readback_frame
+    slot = readback_frame % readback_ring_size
+    if compact:
+        args = {
+            'total_objects': total_objects,
+            'position_threshold': position_threshold,
+            'rotation_threshold': rotation_threshold,
+            'transforms': transforms_ring[slot],
+            'transform_ids': transform_ids_ring[slot],
+        }
+    else:
+        args = {
+            'total_objects': total_objects,
+            'object_cm': object_cm_ring[slot],
+            'object_rot': object_rot_ring[slot],
+        }
+    if contact_output_enabled:
+        args['object_contacts'] = object_contacts_ring[slot]
+    run_graph('copy_transforms' if compact else 'copy_to_nd', args)
+    readback_frame += 1
+    if readback_frame < 2:
+        return None
+    return (readback_frame - 2) % readback_ring_size
+
+
+def read_transforms(slot, compact=True, total_objects=None):
+    # compact: (object ids, rows of position + quaternion xyzw) of the moved objects,
+    # full: (object_cm, object_rot) of the first total_objects objects
+    if compact:
+        ids = transform_ids_ring[slot].to_numpy()
+        count = ids[0]
+        return ids[1:count + 1], transforms_ring[slot].to_numpy()[:count]
+    return object_cm_ring[slot].to_numpy()[:total_objects], object_rot_ring[slot].to_numpy()[:total_objects]
+
+
+def read_contacts(slot, total_objects):
+    # contact output rows of the first total_objects objects, written with the
+    # transforms of the same slot
+    return object_contacts_ring[slot].to_numpy()[:total_objects]
+# transform readback graph----------------------------------------------
+
+# solver stats graph----------------------------------------------------
+@ti.kernel
+def copy_solver_stats(solver_stats: ti.types.ndarray()):
+    solver_stats[0] = ti.cast(solver_iter[None], ti.f32)
+    solver_stats[1] = solver_residual[None]
+
+@lazy_graph('copy_solver_stats')
+def build_copy_solver_stats_graph():
+    copy_solver_stats_GraphBuilder = GraphBuilder()
+    copy_solver_stats_GraphBuilder.dispatch(copy_solver_stats, sym_solver_stats)
+    return copy_solver_stats_GraphBuilder.compile()
+
+def copy_solver_stats_mock():
+    # returns (iterations used in the last update, residual of its last iteration)
+    run_graph('copy_solver_stats', {
+        'solver_stats': solver_stats_to_host,
+    })
+    stats = solver_stats_to_host.to_numpy()
+    return int(stats[0]), float(stats[1])
+# solver stats graph----------------------------------------------------
+
+# haptic query graph----------------------------------------------------
+@ti.func
+def closest_point_on_segment(p0, p1, p):
+    seg = p1 - p0
+    t = 0.0
+    if seg.norm_sqr() > eps:
+        t = ti.min(ti.max((p - p0).dot(seg) / seg.norm_sqr(), 0.0), 1.0)
+    return p0 + t * seg
+
+
+@ti.kernel
+def haptic_query(haptic_tool: ti.types.ndarray(), stiffness: ti.f32, dt: ti.f32,
+    haptic_wrench: ti.types.ndarray()):
+    p0 = vec3(haptic_tool[0], haptic_tool[1], haptic_tool[2])
+    p1 = vec3(haptic_tool[3], haptic_tool[4], haptic_tool[5])
+    reach = haptic_tool[6] + particle_radius
+    scene = ti.cast(haptic_tool[7], ti.i32)
+    center = 0.5 * (p0 + p1)
+    cell_lo = grid_cell(ti.min(p0, p1) - reach)
+    cell_hi = grid_cell(ti.max(p0, p1) + reach)
+
+    haptic_force[None] = vec3(0.0)
+    haptic_torque[None] = vec3(0.0)
+    for cell in ti.grouped(ti.ndrange(
+        (cell_lo.x, cell_hi.x + 1), (cell_lo.y, cell_hi.y + 1), (cell_lo.z, cell_hi.z + 1)
+    )):
+        h = grid_hash(cell, scene)
+        for k in range(grid_end[h] - grid_count[h], grid_end[h]):
+            j = grid_particle[k]
+            if not all(particle_cell[j] == cell) or object_scene[particle_object_id[j]] != scene:
+                continue
+            c = closest_point_on_segment(p0, p1, x[j])
+            d = c - x[j]
+            dist = d.norm()
+            if dist < reach and dist > eps:
+                # penalty force pushing the tool out of the particle
+                f = stiffness * (reach - dist) * d / dist
+                ti.atomic_add(haptic_force[None], f)
+                ti.atomic_add(haptic_torque[None], (c - center).cross(f))
+                object_id = particle_object_id[j]
+                if object_state[object_id] == STATE_DYNAMIC:
+                    ti.atomic_add(object_haptic_impulse[object_id], -f * dt)
+                    ti.atomic_add(
+                        object_haptic_angular_impulse[object_id],
+                        (x[j] - object_Cm[object_id]).cross(-f * dt)
+                    )
+                    if object_sleep[object_id]:
+                        object_wake[object_id] = 1
+
+    for d in ti.static(range(3)):
+        haptic_wrench[d] = haptic_force[None][d]
+        haptic_wrench[3 + d] = haptic_torque[None][d]
+
+@lazy_graph('haptic_query')
+def build_haptic_query_graph():
+    haptic_query_GraphBuilder = GraphBuilder()
+    haptic_query_GraphBuilder.dispatch(haptic_query, sym_haptic_tool, sym_stiffness, sym_dt, sym_haptic_wrench)
+    return haptic_query_GraphBuilder.compile()
+
+def haptic_query_mock(p0, p1, radius, stiffness, dt=1e-3, scene=0):
+    # returns (force on the tool, torque about the tool center)
+    haptic_tool_to_device.from_numpy(np.array([*p0, *p1, radius, scene], dtype=np.float32))
+    run_graph('haptic_query', {
+        'haptic_tool': haptic_tool_to_device,
+        'stiffness': stiffness,
+        'dt': dt,
+        'haptic_wrench': haptic_wrench_to_host,
+    })
+    wrench = haptic_wrench_to_host.to_numpy()
+    return wrench[:3], wrench[3:]
+# haptic query graph----------------------------------------------------
+
+# static sdf graph------------------------------------------------------
+@ti.func
+def static_sdf_index(scene, I):
+    dims = static_sdf_dims[scene]
+    return static_sdf_offset[scene] + (I.x * dims.y + I.y) * dims.z + I.z
+
+
+@ti.func
+def static_sdf_node_scene(n):
+    # the scene whose grid holds node n: the last offset not above n
+    lo = 0
+    hi = max_scene_num
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if static_sdf_offset[mid] <= n:
+            lo = mid
+        else:
+            hi = mid
+    return lo
+
+
+@ti.func
+def in_static_sdf(object_id):
+    # a static object the volume of its scene stands in for
+    return (
+        static_sdf_ready[None]
+        and object_state[object_id] == STATE_STATIC
+        and static_sdf_dims[object_scene[object_id]].x > 0
+    )
+
+
+@ti.func
+def sample_static_sdf(p, scene):
+    # trilinear phi and gradient in the volume of scene, phi is inf outside it
+    phi = inf
+    grad = vec3(0.0)
+    if static_sdf_ready[None] and static_sdf_dims[scene].x > 0:
+        g = (p - static_sdf_origin[scene]) / static_sdf_cell[scene]
+        base = ti.cast(ti.floor(g), ti.i32)
+        if all(base >= 0) and all(base < static_sdf_dims[scene] - 1):
+            f = g - base
+            phi = 0.0
+            for o in ti.static(ti.grouped(ti.ndrange(2, 2, 2))):
+                w = 1.0
+                for k in ti.static(range(3)):
+                    w *= o[k] * f[k] + (1 - o[k]) * (1.0 - f[k])
+                n = static_sdf_index(scene, base + o)
+                phi += w * static_sdf[n]
+                grad += w * static_sdf_grad[n]
+    return phi, grad
+
+
+@ti.kernel
+def bake_static_sdf():
+    static_sdf_ready[None] = 0
+    for s in range(max_scene_num):
+        static_sdf_lower[s] = vec3(inf)
+        static_sdf_upper[s] = vec3(-inf)
+    static_num = 0
+    for i in range(particle_num[None]):
+        object_id = particle_object_id[i]
+        if object_state[object_id] == STATE_STATIC:
+            static_num += 1
+            for k in ti.static(range(3)):
+                ti.atomic_min(static_sdf_lower[object_scene[object_id]][k], x[i][k])
+                ti.atomic_max(static_sdf_upper[object_scene[object_id]][k], x[i][k])
+
+    # the node budget split by the extent of every scene with static particles
+    total_volume = 0.0
+    for s in range(max_scene_num):
+        if static_sdf_lower[s].x <= static_sdf_upper[s].x:
+            extent = static_sdf_upper[s] - static_sdf_lower[s] + 2.0 * static_sdf_band
+            total_volume += extent.x * extent.y * extent.z
+
+    # per scene the smallest cell, not below static_sdf_min_cell, that fits its share
+    for s in range(max_scene_num):
+        origin = static_sdf_lower[s] - static_sdf_band
+        extent = static_sdf_upper[s] + static_sdf_band - origin
+        cell = static_sdf_min_cell
+        dims = ti.Vector([0, 0, 0])
+        if static_sdf_lower[s].x <= static_sdf_upper[s].x:
+            volume = extent.x * extent.y * extent.z
+            budget = ti.cast(static_sdf_max_nodes * (volume / total_volume), ti.i32)
+            if budget >= 8:
+                cell = ti.max(cell, ti.pow(volume / budget, 1.0 / 3.0))
+                dims = ti.cast(ti.ceil(extent / cell), ti.i32) + 1
+                while dims.x * dims.y * dims.z > budget:
+                    cell *= 1.05
+                    dims = ti.cast(ti.ceil(extent / cell), ti.i32) + 1
+        static_sdf_origin[s] = origin
+        static_sdf_cell[s] = cell
+        static_sdf_dims[s] = dims
+
+    node_num = 0
+    ti.loop_config(serialize=True)
+    for s in range(max_scene_num):
+        static_sdf_offset[s] = node_num
+        dims = static_sdf_dims[s]
+        node_num += dims.x * dims.y * dims.z
+    static_sdf_offset[max_scene_num] = node_num
+
+    for n in range(node_num):
+        static_sdf[n] = static_sdf_band
+
+    for i in range(particle_num[None]):
+        scene = object_scene[particle_object_id[i]]
+        if object_state[particle_object_id[i]] == STATE_STATIC and static_sdf_dims[scene].x > 0:
+            origin = static_sdf_origin[scene]
+            cell = static_sdf_cell[scene]
+            dims = static_sdf_dims[scene]
+            lo = ti.max(ti.cast(ti.floor((x[i] - static_sdf_band - origin) / cell), ti.i32), 0)
+            hi = ti.min(ti.cast(ti.ceil((x[i] + static_sdf_band - origin) / cell), ti.i32), dims - 1)
+            for I in ti.grouped(ti.ndrange((lo.x, hi.x + 1), (lo.y, hi.y + 1), (lo.z, hi.z + 1))):
+                node = origin + I * cell
+                ti.atomic_min(
+                    static_sdf[static_sdf_index(scene, I)],
+                    (node - x[i]).norm() + rest_sdf(i)
+                )
+
+    for n in range(node_num):
+        scene = static_sdf_node_scene(n)
+        dims = static_sdf_dims[scene]
+        local = n - static_sdf_offset[scene]
+        I = ti.Vector([local // (dims.y * dims.z), local // dims.z % dims.y, local % dims.z])
+        grad = vec3(0.0)
+        for k in ti.static(range(3)):
+            e = ti.Vector([0, 0, 0])
+            e[k] = 1
+            lo = ti.max(I - e, 0)
+            hi = ti.min(I + e, dims - 1)
+            grad[k] = (static_sdf[static_sdf_index(scene, hi)] - static_sdf[static_sdf_index(scene, lo)]) / (
+                ti.max(hi[k] - lo[k], 1) * static_sdf_cell[scene]
+            )
+        static_sdf_grad[n] = grad
+
+    if static_num > 0:
+        static_sdf_ready[None] = 1
+
+@lazy_graph('bake_static_sdf')
+def build_bake_static_sdf_graph():
+    bake_static_sdf_GraphBuilder = GraphBuilder()
+    bake_static_sdf_GraphBuilder.dispatch(bake_static_sdf)
+    return bake_static_sdf_GraphBuilder.compile()
+
+def bake_static_sdf_mock():
+    # after the static objects are added, rerun when one is added or removed
+    run_graph('bake_static_sdf', {})
+# static sdf graph------------------------------------------------------
+
 # reset graph-----------------------------------------------------------
 
 @ti.kernel
@@ -544,23 +3378,251 @@ def reset_all(total_objects: ti.i32):
     part_num = particle_num[None]
     for i in range(part_num):
         v[i] = ti.Vector([0,0,0])
-        x[i] = x0[i]
-        x_old[i] = x0[i]   
+        x[i] = rest_position(i)
+        x_old[i] = x[i]
 
     for i in range(total_objects):
         object_Cm[i] = object_rest_Cm[i]     
-        object_rot[i] = object_rest_rot[i]
-
-reset_all_GraphBuilder = ti.graph.GraphBuilder()
-reset_all_GraphBuilder.dispatch(reset_all, sym_total_objects)
-reset_all_graph = reset_all_GraphBuilder.compile()
+        object_rot[i] = mat33_identity
+        object_prev_rot[i] = mat33_identity
+        object_sleep[i] = 0
+        object_sleep_counter[i] = 0
+        object_wake[i] = 0
+        object_sweep[i] = 0.0
+        object_rot_q[i] = ti.Vector([0.0, 0.0, 0.0, 1.0])
+        object_v[i] = vec3(0.0)
+        object_omega[i] = vec3(0.0)
+        object_sent_valid[i] = 0
+        object_haptic_impulse[i] = vec3(0.0)
+        object_haptic_angular_impulse[i] = vec3(0.0)
+
+@lazy_graph('reset_all')
+def build_reset_all_graph():
+    reset_all_GraphBuilder = GraphBuilder()
+    reset_all_GraphBuilder.dispatch(reset_all, sym_total_objects)
+    return reset_all_GraphBuilder.compile()
 
 def reset_all_mock(total_objects: ti.i32):
-    reset_all_graph.run({
+    run_graph('reset_all', {
         'total_objects': total_objects
     })
 # reset graph-----------------------------------------------------------
 
+# snapshot graph--------------------------------------------------------
+@ti.func
+def snapshot_put_vec(rows: ti.template(), i, offset, value):
+    for d in ti.static(range(value.n)):
+        rows[i][offset + d] = value[d]
+
+
+@ti.func
+def snapshot_put_mat33(rows: ti.template(), i, offset, value):
+    for r, c in ti.static(ti.ndrange(3, 3)):
+        rows[i][offset + 3 * r + c] = value[r, c]
+
+
+@ti.func
+def snapshot_vec(rows: ti.template(), i, offset, n: ti.template()):
+    return ti.Vector([rows[i][offset + d] for d in ti.static(range(n))])
+
+
+@ti.func
+def snapshot_mat33(rows: ti.template(), i, offset):
+    return ti.Matrix([[rows[i][offset + 3 * r + c] for c in ti.static(range(3))] for r in ti.static(range(3))])
+
+
+@ti.func
+def snapshot_i32(rows: ti.template(), i, offset):
+    return ti.cast(rows[i][offset], ti.i32)
+
+
+@ti.kernel
+def save_snapshot(snapshot_particles: ti.types.ndarray(field_dim=1),
+    snapshot_objects: ti.types.ndarray(field_dim=1), snapshot_scenes: ti.types.ndarray(field_dim=1),
+    total_objects: ti.i32):
+    for i in range(particle_num[None]):
+        snapshot_put_vec(snapshot_particles, i, SNAPSHOT_PARTICLE_X, x[i])
+        snapshot_put_vec(snapshot_particles, i, SNAPSHOT_PARTICLE_X_OLD, x_old[i])
+        snapshot_put_vec(snapshot_particles, i, SNAPSHOT_PARTICLE_V, v[i])
+        snapshot_put_vec(snapshot_particles, i, SNAPSHOT_PARTICLE_X0, rest_position(i))
+        snapshot_particles[i][SNAPSHOT_PARTICLE_SDF] = rest_sdf(i)
+        snapshot_put_vec(snapshot_particles, i, SNAPSHOT_PARTICLE_SDF_GRAD, rest_sdf_grad(i))
+        snapshot_particles[i][SNAPSHOT_PARTICLE_OBJECT] = particle_object_id[i]
+
+    for i in range(total_objects):
+        snapshot_put_vec(snapshot_objects, i, SNAPSHOT_OBJECT_REST_CM, object_rest_Cm[i])
+        snapshot_put_vec(snapshot_objects, i, SNAPSHOT_OBJECT_CM, object_Cm[i])
+        snapshot_put_mat33(snapshot_objects, i, SNAPSHOT_OBJECT_ROT, object_rot[i])
+        snapshot_put_mat33(snapshot_objects, i, SNAPSHOT_OBJECT_REST_ROT, object_rest_rot[i])
+        snapshot_put_mat33(snapshot_objects, i, SNAPSHOT_OBJECT_PREV_ROT, object_prev_rot[i])
+        snapshot_put_vec(snapshot_objects, i, SNAPSHOT_OBJECT_ROT_Q, object_rot_q[i])
+        snapshot_put_vec(snapshot_objects, i, SNAPSHOT_OBJECT_REST_EXTENT, object_rest_extent[i])
+        snapshot_put_mat33(snapshot_objects, i, SNAPSHOT_OBJECT_REST_INERTIA, object_rest_inertia[i])
+        snapshot_put_vec(snapshot_objects, i, SNAPSHOT_OBJECT_FRICTION, object_friction_factor[i])
+        snapshot_objects[i][SNAPSHOT_OBJECT_RESTITUTION] = object_restitution[i]
+        snapshot_objects[i][SNAPSHOT_OBJECT_MASS] = object_mass[i]
+        snapshot_objects[i][SNAPSHOT_OBJECT_BEGIN] = object_begin[i]
+        snapshot_objects[i][SNAPSHOT_OBJECT_SIZE] = object_size[i]
+        snapshot_objects[i][SNAPSHOT_OBJECT_STATE] = object_state[i]
+        snapshot_objects[i][SNAPSHOT_OBJECT_SLEEP] = object_sleep[i]
+        snapshot_objects[i][SNAPSHOT_OBJECT_SLEEP_COUNTER] = object_sleep_counter[i]
+        snapshot_objects[i][SNAPSHOT_OBJECT_WAKE] = object_wake[i]
+        snapshot_objects[i][SNAPSHOT_OBJECT_SCENE] = object_scene[i]
+        snapshot_objects[i][SNAPSHOT_OBJECT_SWEEP] = object_sweep[i]
+        snapshot_put_vec(snapshot_objects, i, SNAPSHOT_OBJECT_HAPTIC_IMPULSE, object_haptic_impulse[i])
+        snapshot_put_vec(
+            snapshot_objects, i, SNAPSHOT_OBJECT_HAPTIC_ANGULAR_IMPULSE, object_haptic_angular_impulse[i]
+        )
+        snapshot_put_vec(snapshot_objects, i, SNAPSHOT_OBJECT_V, object_v[i])
+        snapshot_put_vec(snapshot_objects, i, SNAPSHOT_OBJECT_OMEGA, object_omega[i])
+
+    for s in range(max_scene_num):
+        snapshot_put_vec(snapshot_scenes, s, SNAPSHOT_SCENE_DESC + SCENE_DESC_BOUNDARY_LOWER,
+            scene_boundary_lower[s])
+        snapshot_put_vec(snapshot_scenes, s, SNAPSHOT_SCENE_DESC + SCENE_DESC_BOUNDARY_UPPER,
+            scene_boundary_upper[s])
+        snapshot_scenes[s][SNAPSHOT_SCENE_DESC + SCENE_DESC_CORR_RATE] = scene_corr_rate[s]
+        snapshot_scenes[s][SNAPSHOT_SCENE_DESC + SCENE_DESC_DAMP] = scene_damp[s]
+        snapshot_scenes[s][SNAPSHOT_SCENE_OVERRIDE] = scene_override[s]
+
+
+@ti.kernel
+def load_snapshot(snapshot_particles: ti.types.ndarray(field_dim=1),
+    snapshot_objects: ti.types.ndarray(field_dim=1), snapshot_scenes: ti.types.ndarray(field_dim=1),
+    snapshot_particle_num: ti.i32, snapshot_scene_num: ti.i32,
+    total_objects: ti.i32, static_sdf_valid: ti.i32):
+    for s in range(max_scene_num):
+        scene_override[s] = 0
+        if s < snapshot_scene_num:
+            scene_override[s] = snapshot_i32(snapshot_scenes, s, SNAPSHOT_SCENE_OVERRIDE)
+            scene_boundary_lower[s] = snapshot_vec(
+                snapshot_scenes, s, SNAPSHOT_SCENE_DESC + SCENE_DESC_BOUNDARY_LOWER, 3)
+            scene_boundary_upper[s] = snapshot_vec(
+                snapshot_scenes, s, SNAPSHOT_SCENE_DESC + SCENE_DESC_BOUNDARY_UPPER, 3)
+            scene_corr_rate[s] = snapshot_scenes[s][SNAPSHOT_SCENE_DESC + SCENE_DESC_CORR_RATE]
+            scene_damp[s] = snapshot_scenes[s][SNAPSHOT_SCENE_DESC + SCENE_DESC_DAMP]
+
+    # the baked volume survives if the static particles are where it was baked
+    if not static_sdf_valid:
+        static_sdf_ready[None] = 0
+    old_particle_num = particle_num[None]
+    for i in range(ti.max(old_particle_num, snapshot_particle_num)):
+        was_static = 0
+        if i < old_particle_num:
+            was_static = object_state[particle_object_id[i]] == STATE_STATIC
+        is_static = 0
+        if i < snapshot_particle_num:
+            object_id = snapshot_i32(snapshot_particles, i, SNAPSHOT_PARTICLE_OBJECT)
+            is_static = snapshot_i32(snapshot_objects, object_id, SNAPSHOT_OBJECT_STATE) == STATE_STATIC
+        if was_static != is_static:
+            static_sdf_ready[None] = 0
+        elif is_static and any(snapshot_vec(snapshot_particles, i, SNAPSHOT_PARTICLE_X, 3) != x[i]):
+            static_sdf_ready[None] = 0
+
+    particle_num[None] = snapshot_particle_num
+    for i in range(snapshot_particle_num, old_particle_num):
+        x[i] = ti.Vector([1e20, 1e20, 1e20])
+
+    for i in range(snapshot_particle_num):
+        x[i] = snapshot_vec(snapshot_particles, i, SNAPSHOT_PARTICLE_X, 3)
+        x_old[i] = snapshot_vec(snapshot_particles, i, SNAPSHOT_PARTICLE_X_OLD, 3)
+        v[i] = snapshot_vec(snapshot_particles, i, SNAPSHOT_PARTICLE_V, 3)
+        store_rest(
+            i, snapshot_vec(snapshot_particles, i, SNAPSHOT_PARTICLE_X0, 3),
+            snapshot_particles[i][SNAPSHOT_PARTICLE_SDF],
+            snapshot_vec(snapshot_particles, i, SNAPSHOT_PARTICLE_SDF_GRAD, 3)
+        )
+        particle_object_id[i] = snapshot_i32(snapshot_particles, i, SNAPSHOT_PARTICLE_OBJECT)
+
+    for i in range(total_objects):
+        object_rest_Cm[i] = snapshot_vec(snapshot_objects, i, SNAPSHOT_OBJECT_REST_CM, 3)
+        object_Cm[i] = snapshot_vec(snapshot_objects, i, SNAPSHOT_OBJECT_CM, 3)
+        object_rot[i] = snapshot_mat33(snapshot_objects, i, SNAPSHOT_OBJECT_ROT)
+        object_rest_rot[i] = snapshot_mat33(snapshot_objects, i, SNAPSHOT_OBJECT_REST_ROT)
+        object_prev_rot[i] = snapshot_mat33(snapshot_objects, i, SNAPSHOT_OBJECT_PREV_ROT)
+        object_rot_q[i] = snapshot_vec(snapshot_objects, i, SNAPSHOT_OBJECT_ROT_Q, 4)
+        object_rest_extent[i] = snapshot_vec(snapshot_objects, i, SNAPSHOT_OBJECT_REST_EXTENT, 3)
+        set_rest_quantum(i)
+        object_rest_inertia[i] = snapshot_mat33(snapshot_objects, i, SNAPSHOT_OBJECT_REST_INERTIA)
+        object_friction_factor[i] = snapshot_vec(snapshot_objects, i, SNAPSHOT_OBJECT_FRICTION, 2)
+        object_restitution[i] = snapshot_objects[i][SNAPSHOT_OBJECT_RESTITUTION]
+        object_mass[i] = snapshot_objects[i][SNAPSHOT_OBJECT_MASS]
+        object_begin[i] = snapshot_i32(snapshot_objects, i, SNAPSHOT_OBJECT_BEGIN)
+        object_size[i] = snapshot_i32(snapshot_objects, i, SNAPSHOT_OBJECT_SIZE)
+        object_state[i] = snapshot_i32(snapshot_objects, i, SNAPSHOT_OBJECT_STATE)
+        object_sleep[i] = snapshot_i32(snapshot_objects, i, SNAPSHOT_OBJECT_SLEEP)
+        object_sleep_counter[i] = snapshot_i32(snapshot_objects, i, SNAPSHOT_OBJECT_SLEEP_COUNTER)
+        object_wake[i] = snapshot_i32(snapshot_objects, i, SNAPSHOT_OBJECT_WAKE)
+        object_scene[i] = snapshot_i32(snapshot_objects, i, SNAPSHOT_OBJECT_SCENE)
+        object_sweep[i] = snapshot_objects[i][SNAPSHOT_OBJECT_SWEEP]
+        object_haptic_impulse[i] = snapshot_vec(snapshot_objects, i, SNAPSHOT_OBJECT_HAPTIC_IMPULSE, 3)
+        object_haptic_angular_impulse[i] = snapshot_vec(
+            snapshot_objects, i, SNAPSHOT_OBJECT_HAPTIC_ANGULAR_IMPULSE, 3
+        )
+        object_v[i] = snapshot_vec(snapshot_objects, i, SNAPSHOT_OBJECT_V, 3)
+        object_omega[i] = snapshot_vec(snapshot_objects, i, SNAPSHOT_OBJECT_OMEGA, 3)
+        # every restored object is sent again by copy_transforms
+        object_sent_valid[i] = 0
+
+    for i in range(snapshot_particle_num):
+        rest_x = snapshot_vec(snapshot_particles, i, SNAPSHOT_PARTICLE_X0, 3)
+        store_rest_q(i, rest_x - object_rest_Cm[particle_object_id[i]])
+
+@lazy_graph('save_snapshot')
+def build_save_snapshot_graph():
+    save_snapshot_GraphBuilder = GraphBuilder()
+    save_snapshot_GraphBuilder.dispatch(
+        save_snapshot, sym_snapshot_particles, sym_snapshot_objects, sym_snapshot_scenes, sym_total_objects
+    )
+    return save_snapshot_GraphBuilder.compile()
+
+@lazy_graph('load_snapshot')
+def build_load_snapshot_graph():
+    load_snapshot_GraphBuilder = GraphBuilder()
+    load_snapshot_GraphBuilder.dispatch(
+        load_snapshot, sym_snapshot_particles, sym_snapshot_objects, sym_snapshot_scenes,
+        sym_snapshot_particle_num, sym_snapshot_scene_num, sym_total_objects, sym_static_sdf_valid
+    )
+    load_snapshot_GraphBuilder.dispatch(rebuild_object_tables, sym_total_objects)
+    load_snapshot_GraphBuilder.dispatch(build_query_grid)
+    return load_snapshot_GraphBuilder.compile()
+
+
+def save_snapshot_mock(total_objects: ti.i32):
+    # (particle rows, object rows, scene rows) of the current state
+    run_graph('save_snapshot', {
+        'snapshot_particles': snapshot_particles_nd,
+        'snapshot_objects': snapshot_objects_nd,
+        'snapshot_scenes': snapshot_scenes_nd,
+        'total_objects': total_objects,
+    })
+    n = particle_num[None]
+    return (snapshot_particles_nd.to_numpy()[:n], snapshot_objects_nd.to_numpy()[:total_objects],
+        snapshot_scenes_nd.to_numpy())
+
+
+def load_snapshot_mock(particles, objects, scenes, static_sdf_valid=True):
+    # static_sdf_valid: the volume was baked when the rows were saved
+    if len(particles) > max_particle_num or len(objects) > max_object_num or len(scenes) > max_scene_num:
+        raise ValueError('snapshot of {} particles / {} objects / {} scenes exceeds the capacity'.format(
+            len(particles), len(objects), len(scenes)))
+    snapshot_particles_np[:len(particles)] = particles
+    snapshot_objects_np[:len(objects)] = objects
+    snapshot_scenes_np[:len(scenes)] = scenes
+    snapshot_particles_nd.from_numpy(snapshot_particles_np)
+    snapshot_objects_nd.from_numpy(snapshot_objects_np)
+    snapshot_scenes_nd.from_numpy(snapshot_scenes_np)
+    run_graph('load_snapshot', {
+        'snapshot_particles': snapshot_particles_nd,
+        'snapshot_objects': snapshot_objects_nd,
+        'snapshot_scenes': snapshot_scenes_nd,
+        'snapshot_particle_num': len(particles),
+        'snapshot_scene_num': len(scenes),
+        'total_objects': len(objects),
+        'static_sdf_valid': int(static_sdf_valid),
+    })
+# snapshot graph--------------------------------------------------------
+
 
 
 
@@ -575,23 +3637,29 @@ def convert_to_field(x: ti.types.ndarray(field_dim=1), y: ti.template()):
 def save_aot_foo():
     # save aot artefact
     # Notion: calling this makes 'running cgraphs at python runtime' generates error
+    ensure_init()
     mod = ti.aot.Module(ti.vulkan)
-    mod.add_graph('init', init_graph)
-    mod.add_graph('add_box', add_box_graph)
-    mod.add_graph('update', update_graph)
-    mod.add_graph('copy_to_nd', copy_to_end_graph)
-    mod.add_graph('set_ini_velocity', set_ini_velocity_graph)
-    mod.add_graph('reset_all', reset_all_graph)
+    mod.add_graph('init', get_graph('init'))
+    mod.add_graph('add_box', get_graph('add_box'))
+    mod.add_graph('add_boxes', get_graph('add_boxes'))
+    mod.add_graph('add_mesh', get_graph('add_mesh'))
+    mod.add_graph('remove_object', get_graph('remove_object'))
+    mod.add_graph('compact', get_graph('compact'))
+    mod.add_graph('reorder', get_graph('reorder'))
+    mod.add_graph('update', get_graph('update'))
+    mod.add_graph('copy_to_nd', get_graph('copy_to_nd'))
+    mod.add_graph('copy_transforms', get_graph('copy_transforms'))
+    mod.add_graph('set_ini_velocity', get_graph('set_ini_velocity'))
+    mod.add_graph('set_scenes', get_graph('set_scenes'))
+    mod.add_graph('reset_all', get_graph('reset_all'))
+    mod.add_graph('copy_solver_stats', get_graph('copy_solver_stats'))
+    mod.add_graph('haptic_query', get_graph('haptic_query'))
+    mod.add_graph('bake_static_sdf', get_graph('bake_static_sdf'))
     mod.archive("Assets/Resources/TaichiModules/rigid_scene.cgraph.tcm")
     print('AOT done')
 # aux end------------------------------------------------------------------
 
 # data preparing
-import numpy as np
-boundary_box_np = np.ndarray((2, 3))
-boundary_box_np[0] = np.array([-1.0, 0.0, -1.0]) * 1000
-boundary_box_np[1] = np.array([1.0, 1.0, 1.0]) * 1000
-boundary_box.from_numpy(boundary_box_np)
 # boundary_box_field = ti.Vector.field(3, ti.f32, 2)
 # end preparing
 
@@ -601,9 +3669,6 @@ boundary_box.from_numpy(boundary_box_np)
 #--------------------------------------------------------------------------
 #--------------------------------------------------------------------------
 
-center_obj = ti.Vector.field(3, ti.f32, max_object_num)
-
-
 save_aot = True
 
 if __name__ == '__main__':
@@ -615,6 +3680,7 @@ if __name__ == '__main__':
 
     init_mock()
     object_id = 0
+    center_obj = ti.Vector.field(3, ti.f32, max_object_num)
 
     # generate_friction_scene
     object_id = add_box_mock(
@@ -677,6 +3743,7 @@ if __name__ == '__main__':
         state=STATE_STATIC,
         object_id=object_id
     )
+    bake_static_sdf_mock()
 
     window = ti.ui.Window("Shape matching - Rigid", (1200, 1200), vsync=True)
     scene = ti.ui.Scene()
@@ -692,6 +3759,7 @@ if __name__ == '__main__':
 
     pause = True
     frame = 0
+    despawn_distance = 6.0
 
     idx = 0
     while window.running:
@@ -709,25 +3777,44 @@ if __name__ == '__main__':
             reset_all_mock(object_id)
 
         if not pause and window.is_pressed("t"):
-            object_id = add_box_mock(
-                center_x=0.0, 
-                center_y=5.2, 
-                center_z=0.0,
-                half_extent_x=0.3,
-                half_extent_y=0.3,
-                half_extent_z=0.3,
-                state=STATE_DYNAMIC,
-                object_id=object_id
-            )
-            set_ini_velocity_mock(object_id=object_id-1, v_x=10, v_y=0, v_z=0)
+            slot = allocate_object_id(object_id)
+            try:
+                add_box_mock(
+                    center_x=0.0, 
+                    center_y=5.2, 
+                    center_z=0.0,
+                    half_extent_x=0.3,
+                    half_extent_y=0.3,
+                    half_extent_z=0.3,
+                    state=STATE_DYNAMIC,
+                    object_id=slot
+                )
+                set_ini_velocity_mock(object_id=slot, v_x=10, v_y=0, v_z=0)
+                object_id = max(object_id, slot + 1)
+            except RuntimeError as e:
+                # full, the box is not spawned
+                print(e)
 
         if not pause:
             update_mock(object_num=object_id, dt=1.0/60.0, corr_rate=1.0, damp=0.98)
             copy_to_nd_mock(object_id)
 
+            # despawn boxes that left the stage, their slots are reused by "t"
+            cm = object_cm_to_host.to_numpy()[:object_id]
+            gone = [
+                i for i in range(object_id)
+                if i not in free_object_ids and (np.abs(cm[i][[0, 2]]).max() > despawn_distance
+                or cm[i][1] < boundary_box_np[0][1] - despawn_distance)
+            ]
+            if gone:
+                object_id = remove_objects_mock(gone, object_id)
+
         if window.is_pressed("q"):
             pass
 
+        if profiling and window.is_pressed("p"):
+            dump_profile('profile.csv')
+
         scene.point_light((1.0, 1.0, 3.0), color=(1.0, 1.0, 1.0))
         scene.point_light((1.0, 1.0, 5.0), color=(1.0, 1.0, 1.0))
         scene.point_light((1.0, 1.0, 7.0), color=(1.0, 1.0, 1.0))
@@ -0,0 +1,214 @@
+import argparse
+import os
+
+import numpy as np
+
+
+# snapshots: save / restore the whole simulation state of rigid_scene
+# usage: python scripts/snapshot.py state.tsnap   (prints the header)
+#
+# A snapshot is one flat little-endian buffer, the same bytes in memory and
+# on disk, so a file can be np.memmap'ed and restored without a parse step:
+#   header            snapshot_header, 64 bytes
+#   particles         float32 [particle_num, particle_row]   rs.save_snapshot rows
+#   objects           float32 [object_num, object_row]
+#   scenes            float32 [scene_num, scene_row]         set_scenes parameters
+#   kinematic poses   float32 [object_num, kinematic_row]    rs.kinematic_poses_np
+#   free object ids   int32   [free_id_num]                  rs.free_object_ids
+# Every block starts on a multiple of 4 bytes. The row sizes are part of the
+# header, a snapshot only loads into a build with the same layout and at
+# least scene_num scenes. Version 1 had no scene block.
+# The frame ring keeps the last snapshot_ring_size frames in preallocated
+# buffers for rollback, push / rollback go through the same functions.
+
+
+snapshot_magic = b'TIOUCHSN'
+snapshot_version = 2
+snapshot_ring_size = int(os.environ.get('TIOUCH_SNAPSHOT_RING', 8))
+
+FLAG_STATIC_SDF_READY = 1
+
+snapshot_header = np.dtype([
+    ('magic', 'S8'),
+    ('version', '<u4'),
+    ('flags', '<u4'),
+    ('particle_num', '<i4'),
+    ('object_num', '<i4'),
+    ('particle_row', '<i4'),
+    ('object_row', '<i4'),
+    ('kinematic_row', '<i4'),
+    ('free_id_num', '<i4'),
+    ('frame', '<i8'),
+    ('scene_num', '<i4'),
+    ('scene_row', '<i4'),
+    ('reserved', '<u4', 2),
+])
+assert snapshot_header.itemsize == 64
+
+
+# layout----------------------------------------------------------------
+def snapshot_blocks(header):
+    # (name, dtype, shape) of every block after the header, in file order
+    return [
+        ('particles', np.float32, (int(header['particle_num']), int(header['particle_row']))),
+        ('objects', np.float32, (int(header['object_num']), int(header['object_row']))),
+        ('scenes', np.float32, (int(header['scene_num']), int(header['scene_row']))),
+        ('kinematic_poses', np.float32, (int(header['object_num']), int(header['kinematic_row']))),
+        ('free_ids', np.int32, (int(header['free_id_num']),)),
+    ]
+
+
+def snapshot_nbytes(header):
+    return snapshot_header.itemsize + sum(
+        int(np.prod(shape)) * np.dtype(dtype).itemsize for _, dtype, shape in snapshot_blocks(header))
+
+
+def snapshot_views(buf):
+    # header record and numpy views of every block of buf (bytes, array or memmap)
+    buf = np.frombuffer(buf, dtype=np.uint8) if isinstance(buf, bytes) else buf
+    header = buf[:snapshot_header.itemsize].view(snapshot_header)[0]
+    if header['magic'] != snapshot_magic:
+        raise ValueError('not a snapshot')
+    if header['version'] != snapshot_version:
+        raise ValueError('snapshot version {}, expected {}'.format(header['version'], snapshot_version))
+    views = {}
+    offset = snapshot_header.itemsize
+    for name, dtype, shape in snapshot_blocks(header):
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        views[name] = buf[offset:offset + nbytes].view(dtype).reshape(shape)
+        offset += nbytes
+    return header, views
+
+
+def check_layout(rs, header):
+    expected = (rs.snapshot_particle_size, rs.snapshot_object_size, rs.kinematic_pose_size,
+        rs.snapshot_scene_size)
+    found = (int(header['particle_row']), int(header['object_row']), int(header['kinematic_row']),
+        int(header['scene_row']))
+    if found != expected:
+        raise ValueError('snapshot rows {} do not match this build {}'.format(found, expected))
+    if int(header['scene_num']) > rs.max_scene_num:
+        raise ValueError('snapshot of {} scenes, this build has {}'.format(
+            int(header['scene_num']), rs.max_scene_num))
+# layout----------------------------------------------------------------
+
+
+# snapshot / restore----------------------------------------------------
+def snapshot(rs, object_num, frame=0, out=None):
+    # the current state as a snapshot buffer, written into out when it is large enough
+    particles, objects, scenes = rs.save_snapshot_mock(object_num)
+    header = np.zeros((), dtype=snapshot_header)
+    header['magic'] = snapshot_magic
+    header['version'] = snapshot_version
+    header['flags'] = FLAG_STATIC_SDF_READY if rs.static_sdf_ready[None] else 0
+    header['particle_num'] = len(particles)
+    header['object_num'] = object_num
+    header['particle_row'] = rs.snapshot_particle_size
+    header['object_row'] = rs.snapshot_object_size
+    header['kinematic_row'] = rs.kinematic_pose_size
+    header['free_id_num'] = len(rs.free_object_ids)
+    header['frame'] = frame
+    header['scene_num'] = len(scenes)
+    header['scene_row'] = rs.snapshot_scene_size
+
+    nbytes = snapshot_nbytes(header)
+    if out is None or len(out) < nbytes:
+        out = np.empty(nbytes, dtype=np.uint8)
+    buf = out[:nbytes]
+    buf[:snapshot_header.itemsize] = np.frombuffer(header.tobytes(), dtype=np.uint8)
+    _, views = snapshot_views(buf)
+    views['particles'][:] = particles
+    views['objects'][:] = objects
+    views['scenes'][:] = scenes
+    views['kinematic_poses'][:] = rs.kinematic_poses_np[:object_num]
+    views['free_ids'][:] = rs.free_object_ids
+    return buf
+
+
+def restore(rs, buf):
+    # load a snapshot buffer or memmap, returns (object_num, frame)
+    header, views = snapshot_views(buf)
+    check_layout(rs, header)
+    object_num = int(header['object_num'])
+    static_sdf_ready = bool(header['flags'] & FLAG_STATIC_SDF_READY)
+    rs.load_snapshot_mock(views['particles'], views['objects'], views['scenes'], static_sdf_ready)
+    rs.kinematic_poses_np[:] = 0.0
+    rs.kinematic_poses_np[:object_num] = views['kinematic_poses']
+    rs.free_object_ids[:] = views['free_ids'].tolist()
+    if static_sdf_ready and not rs.static_sdf_ready[None]:
+        # the static objects differ from the ones the volume was baked for
+        rs.bake_static_sdf_mock()
+    return object_num, int(header['frame'])
+# snapshot / restore----------------------------------------------------
+
+
+# files-----------------------------------------------------------------
+def save(path, buf):
+    # write then rename, a reader never maps half a file
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(memoryview(np.ascontiguousarray(buf)))
+    os.replace(tmp_path, path)
+
+
+def load(path):
+    # memory mapped, restore(rs, load(path)) reads the blocks straight from the page cache
+    buf = np.memmap(path, dtype=np.uint8, mode='r')
+    snapshot_views(buf)
+    return buf
+# files-----------------------------------------------------------------
+
+
+# frame ring------------------------------------------------------------
+ring_buffers = []  # preallocated, one per slot
+ring_frames = []  # frame held by each slot, -1 when empty
+
+
+def ring_push(rs, object_num, frame):
+    # snapshot frame into the slot of the oldest frame
+    if not ring_buffers:
+        header = np.zeros((), dtype=snapshot_header)
+        header['particle_num'] = rs.max_particle_num
+        header['object_num'] = rs.max_object_num
+        header['particle_row'] = rs.snapshot_particle_size
+        header['object_row'] = rs.snapshot_object_size
+        header['kinematic_row'] = rs.kinematic_pose_size
+        header['free_id_num'] = rs.max_object_num
+        header['scene_num'] = rs.max_scene_num
+        header['scene_row'] = rs.snapshot_scene_size
+        for _ in range(snapshot_ring_size):
+            ring_buffers.append(np.empty(snapshot_nbytes(header), dtype=np.uint8))
+            ring_frames.append(-1)
+    slot = frame % snapshot_ring_size
+    snapshot(rs, object_num, frame, ring_buffers[slot])
+    ring_frames[slot] = frame
+
+
+def ring_rollback(rs, frame):
+    # restore frame if it is still in the ring, returns its object_num
+    slot = frame % snapshot_ring_size
+    if not ring_frames or ring_frames[slot] != frame:
+        raise KeyError('frame {} is not in the snapshot ring'.format(frame))
+    object_num, _ = restore(rs, ring_buffers[slot])
+    # later frames are a future that no longer happens
+    for s in range(snapshot_ring_size):
+        if ring_frames[s] > frame:
+            ring_frames[s] = -1
+    return object_num
+
+
+def ring_clear():
+    ring_frames[:] = [-1] * len(ring_frames)
+# frame ring------------------------------------------------------------
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('snapshot', help='snapshot file')
+    args = parser.parse_args()
+
+    header, views = snapshot_views(load(args.snapshot))
+    print('{}: version {}, frame {}, {} particles, {} objects, {} scenes, {} free ids{}'.format(
+        args.snapshot, header['version'], header['frame'], header['particle_num'], header['object_num'],
+        header['scene_num'], header['free_id_num'],
+        ', static sdf baked' if header['flags'] & FLAG_STATIC_SDF_READY else ''))